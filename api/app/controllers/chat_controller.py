@@ -1,30 +1,96 @@
+import asyncio
+import json
 import logging
+import time
 from fastapi import Depends, HTTPException
-from sqlalchemy.orm import Session
-from schemas.chat import ChatRequest, ChatResponse, Category1Response, Category2Response, Category3Response, Category4Response, InitialChatResponse, Approximation, ChatRequestSummary
+from sqlalchemy.ext.asyncio import AsyncSession
+from schemas.chat import ChatRequest, ChatResponse, Category1Response, Category2Response, Category3Response, Category4Response, InitialChatResponse, Approximation, ChatHistoryPage
 from services.chat_service import ChatService
 from services.chat_processing_service import ChatProcessingService
+from services.answer_policy import AnswerPolicy, ANSWER_SOURCE_TEMPLATE
 from services.chat_request_service import ChatRequestService
 from services.chat_response_service import ChatResponseService
-from database import get_db
-from typing import List
+from database import get_async_db, AsyncSessionLocal
+from utils.text_processing import clean_json_response
+from utils.resilience import UpstreamUnavailableError
+from utils.chat_pipeline import SpeculativePrefetch, StageTimer, chat_pipeline_stats, save_chat_request_in_new_session
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+def _sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
 class ChatController:
     @staticmethod
-    async def process_chat(user_id: int, content: str, db: Session = Depends(get_db)) -> ChatResponse:
+    async def process_chat(user_id: int, content: str, db: AsyncSession = Depends(get_async_db), use_cache: bool = True) -> ChatResponse:
         logger.info(f"Starting process_chat for user_id: {user_id}")
         logger.info(f"Received content: {content}")
+        timer = StageTimer()
 
-        # リクエストを保存
-        chat_request = await ChatRequestService.save_chat_request(db, user_id, content)
-        logger.info(f"Saved chat request with id: {chat_request.id}")
+        # リクエストの保存と、質問文の友人名からの先読みを、質問の分析と並行して進める
+        save_request = asyncio.ensure_future(save_chat_request_in_new_session(user_id, content))
+        prefetch = SpeculativePrefetch(user_id, content).start()
 
-        initial_response = await ChatService.process_chat(user_id, content, db)
-        logger.info(f"Initial ChatResponse: {initial_response}")
+        completed = False
+        try:
+            started_at = time.perf_counter()
+            initial_response = await ChatService.process_chat(user_id, content, db, use_cache)
+            timer.record("analysis", started_at)
+            logger.info(f"Initial ChatResponse: {initial_response}")
+
+            started_at = time.perf_counter()
+            speculation = await prefetch.resolve(initial_response.question_category, initial_response.who)
+            chat_pipeline_stats.record_speculation(speculation)
+            timer.record("speculation_wait", started_at)
+
+            started_at = time.perf_counter()
+            result, similarity_category = await ChatController._run_category(db, user_id, content, initial_response, use_cache)
+            response = ChatController._build_response(initial_response, result, similarity_category)
+            timer.record("category", started_at)
+            completed = True
+        except UpstreamUnavailableError as e:
+            logger.error(f"Gemini unavailable and no degraded answer possible: {str(e)}")
+            raise HTTPException(status_code=503, detail="The answer service is temporarily unavailable. Please try again later.")
+        finally:
+            prefetch.cancel()
+            if not completed:
+                await ChatController._discard_save_request(save_request)
+
+        final_response = ChatResponse(
+            question_category=initial_response.question_category,
+            response=response
+        )
+
+        logger.debug(f"Final response before saving: {final_response.dict()}")
+
+        # レスポンスを保存
+        started_at = time.perf_counter()
+        chat_request_id = await save_request
+        logger.info(f"Saved chat request with id: {chat_request_id}")
+        await ChatResponseService.save_chat_response(db, chat_request_id, final_response.dict())
+        timer.record("save_response", started_at)
+
+        logger.info(f"process_chat timings for user_id: {user_id} (speculation: {speculation}): {timer.finish()}")
+        return final_response
+
+    @staticmethod
+    async def _discard_save_request(save_request: "asyncio.Future[int]") -> None:
+        """回答を作れなかった場合、まだ終わっていないChatRequestの保存を取り消し、結果（例外）を回収する"""
+        save_request.cancel()
+        try:
+            chat_request_id = await save_request
+            logger.info(f"Chat request {chat_request_id} was saved without a response")
+        except asyncio.CancelledError:
+            # 自分自身が取り消された場合はそのまま伝える
+            if not save_request.cancelled():
+                raise
+        except Exception as e:
+            logger.error(f"Error saving chat request: {str(e)}")
 
+    @staticmethod
+    async def _run_category(db: AsyncSession, user_id: int, content: str, initial_response: InitialChatResponse, use_cache: bool = True) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
         if initial_response.question_category == 1:
             logger.info("Processing category 1")
             result, similarity_category = await ChatProcessingService.process_category_1(
@@ -36,7 +102,37 @@ class ChatController:
             )
             logger.info(f"Category 1 result: {result}")
             logger.info(f"Category 1 similarity: {similarity_category}")
-            response = Category1Response(
+        elif initial_response.question_category == 2:
+            logger.info("Processing category 2")
+            result, similarity_category = await ChatProcessingService.process_category_2(
+                db, user_id, initial_response.who, initial_response.what, initial_response.related_subject, content, use_cache
+            )
+            logger.debug(f"ChatProcessingService response: result={result}, similarity_category={similarity_category}")
+        elif initial_response.question_category == 3:
+            logger.info("Processing category 3")
+            result, similarity_category = await ChatProcessingService.process_category_3(
+                db,
+                user_id,
+                initial_response.what
+            )
+        elif initial_response.question_category == 4:
+            logger.info("Processing category 4")
+            result, similarity_category = await ChatProcessingService.process_category_4(
+                db,
+                user_id,
+                initial_response.who
+            )
+            logger.info(f"Category 4 result: {result}")
+            logger.info(f"Category 4 similarity: {similarity_category}")
+        else:
+            # 他のカテゴリーの処理（必要に応じて追加）
+            result, similarity_category = None, None
+        return result, similarity_category
+
+    @staticmethod
+    def _build_response(initial_response: InitialChatResponse, result: Optional[Dict[str, Any]], similarity_category: Optional[str]):
+        if initial_response.question_category == 1:
+            return Category1Response(
                 who=initial_response.who,
                 what=initial_response.what,
                 related_subject=initial_response.related_subject,
@@ -44,15 +140,10 @@ class ChatController:
                 answer=result["answer"] if isinstance(result["answer"], (str, dict)) else None,
                 approximation=result.get("approximation"),
                 similarity_category=similarity_category,
-                final_answer=result.get("final_answer")
+                final_answer=result.get("final_answer"),
+                answer_source=AnswerPolicy.answer_source(result)
             )
         elif initial_response.question_category == 2:
-            logger.info("Processing category 2")
-            result, similarity_category = await ChatProcessingService.process_category_2(
-                db, user_id, initial_response.who, initial_response.what, initial_response.related_subject, content
-            )
-            logger.debug(f"ChatProcessingService response: result={result}, similarity_category={similarity_category}")
-
             approximation = result.get("approximation")
             if isinstance(approximation, dict):
                 approximation = Approximation(**approximation)
@@ -61,7 +152,7 @@ class ChatController:
             else:
                 approximation = None
 
-            response = Category2Response(
+            return Category2Response(
                 who=initial_response.who,
                 what=initial_response.what or "Unknown",
                 related_subject=initial_response.related_subject,
@@ -69,16 +160,11 @@ class ChatController:
                 answer=result.get("answer"),
                 approximation=approximation,
                 similarity_category=similarity_category,
-                final_answer=result.get("final_answer")
+                final_answer=result.get("final_answer"),
+                answer_source=AnswerPolicy.answer_source(result)
             )
         elif initial_response.question_category == 3:
-            logger.info("Processing category 3")
-            result, similarity_category = await ChatProcessingService.process_category_3(
-                db,
-                user_id,
-                initial_response.what
-            )
-            response = Category3Response(
+            return Category3Response(
                 who=initial_response.who,
                 what=initial_response.what,
                 related_subject=initial_response.related_subject,
@@ -86,20 +172,12 @@ class ChatController:
                 answer=result["answer"],
                 approximation=result.get("approximation"),
                 similarity_category=similarity_category,
-                final_answer=result.get("final_answer")
+                final_answer=result.get("final_answer"),
+                metadata=result.get("metadata"),
+                answer_source=AnswerPolicy.answer_source(result)
             )
-
-        # In ChatController
         elif initial_response.question_category == 4:
-            logger.info("Processing category 4")
-            result, confidence = await ChatProcessingService.process_category_4(
-                db,
-                user_id,
-                initial_response.who
-            )
-            logger.info(f"Category 4 result: {result}")
-            logger.info(f"Category 4 similarity: {confidence}")
-            response = Category4Response(
+            return Category4Response(
                 who=initial_response.who,
                 what=initial_response.what or "general description",
                 related_subject=initial_response.related_subject,
@@ -108,33 +186,86 @@ class ChatController:
                 summary=result.get("summary", "Summary not available."),
                 missing_info=result.get("missing_info"),
                 approximation=result.get("approximation"),
-                similarity_category=confidence,
-                final_answer=result.get("final_answer")
+                similarity_category=similarity_category,
+                final_answer=result.get("final_answer"),
+                metadata=result.get("metadata"),
+                answer_source=AnswerPolicy.answer_source(result)
             )
-        else:
-            # 他のカテゴリーの処理（必要に応じて追加）
-            response = None
-        final_response = ChatResponse(
-            question_category=initial_response.question_category,
-            response=response
-        )
+        return None
 
-        logger.debug(f"Final response before saving: {final_response.dict()}")
+    @staticmethod
+    async def stream_chat(user_id: int, content: str, use_cache: bool = True) -> AsyncIterator[str]:
+        """/chat/stream 用: 分析結果を先に送り、続けて最終回答をServer-Sent Eventsで送る
 
-        # レスポンスを保存
-        await ChatResponseService.save_chat_response(db, chat_request.id, final_response.dict())
+        Geminiが生成した順にトークン単位で流せるのはカテゴリー②のLLM回答だけで、"token" イベントで送る。
+        カテゴリー①③④とテンプレート回答は完成した回答を1回の "answer" イベントで送る
+        （カテゴリー①④は回答がJSON応答の一部として生成され、カテゴリー③は順位付けの後にテンプレートで作るため）。
+        ストリームはレスポンス送信中も続くので、依存性注入のセッションではなく専用のセッションを使う。
+        """
+        db = AsyncSessionLocal()
+        try:
+            logger.info(f"Starting stream_chat for user_id: {user_id}")
+            chat_request = await ChatRequestService.save_chat_request(db, user_id, content)
 
-        return final_response
+            initial_response = await ChatService.process_chat(user_id, content, db, use_cache)
+            yield _sse_event("analysis", initial_response.dict())
+
+            if initial_response.question_category == 2:
+                # カテゴリー②は属性検索の後、回答文をトークン単位で流す
+                result, similarity_category = await ChatProcessingService.resolve_category_2(
+                    db, user_id, initial_response.who, initial_response.what, initial_response.related_subject
+                )
+                template_answer = None
+                if "final_answer" not in result:
+                    template_answer = AnswerPolicy.category_2_template(initial_response.who, result, result.get("attribute_similarity"))
+                if template_answer:
+                    result["final_answer"] = template_answer
+                    result["answer_source"] = ANSWER_SOURCE_TEMPLATE
+                    yield _sse_event("answer", {"text": template_answer})
+                elif "final_answer" not in result:
+                    chunks = []
+                    try:
+                        async for chunk in ChatProcessingService.stream_final_answer(content, result, 2, user_id):
+                            chunks.append(chunk)
+                            yield _sse_event("token", {"text": chunk})
+                        final_answer = clean_json_response("".join(chunks))
+                    except UpstreamUnavailableError as e:
+                        logger.warning(f"Gemini unavailable while streaming, returning the best matching attribute: {str(e)}")
+                        result["degraded"] = True
+                        final_answer = ChatProcessingService.category_2_degraded_answer(initial_response.who, result)
+                        yield _sse_event("token", {"text": final_answer, "replace": True})
+                    result["final_answer"] = final_answer or ChatProcessingService.category_2_fallback_answer(result)
+                elif result["final_answer"]:
+                    yield _sse_event("answer", {"text": result["final_answer"]})
+            else:
+                # 他のカテゴリーはトークン単位で流せないので、完成した回答をまとめて送る
+                result, similarity_category = await ChatController._run_category(db, user_id, content, initial_response, use_cache)
+                if result and result.get("final_answer"):
+                    yield _sse_event("answer", {"text": result["final_answer"]})
+
+            final_response = ChatResponse(
+                question_category=initial_response.question_category,
+                response=ChatController._build_response(initial_response, result, similarity_category)
+            )
+            await ChatResponseService.save_chat_response(db, chat_request.id, final_response.dict())
+            yield _sse_event("done", final_response.dict())
+        except Exception as e:
+            logger.exception(f"Error in stream_chat: {str(e)}")
+            yield _sse_event("error", {"detail": str(e)})
+        finally:
+            await db.close()
 
     @staticmethod
-    async def process_test_chat(user_id: int, content: str, db: Session = Depends(get_db)) -> InitialChatResponse:
+    async def process_test_chat(user_id: int, content: str, db: AsyncSession = Depends(get_async_db)) -> InitialChatResponse:
         initial_response = await ChatService.process_chat(user_id, content, db)
         logger.debug(f"Initial ChatResponse: {initial_response}")
         return initial_response
 
     @staticmethod
-    def get_user_chats(db: Session, user_id: int) -> List[ChatRequestSummary]:
+    async def get_user_chats(db: AsyncSession, user_id: int, limit: int = 50, cursor: Optional[str] = None) -> ChatHistoryPage:
         try:
-            return ChatService.get_user_chats_service(db, user_id)
+            return await ChatService.get_user_chats_service(db, user_id, limit, cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
@@ -1,24 +1,24 @@
 import logging
 from fastapi import Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from models.friend import Friend
 from schemas.conversation import ConversationInput
 from schemas.friend import FriendCreate, FriendUpdate, FriendInDB, FriendDetailRequest, FriendDetailResponse, UpdateFriendDetailsRequest, UpdateFriendDetailsResponse
 from schemas.attribute import AttributeSchema
 from services import conversation_service, attribute_service, friend_service
-from database import get_db
+from database import get_async_db
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 class FriendController:
     @staticmethod
-    async def extract_and_save_attributes(user_id: int, conversation: ConversationInput, db: Session = Depends(get_db)):
+    async def extract_and_save_attributes(user_id: int, conversation: ConversationInput, db: AsyncSession = Depends(get_async_db)):
         logger.debug(f"Starting extract_and_save_attributes for user_id: {user_id}, friend_id: {conversation.friend_id}")
         try:
             # Extract attributes from conversation
             logger.debug("Extracting attributes from conversation")
-            result = await conversation_service.extract_attributes_service(conversation)
+            result = await conversation_service.extract_attributes_service(conversation, user_id)
             logger.debug(f"Extracted result: {result}")
             if "error" in result:
                 logger.error(f"Error in extract_attributes_service: {result['error']}")
@@ -28,12 +28,9 @@ class FriendController:
                 logger.error(f"No 'attributes' key in result: {result}")
                 raise HTTPException(status_code=500, detail="Unexpected response format from attribute extraction")
 
-            # Process attributes and save them
+            # Process attributes and save them together with the conversation history
             logger.debug("Processing and saving attributes")
-            processed_attributes = await attribute_service.process_attributes(db, user_id, conversation.friend_id, result["attributes"])
-
-            # Save conversation history
-            await conversation_service.save_conversation_history(db, user_id, conversation)
+            processed_attributes = await attribute_service.process_attributes(db, user_id, conversation.friend_id, result["attributes"], conversation)
 
             logger.debug("Attributes extracted and saved successfully")
             return {
@@ -49,21 +46,21 @@ class FriendController:
             raise HTTPException(status_code=500, detail=str(e))
 
     @staticmethod
-    async def get_all_attributes(db: Session = Depends(get_db)):
+    async def get_all_attributes(db: AsyncSession = Depends(get_async_db)):
         attributes = await friend_service.get_all_attributes(db)
         return [AttributeSchema.from_orm(attr) for attr in attributes]
 
     @staticmethod
-    async def find_similar_attributes(query: str, db: Session = Depends(get_db)):
+    async def find_similar_attributes(query: str, db: AsyncSession = Depends(get_async_db)):
         similar_attributes = await friend_service.find_similar_attributes(db, query)
         if not similar_attributes:
             return {"message": "No similar attributes found"}
         return {"similar_attributes": similar_attributes}
 
     @staticmethod
-    def create_friend(friend: FriendCreate, db: Session, user_id: int):
+    async def create_friend(friend: FriendCreate, db: AsyncSession, user_id: int):
         try:
-            return friend_service.create_friend(db, friend, user_id)
+            return await friend_service.create_friend(db, friend, user_id)
         except HTTPException as e:
             # HTTPExceptionをそのまま再発生させる
             raise e
@@ -72,37 +69,44 @@ class FriendController:
             raise HTTPException(status_code=500, detail=str(e))
 
     @staticmethod
-    def get_friend(friend_id: int, db: Session = Depends(get_db)):
-        db_friend = friend_service.get_friend(db, friend_id)
+    async def get_friend(friend_id: int, db: AsyncSession = Depends(get_async_db)):
+        db_friend = await friend_service.get_friend(db, friend_id)
         if db_friend is None:
             raise HTTPException(status_code=404, detail="Friend not found")
         return db_friend
 
     @staticmethod
-    def get_friends(db: Session, user_id: int):
-        return friend_service.get_friends_by_user_id(db, user_id)
+    async def get_friends(db: AsyncSession, user_id: int):
+        return await friend_service.get_friends_by_user_id(db, user_id)
 
     @staticmethod
-    def update_friend(friend_id: int, friend: FriendUpdate, db: Session = Depends(get_db)):
-        db_friend = friend_service.update_friend(db, friend_id, friend)
+    async def update_friend(friend_id: int, friend: FriendUpdate, db: AsyncSession = Depends(get_async_db)):
+        db_friend = await friend_service.update_friend(db, friend_id, friend)
         if db_friend is None:
             raise HTTPException(status_code=404, detail="Friend not found")
         return db_friend
 
     @staticmethod
-    def get_friend_details_with_history(db: Session, user_id: int, request: FriendDetailRequest) -> FriendDetailResponse:
+    async def delete_friend(friend_id: int, db: AsyncSession = Depends(get_async_db)):
+        db_friend = await friend_service.delete_friend(db, friend_id)
+        if db_friend is None:
+            raise HTTPException(status_code=404, detail="Friend not found")
+        return {"message": "Friend deleted successfully"}
+
+    @staticmethod
+    async def get_friend_details_with_history(db: AsyncSession, user_id: int, request: FriendDetailRequest) -> FriendDetailResponse:
         try:
-            return friend_service.get_friend_details_with_history(db, user_id, request.friend_id)
+            return await friend_service.get_friend_details_with_history(db, user_id, request.friend_id)
         except HTTPException as e:
             raise e
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
 
     @staticmethod
-    def update_friend_details(db: Session, user_id: int, request: UpdateFriendDetailsRequest) -> UpdateFriendDetailsResponse:
+    async def update_friend_details(db: AsyncSession, user_id: int, request: UpdateFriendDetailsRequest) -> UpdateFriendDetailsResponse:
         logger.info(f"Updating friend details for user_id: {user_id}, friend_id: {request.friend_id}")
         try:
-            result = friend_service.update_friend_details(db, user_id, request.friend_id, request.attributes)
+            result = await friend_service.update_friend_details(db, user_id, request.friend_id, request.attributes)
             logger.info("Successfully updated friend details")
             return result
         except HTTPException as e:
@@ -22,6 +22,86 @@ class Environment(BaseSettings):
     # 環境設定
     ENVIRONMENT: str = "development"
 
+    # DBコネクションプール（同期・非同期のエンジンそれぞれに適用される）
+    # 1プロセスの最大接続数は (DB_POOL_SIZE + DB_MAX_OVERFLOW) × 2。ワーカー数を掛けてDBの接続上限に収める
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0
+    # Herokuなどでアイドル中の接続が切られる前に作り直す（秒、-1で無効）
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    # asyncpgのプリペアドステートメントのキャッシュ件数（PgBouncerのtransactionモードを挟む場合は0にする）
+    DB_STATEMENT_CACHE_SIZE: int = 500
+
+    # Embedding設定
+    EMBEDDING_MODEL_NAME: str = "all-MiniLM-L6-v2"
+    EMBEDDING_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    # 空文字の場合はディスクキャッシュを無効化
+    EMBEDDING_CACHE_PATH: str = os.path.join(PROJECT_ROOT, ".cache", "embeddings.sqlite3")
+    # 起動時に構築するEmbedding行列（同義語テーブルなど）の保存先
+    EMBEDDING_ARTIFACT_DIR: str = os.path.join(PROJECT_ROOT, ".cache")
+    # エンコードを実行する専用スレッドプールの大きさと、torchの演算スレッド数（0以下ならtorchの既定値）
+    EMBEDDING_EXECUTOR_WORKERS: int = 4
+    EMBEDDING_TORCH_THREADS: int = 2
+    # 並行リクエストのエンコードをまとめる時間窓とバッチ上限（0以下で無効）
+    EMBEDDING_BATCH_WINDOW_MS: float = 5.0
+    EMBEDDING_BATCH_MAX_SIZE: int = 64
+    # ユーザーごとのベクトルインデックス（カテゴリー③の検索用）
+    VECTOR_INDEX_MAX_USERS: int = 128
+    VECTOR_INDEX_TTL_SECONDS: int = 300
+
+    # Gemini API設定
+    GEMINI_MODEL_NAME: str = "gemini-pro"
+    # google: 本番のAPI / stub: scripts/gemini_stub_server.py / record: googleへの呼び出しを記録 / replay: 記録から再生
+    GEMINI_BACKEND: str = "google"
+    GEMINI_STUB_URL: str = "http://127.0.0.1:8765"
+    GEMINI_RECORDING_PATH: str = os.path.join(PROJECT_ROOT, ".cache", "gemini_recording.jsonl")
+    # 1回の試行のタイムアウトと、リトライを含めた1回の呼び出し全体の期限
+    GEMINI_TIMEOUT_SECONDS: float = 30.0
+    GEMINI_DEADLINE_SECONDS: float = 45.0
+    # 再試行可能なエラー（タイムアウト・429・5xx）のリトライ（ジッター付き指数バックオフ）
+    GEMINI_MAX_RETRIES: int = 2
+    GEMINI_RETRY_BASE_SECONDS: float = 0.5
+    GEMINI_RETRY_MAX_SECONDS: float = 4.0
+    # p95を超えても返らない呼び出しに同じリクエストをもう1本送る（クォータを余分に使うので既定は無効）
+    GEMINI_HEDGE_ENABLED: bool = False
+    GEMINI_HEDGE_PERCENTILE: float = 95.0
+    # リトライしても失敗した呼び出しが連続でこの回数に達したら、GEMINI_BREAKER_RESET_SECONDSの間Geminiを呼ばずに縮退した回答を返す
+    GEMINI_BREAKER_FAILURE_THRESHOLD: int = 5
+    GEMINI_BREAKER_RESET_SECONDS: float = 30.0
+    # プロセス全体とユーザーごとのGemini同時呼び出し数の上限
+    GEMINI_MAX_CONCURRENCY: int = 16
+    GEMINI_PER_USER_CONCURRENCY: int = 2
+    # 質問分析・回答生成のLLM応答キャッシュ
+    LLM_CACHE_MAX_ENTRIES: int = 1024
+    LLM_CACHE_TTL_SECONDS: int = 3600
+
+    # カテゴリー③④のプロンプトに入れる友人・属性情報のトークン予算と件数上限
+    PROMPT_CONTEXT_TOKEN_BUDGET: int = 1500
+    # 1回のプロンプトに入れる友人数。候補がこれを超えると、この人数ずつのシャードに分けて並行に順位付けする
+    CATEGORY_3_MAX_FRIENDS: int = 20
+    CATEGORY_3_MAX_CANDIDATES: int = 200
+    CATEGORY_3_SHARD_CONCURRENCY: int = 10
+    CATEGORY_3_MAX_ATTRIBUTES_PER_FRIEND: int = 8
+    CATEGORY_4_MAX_ATTRIBUTES: int = 60
+
+    # 属性の類似度がしきい値以上なら、Geminiを呼ばずにテンプレートで回答する（カテゴリー①は質問に属性値が含まれる場合のみ）
+    ANSWER_TEMPLATES_ENABLED: bool = True
+    CATEGORY_1_TEMPLATE_THRESHOLD: float = 0.8
+    # カテゴリー①は、属性名と質問の同義語カテゴリー（住まい・仕事など）の類似度もこの値以上であることを求める
+    CATEGORY_1_TEMPLATE_CATEGORY_THRESHOLD: float = 0.6
+    CATEGORY_2_TEMPLATE_THRESHOLD: float = 0.8
+
+    # ローカルの質問分類器（確信度が閾値以上ならGeminiでの質問分析を省略する）
+    QUESTION_CLASSIFIER_ENABLED: bool = True
+    QUESTION_CLASSIFIER_K: int = 5
+    QUESTION_CLASSIFIER_CONFIDENCE: float = 0.8
+    QUESTION_CLASSIFIER_MIN_SIMILARITY: float = 0.75
+    # 学習例として読み込むchat_responsesの最大件数
+    QUESTION_CLASSIFIER_MAX_EXAMPLES: int = 2000
+    # 高速パスで答えた質問のうち、Geminiでも分析して一致率を測る割合
+    QUESTION_CLASSIFIER_SHADOW_RATE: float = 0.05
+
     class Config:
         env_file = os.path.join(PROJECT_ROOT, '.env')
 
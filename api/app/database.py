@@ -1,7 +1,10 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from core.config import get_env
+from utils.db_pool import TimedQueuePool, TimedAsyncAdaptedQueuePool
 from urllib.parse import quote_plus
 
 env = get_env()
@@ -16,15 +19,38 @@ else:
     encoded_password = quote_plus(env.DB_PASSWORD)
     DATABASE_URL = f"postgresql://{env.DB_USER}:{encoded_password}@{env.DB_HOST}:{env.DB_PORT}/{env.DB_NAME}"
 
+# コネクションプールの設定（同期・非同期のエンジンで共通）
+# pre_pingで切断済みの接続を使う前に検出し、recycleでアイドル中に切られる前に接続を作り直す
+POOL_OPTIONS = {
+    "pool_size": env.DB_POOL_SIZE,
+    "max_overflow": env.DB_MAX_OVERFLOW,
+    "pool_timeout": env.DB_POOL_TIMEOUT,
+    "pool_recycle": env.DB_POOL_RECYCLE,
+    "pool_pre_ping": env.DB_POOL_PRE_PING,
+}
+
 # SSLモードの設定（Heroku用）
 if env.ENVIRONMENT == "production":
-    Engine = create_engine(DATABASE_URL, connect_args={"sslmode": "require"})
+    Engine = create_engine(DATABASE_URL, poolclass=TimedQueuePool, connect_args={"sslmode": "require"}, **POOL_OPTIONS)
 else:
-    Engine = create_engine(DATABASE_URL)
+    Engine = create_engine(DATABASE_URL, poolclass=TimedQueuePool, **POOL_OPTIONS)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=Engine)
 BaseModel = declarative_base()
 
+# 非同期エンジン（asyncpg）。クエリの待ち時間中もイベントループを止めないので、async defのルートではこちらを使う
+# asyncpgはクエリをサーバー側でprepareし、接続ごとにSQL文をキーにキャッシュして再利用する（0で無効）
+ASYNC_DATABASE_URL = make_url(DATABASE_URL).set(drivername="postgresql+asyncpg").update_query_dict(
+    {"prepared_statement_cache_size": str(env.DB_STATEMENT_CACHE_SIZE)}
+)
+if env.ENVIRONMENT == "production":
+    AsyncEngine = create_async_engine(ASYNC_DATABASE_URL, poolclass=TimedAsyncAdaptedQueuePool, connect_args={"ssl": "require"}, **POOL_OPTIONS)
+else:
+    AsyncEngine = create_async_engine(ASYNC_DATABASE_URL, poolclass=TimedAsyncAdaptedQueuePool, **POOL_OPTIONS)
+
+# コミット後に属性を読むたびに再読み込み（=暗黙のI/O）が起きないよう、expire_on_commit=Falseにする
+AsyncSessionLocal = async_sessionmaker(AsyncEngine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 def get_db():
     db = SessionLocal()
     try:
@@ -32,6 +58,16 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def get_pool_stats() -> dict:
+    return {
+        "sync": TimedQueuePool.stats.snapshot(Engine.pool),
+        "async": TimedAsyncAdaptedQueuePool.stats.snapshot(AsyncEngine.sync_engine.pool),
+    }
+
 # デバッグ情報（オプション）
 print(f"Current environment: {env.ENVIRONMENT}")
 print(f"Using database URL: {'DATABASE_URL is set' if env.ENVIRONMENT == 'production' else DATABASE_URL.split('@')[1]}")
@@ -1,8 +1,13 @@
 import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from routes import user_routes, conversation_routes, friend_routes, chat_routes, auth_routes, test_routes
-from database import Engine, BaseModel as SQLAlchemyBaseModel
+from routes import user_routes, conversation_routes, friend_routes, chat_routes, auth_routes, test_routes, metrics_routes, health_routes
+import logging
+from database import Engine, AsyncEngine, AsyncSessionLocal, BaseModel as SQLAlchemyBaseModel
+from services.attribute_service import load_attribute_registry
+from utils.warmup import start_warmup_in_background
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
@@ -28,10 +33,25 @@ app.include_router(user_routes.router)
 app.include_router(conversation_routes.router)
 app.include_router(friend_routes.router)
 app.include_router(chat_routes.router)
+app.include_router(metrics_routes.router, tags=["metrics"])
+app.include_router(health_routes.router, prefix="/health", tags=["health"])
 
 @app.on_event("startup")
 async def startup():
     SQLAlchemyBaseModel.metadata.create_all(bind=Engine)
+    # 属性名→idの対応を読み込んでおく（失敗しても、各リクエストで無い属性名だけDBから引く）
+    try:
+        async with AsyncSessionLocal() as db:
+            await load_attribute_registry(db)
+    except Exception as e:
+        logger.exception(f"Failed to load the attribute registry: {str(e)}")
+    # モデルの読み込みと同義語テーブルのEmbedding行列の構築はバックグラウンドで行い、
+    # 完了するまで /health/ready は503を返す（/health/live は起動直後から200）
+    start_warmup_in_background()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await AsyncEngine.dispose()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,24 @@
+"""Add embedding_key to friend_attributes
+
+Revision ID: 2eba859ce0f6
+Revises: 85154f2053fa
+Create Date: 2026-10-18 10:02:14.318207+09:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2eba859ce0f6'
+down_revision = '85154f2053fa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # embeddingを計算した (モデル名, テキスト) のハッシュ。NULLの行は読み込み時に再計算される
+    op.add_column('friend_attributes', sa.Column('embedding_key', sa.String(length=64), nullable=True))
+
+def downgrade():
+    op.drop_column('friend_attributes', 'embedding_key')
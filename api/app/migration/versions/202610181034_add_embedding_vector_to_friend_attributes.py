@@ -0,0 +1,25 @@
+"""Add binary embedding_vector column to friend_attributes
+
+Revision ID: 4e8f4f2dc514
+Revises: 2eba859ce0f6
+Create Date: 2026-10-18 10:34:51.902114+09:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e8f4f2dc514'
+down_revision = '2eba859ce0f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # NULL許容・デフォルト無しの列追加なのでテーブルの書き換えは発生しない。
+    # 既存行のJSON(embedding)からの変換は scripts/backfill_embedding_vectors.py でバッチ実行する
+    op.add_column('friend_attributes', sa.Column('embedding_vector', sa.LargeBinary(), nullable=True))
+
+def downgrade():
+    op.drop_column('friend_attributes', 'embedding_vector')
@@ -0,0 +1,24 @@
+"""Add (user_id, created_at, id) index to chat_requests
+
+Revision ID: 7b3546d19e5f
+Revises: 4e8f4f2dc514
+Create Date: 2026-10-18 14:12:37.481206+09:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b3546d19e5f'
+down_revision = '4e8f4f2dc514'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # /chats/ のキーセットページネーション（ユーザーごとに (created_at, id) の降順で辿る）用
+    op.create_index('ix_chat_requests_user_id_created_at_id', 'chat_requests', ['user_id', 'created_at', 'id'])
+
+def downgrade():
+    op.drop_index('ix_chat_requests_user_id_created_at_id', table_name='chat_requests')
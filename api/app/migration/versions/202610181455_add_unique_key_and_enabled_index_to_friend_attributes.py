@@ -0,0 +1,53 @@
+"""Deduplicate friend_attributes and add a unique (user_id, friend_id, attribute_id) key and a partial index on enabled rows
+
+Revision ID: c1e03d27086e
+Revises: 7b3546d19e5f
+Create Date: 2026-10-18 14:55:09.736412+09:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c1e03d27086e'
+down_revision = '7b3546d19e5f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 同じ (user_id, friend_id, attribute_id) の行が複数ある場合は、最後に更新された行（同じならidが大きい行）だけを残す。
+    # キーのいずれかがNULLの行は一意制約の対象外なので残す
+    op.execute("""
+        DELETE FROM friend_attributes AS fa
+        USING (
+            SELECT id,
+                   row_number() OVER (
+                       PARTITION BY user_id, friend_id, attribute_id
+                       ORDER BY updated_at DESC NULLS LAST, id DESC
+                   ) AS rank
+            FROM friend_attributes
+            WHERE user_id IS NOT NULL AND friend_id IS NOT NULL AND attribute_id IS NOT NULL
+        ) AS ranked
+        WHERE fa.id = ranked.id AND ranked.rank > 1
+    """)
+
+    # 一意制約のインデックスが (user_id, friend_id, attribute_id) と (user_id, friend_id) での検索にも使われる
+    op.create_unique_constraint(
+        'uq_friend_attributes_user_friend_attribute',
+        'friend_attributes',
+        ['user_id', 'friend_id', 'attribute_id']
+    )
+    # 回答に使う属性の読み込み（enabledの行だけ）用
+    op.create_index(
+        'ix_friend_attributes_user_friend_enabled',
+        'friend_attributes',
+        ['user_id', 'friend_id'],
+        postgresql_where=sa.text('enabled')
+    )
+
+def downgrade():
+    # 削除した重複行は元に戻らない
+    op.drop_index('ix_friend_attributes_user_friend_enabled', table_name='friend_attributes')
+    op.drop_constraint('uq_friend_attributes_user_friend_attribute', 'friend_attributes', type_='unique')
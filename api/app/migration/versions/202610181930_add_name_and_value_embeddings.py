@@ -0,0 +1,31 @@
+"""Add name embeddings to attributes and value embeddings to friend_attributes
+
+Revision ID: aabee918581d
+Revises: c1e03d27086e
+Create Date: 2026-10-18 19:30:12.415637+09:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'aabee918581d'
+down_revision = 'c1e03d27086e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # NULL許容・デフォルト無しの列追加なのでテーブルの書き換えは発生しない。
+    # 値は読み込み時のバックフィル（utils.chat_processing_utils.EmbeddingBackfill）で埋まる
+    op.add_column('attributes', sa.Column('embedding_vector', sa.LargeBinary(), nullable=True))
+    op.add_column('attributes', sa.Column('embedding_key', sa.String(length=64), nullable=True))
+    op.add_column('friend_attributes', sa.Column('value_embedding_vector', sa.LargeBinary(), nullable=True))
+    op.add_column('friend_attributes', sa.Column('value_embedding_key', sa.String(length=64), nullable=True))
+
+def downgrade():
+    op.drop_column('friend_attributes', 'value_embedding_key')
+    op.drop_column('friend_attributes', 'value_embedding_vector')
+    op.drop_column('attributes', 'embedding_key')
+    op.drop_column('attributes', 'embedding_vector')
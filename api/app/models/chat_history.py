@@ -1,5 +1,5 @@
-from datetime import datetime, timezone
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, JSON, Boolean
+from utils.datetime_utils import utc_now
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, JSON, Boolean, Index
 from sqlalchemy.orm import relationship
 from database import BaseModel
 
@@ -9,11 +9,14 @@ class ChatRequest(BaseModel):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, index=True)
     content = Column(Text)
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utc_now)
+    updated_at = Column(DateTime, default=utc_now, onupdate=utc_now)
 
     response = relationship("ChatResponse", back_populates="request", uselist=False)
 
+    # /chats/ のキーセットページネーション用
+    __table_args__ = (Index("ix_chat_requests_user_id_created_at_id", "user_id", "created_at", "id"),)
+
 
 class ChatResponse(BaseModel):
     __tablename__ = "chat_responses"
@@ -30,7 +33,7 @@ class ChatResponse(BaseModel):
     approximation_value = Column(String)
     similarity_category = Column(String)
     final_answer = Column(Text)
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utc_now)
+    updated_at = Column(DateTime, default=utc_now, onupdate=utc_now)
 
     request = relationship("ChatRequest", back_populates="response")
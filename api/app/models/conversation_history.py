@@ -1,6 +1,6 @@
 from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text
 from sqlalchemy.orm import relationship
-from datetime import datetime, timezone
+from utils.datetime_utils import utc_now
 from database import BaseModel
 
 class ConversationHistory(BaseModel):
@@ -9,10 +9,10 @@ class ConversationHistory(BaseModel):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), index=True)
     friend_id = Column(Integer, ForeignKey("friends.id"), index=True)
-    conversation_date = Column(DateTime, default=datetime.now(timezone.utc))
+    conversation_date = Column(DateTime, default=utc_now)
     context = Column(Text)
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utc_now)
+    updated_at = Column(DateTime, default=utc_now, onupdate=utc_now)
 
     user = relationship("User", back_populates="conversation_histories")
     friend = relationship("Friend", back_populates="conversation_histories")
@@ -1,5 +1,5 @@
-from datetime import datetime, timezone
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Date, JSON, Boolean
+from utils.datetime_utils import utc_now
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Date, JSON, Boolean, LargeBinary, Index, UniqueConstraint, text
 from sqlalchemy.orm import relationship
 from database import BaseModel
 
@@ -9,8 +9,8 @@ class Friend(BaseModel):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     name = Column(String, index=True)
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utc_now)
+    updated_at = Column(DateTime, default=utc_now, onupdate=utc_now)
 
     user = relationship("User", back_populates="friends")
     friend_attributes = relationship("FriendAttribute", back_populates="friend")
@@ -21,8 +21,11 @@ class Attribute(BaseModel):
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True)
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
+    # 属性名だけのembedding（形式とキーはFriendAttribute.embedding_vector / embedding_keyと同じ）
+    embedding_vector = Column(LargeBinary)
+    embedding_key = Column(String(64))
+    created_at = Column(DateTime, default=utc_now)
+    updated_at = Column(DateTime, default=utc_now, onupdate=utc_now)
 
     friend_attributes = relationship("FriendAttribute", back_populates="attribute")
 
@@ -34,11 +37,24 @@ class FriendAttribute(BaseModel):
     friend_id = Column(Integer, ForeignKey("friends.id"))
     attribute_id = Column(Integer, ForeignKey("attributes.id"))
     value = Column(String)
+    # 移行前のJSONテキスト形式。バックフィル後はNULLになる
     embedding = Column(Text)
+    # リトルエンディアンfloat32の生バイト列（utils.embedding_codec）
+    embedding_vector = Column(LargeBinary)
+    # embeddingの元になった (モデル名, テキスト) のキー。値の変更やモデル変更で一致しなくなる
+    embedding_key = Column(String(64))
+    # 属性値だけのembeddingとそのキー（カテゴリー②の属性名・属性値ごとの類似度に使う）
+    value_embedding_vector = Column(LargeBinary)
+    value_embedding_key = Column(String(64))
     enabled = Column(Boolean, default=True)
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utc_now)
+    updated_at = Column(DateTime, default=utc_now, onupdate=utc_now)
 
     user = relationship("User", back_populates="friend_attributes")
     friend = relationship("Friend", back_populates="friend_attributes")
     attribute = relationship("Attribute", back_populates="friend_attributes")
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "friend_id", "attribute_id", name="uq_friend_attributes_user_friend_attribute"),
+        Index("ix_friend_attributes_user_friend_enabled", "user_id", "friend_id", postgresql_where=text("enabled")),
+    )
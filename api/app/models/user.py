@@ -1,4 +1,4 @@
-from datetime import datetime, timezone
+from utils.datetime_utils import utc_now
 from sqlalchemy import Column, Integer, String, DateTime
 from sqlalchemy.orm import relationship
 from database import BaseModel
@@ -11,8 +11,8 @@ class User(BaseModel):
     email = Column(String, unique=True, index=True)
     firebase_uid = Column(String, unique=True, index=True)
     hashed_password = Column(String(128))
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utc_now)
+    updated_at = Column(DateTime, default=utc_now, onupdate=utc_now)
 
     friends = relationship("Friend", back_populates="user")
     friend_attributes = relationship("FriendAttribute", back_populates="user")
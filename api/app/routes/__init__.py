@@ -1 +1 @@
-from . import user_routes, conversation_routes, friend_routes, chat_routes, auth_routes, test_routes
+from . import user_routes, conversation_routes, friend_routes, chat_routes, auth_routes, test_routes, metrics_routes, health_routes
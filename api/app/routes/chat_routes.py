@@ -1,32 +1,57 @@
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from schemas.chat import ChatRequest, ChatResponse, InitialChatResponse, ChatRequestSummary
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from schemas.chat import ChatRequest, ChatResponse, InitialChatResponse, ChatHistoryPage
 from controllers.chat_controller import ChatController
 from utils.jwt import get_current_user_id
-from database import get_db
+from database import get_async_db
 
 router = APIRouter()
 
 @router.post("/chat", response_model=ChatResponse)
 async def process_chat(
     chat_request: ChatRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user_id: int = Depends(get_current_user_id)
 ):
-    return await ChatController.process_chat(current_user_id, chat_request.content, db)
+    return await ChatController.process_chat(current_user_id, chat_request.content, db, chat_request.use_cache)
+
+@router.post("/chat/stream")
+async def stream_chat(
+    chat_request: ChatRequest,
+    current_user_id: int = Depends(get_current_user_id)
+):
+    """
+    Server-Sent Eventsで回答を返す。
+
+    - `analysis`: 質問の分析結果（/test-chat と同じ内容）
+    - `token`: Geminiが生成した回答の断片。カテゴリー2のLLM回答だけがトークン単位で流れる。
+      `replace: true` が付いた場合は、それまでの断片を破棄してこのテキストに置き換える
+    - `answer`: 完成した回答を1回で送る。カテゴリー1・3・4とテンプレート回答はこちらで、最初のトークンまでの時間は短くならない
+    - `done`: /chat と同じレスポンス
+    - `error`: 処理に失敗した場合
+    """
+    # ストリーム中もセッションを使うので、get_async_dbではなくコントローラー側でセッションを開く
+    return StreamingResponse(
+        ChatController.stream_chat(current_user_id, chat_request.content, chat_request.use_cache),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @router.post("/test-chat", response_model=InitialChatResponse)
-async def test_chat(chat_request: ChatRequest, db: Session = Depends(get_db)):
+async def test_chat(chat_request: ChatRequest, db: AsyncSession = Depends(get_async_db)):
     return await ChatController.process_test_chat(chat_request.user_id, chat_request.content, db)
 
-@router.get("/chats/", response_model=List[ChatRequestSummary])
+@router.get("/chats/", response_model=ChatHistoryPage)
 async def get_user_chats(
-    db: Session = Depends(get_db),
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
     current_user_id: int = Depends(get_current_user_id)
 ):
     try:
-        return ChatController.get_user_chats(db, current_user_id)
+        return await ChatController.get_user_chats(db, current_user_id, limit, cursor)
     except HTTPException as e:
         raise e
     except Exception as e:
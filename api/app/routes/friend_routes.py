@@ -1,12 +1,12 @@
 import logging
 from fastapi import APIRouter, Depends, Body, HTTPException, Request
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from controllers.friend_controller import FriendController
 from schemas.friend import FriendCreate, FriendUpdate, FriendInDB, FriendDetailRequest, FriendDetailResponse, UpdateFriendDetailsRequest, UpdateFriendDetailsResponse
 from schemas.conversation import ConversationInput
 from schemas.attribute import AttributeSchema
 from utils.jwt import get_current_user_id
-from database import get_db
+from database import get_async_db
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -14,27 +14,27 @@ logger = logging.getLogger(__name__)
 @router.post("/friends/extract_attributes")
 async def extract_attributes(
     conversation: ConversationInput = Body(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user_id: int = Depends(get_current_user_id)
 ):
     return await FriendController.extract_and_save_attributes(current_user_id, conversation, db)
 
 @router.get("/attributes", response_model=list[AttributeSchema])
-async def get_all_attributes(db: Session = Depends(get_db)):
+async def get_all_attributes(db: AsyncSession = Depends(get_async_db)):
     return await FriendController.get_all_attributes(db)
 
 @router.post("/attributes/similar")
-async def find_similar_attributes(query: str = Body(..., embed=True), db: Session = Depends(get_db)):
+async def find_similar_attributes(query: str = Body(..., embed=True), db: AsyncSession = Depends(get_async_db)):
     return await FriendController.find_similar_attributes(query, db)
 
 @router.post("/friends/", response_model=FriendInDB)
 async def create_friend(
     friend: FriendCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user_id: int = Depends(get_current_user_id)
 ):
     try:
-        return FriendController.create_friend(friend, db, current_user_id)
+        return await FriendController.create_friend(friend, db, current_user_id)
     except HTTPException as e:
         # HTTPExceptionをそのまま再発生させる
         raise e
@@ -43,16 +43,16 @@ async def create_friend(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/friends/{friend_id}", response_model=FriendInDB)
-async def read_friend(friend_id: int, db: Session = Depends(get_db)):
+async def read_friend(friend_id: int, db: AsyncSession = Depends(get_async_db)):
     return await FriendController.get_friend(friend_id, db)
 
 @router.get("/friends/", response_model=list[FriendInDB])
 async def read_friends(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user_id: int = Depends(get_current_user_id)
 ):
     try:
-        return FriendController.get_friends(db, current_user_id)
+        return await FriendController.get_friends(db, current_user_id)
     except HTTPException as e:
         # HTTPExceptionをそのまま再発生させる
         raise e
@@ -61,24 +61,24 @@ async def read_friends(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.put("/friends/{friend_id}", response_model=FriendInDB)
-async def update_friend(friend_id: int, friend: FriendUpdate, db: Session = Depends(get_db)):
+async def update_friend(friend_id: int, friend: FriendUpdate, db: AsyncSession = Depends(get_async_db)):
     return await FriendController.update_friend(friend_id, friend, db)
 
 @router.delete("/friends/{friend_id}")
 async def delete_friend(
     friend_id: int,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     return await FriendController.delete_friend(friend_id, db)
 
 @router.post("/friend/details", response_model=FriendDetailResponse)
 async def get_friend_details_with_history(
     request: FriendDetailRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user_id: int = Depends(get_current_user_id)
 ):
     try:
-        return FriendController.get_friend_details_with_history(db, current_user_id, request)
+        return await FriendController.get_friend_details_with_history(db, current_user_id, request)
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -87,12 +87,12 @@ async def get_friend_details_with_history(
 @router.post("/friend/update", response_model=UpdateFriendDetailsResponse)
 async def update_friend_details(
     request: UpdateFriendDetailsRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user_id: int = Depends(get_current_user_id)
 ):
     logger.info(f"Received update request for friend_id: {request.friend_id}")
     try:
-        result = FriendController.update_friend_details(db, current_user_id, request)
+        result = await FriendController.update_friend_details(db, current_user_id, request)
         logger.info(f"Successfully updated friend details for friend_id: {request.friend_id}")
         return result
     except HTTPException as e:
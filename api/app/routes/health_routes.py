@@ -0,0 +1,16 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from utils.warmup import readiness
+
+router = APIRouter()
+
+@router.get("/live")
+async def live():
+    # プロセスが応答できるかだけを返す（モデルの読み込み完了は待たない）
+    return {"status": "ok"}
+
+@router.get("/ready")
+async def ready():
+    state = readiness()
+    status_code = 200 if state["ready"] else 503
+    return JSONResponse(status_code=status_code, content=state)
@@ -0,0 +1,24 @@
+from fastapi import APIRouter
+from utils.embedding import get_embedding_cache_stats, get_embedding_batcher_stats
+from utils.vector_index import vector_index_registry
+from utils.attribute_registry import attribute_registry
+from utils.gemini_api import get_llm_cache_stats, get_gemini_resilience_stats
+from utils.chat_pipeline import chat_pipeline_stats
+from services.question_classifier import get_question_classifier_stats
+from database import get_pool_stats
+
+router = APIRouter()
+
+@router.get("/metrics")
+async def get_metrics():
+    return {
+        "embedding_cache": get_embedding_cache_stats(),
+        "embedding_batcher": get_embedding_batcher_stats(),
+        "vector_index": vector_index_registry.stats(),
+        "attribute_registry": attribute_registry.stats(),
+        "llm_cache": get_llm_cache_stats(),
+        "gemini": get_gemini_resilience_stats(),
+        "chat_pipeline": chat_pipeline_stats.stats(),
+        "question_classifier": get_question_classifier_stats(),
+        "db_pool": get_pool_stats(),
+    }
@@ -4,6 +4,8 @@ from datetime import datetime
 
 class ChatRequest(BaseModel):
     content: str
+    # Falseの場合、LLM応答キャッシュを使わずに取り直す
+    use_cache: bool = True
 
 class Category1Response(BaseModel):
     who: Optional[str]
@@ -14,6 +16,8 @@ class Category1Response(BaseModel):
     approximation: Optional[Any]
     similarity_category: str
     final_answer: Optional[str]
+    # 回答を作った経路（llm / template / degraded）
+    answer_source: Optional[str] = None
 
 class Approximation(BaseModel):
     attribute: Optional[str] = None
@@ -28,6 +32,8 @@ class Category2Response(BaseModel):
     approximation: Approximation | str | None = Field(default=None)
     similarity_category: str
     final_answer: Optional[str]
+    # 回答を作った経路（llm / template / degraded）
+    answer_source: Optional[str] = None
 
 class Category3Response(BaseModel):
     who: Optional[str]
@@ -38,6 +44,10 @@ class Category3Response(BaseModel):
     approximation: Optional[Any]
     similarity_category: str
     final_answer: Optional[str]
+    # 回答を作った経路（llm / template / degraded）
+    answer_source: Optional[str] = None
+    # プロンプトに含めた件数・切り捨てた件数など
+    metadata: Optional[Dict[str, Any]] = None
 
 class Category4Response(BaseModel):
     who: Optional[str]
@@ -50,6 +60,10 @@ class Category4Response(BaseModel):
     approximation: Optional[Any]
     similarity_category: str
     final_answer: Optional[str]
+    # 回答を作った経路（llm / template / degraded）
+    answer_source: Optional[str] = None
+    # プロンプトに含めた件数・切り捨てた件数など
+    metadata: Optional[Dict[str, Any]] = None
 
 class ChatResponse(BaseModel):
     question_category: int
@@ -69,3 +83,9 @@ class ChatRequestSummary(BaseModel):
     content: str
     created_at: datetime
     response: Optional[ChatResponseSummary]
+
+class ChatHistoryPage(BaseModel):
+    # 古い順に並んだ1ページ分の履歴
+    items: List[ChatRequestSummary]
+    # さらに古い履歴がある場合に、次のリクエストのcursorに渡す値
+    next_cursor: Optional[str] = None
@@ -0,0 +1,89 @@
+"""friend_attributes.embedding (JSONテキスト) を embedding_vector (float32バイト列) に変換する
+
+使い方（/app で実行）:
+    python -m scripts.backfill_embedding_vectors --batch-size 500
+
+変換した行には "属性名: 属性値" のembedding_keyも書き込み、読み込み時に再エンコードされないようにする。
+主キー順にバッチ単位で読み込み、バッチごとに短いトランザクションで更新するので、
+ロックは対象行の行ロックだけでfriend_attributes全体はロックしない。途中で止めても再実行できる。
+"""
+import argparse
+import logging
+import time
+
+from sqlalchemy import select, update
+
+from database import SessionLocal
+from models.friend import Attribute, FriendAttribute
+# Userのリレーションが参照するモデルを登録しておく（アプリ外から単独で実行するため）
+import models.chat_history  # noqa: F401
+import models.conversation_history  # noqa: F401
+from utils.embedding import attribute_embedding_text, embedding_key_for
+from utils.embedding_codec import encode_embedding, decode_legacy_embedding
+
+logger = logging.getLogger(__name__)
+
+
+def backfill_parameters(rows) -> list:
+    """バッチの行から一括UPDATEのパラメーターを作る"""
+    params = []
+    for row in rows:
+        vector = decode_legacy_embedding(row.embedding)
+        if vector is None:
+            # 壊れた値は捨てる。embedding_keyも消して読み込み時に再計算させる
+            params.append({"id": row.id, "embedding": None, "embedding_vector": None, "embedding_key": None})
+        else:
+            # JSON列は "属性名: 属性値" から作られていたので、同じテキストのキーを付ける
+            key = embedding_key_for(attribute_embedding_text(row.name, row.value))
+            params.append({"id": row.id, "embedding": None, "embedding_vector": encode_embedding(vector), "embedding_key": key})
+    return params
+
+
+def backfill(batch_size: int, sleep_seconds: float) -> int:
+    converted = 0
+    discarded = 0
+    last_id = 0
+
+    while True:
+        with SessionLocal() as db:
+            rows = db.execute(
+                select(FriendAttribute.id, FriendAttribute.embedding, FriendAttribute.value, Attribute.name)
+                .join(Attribute, FriendAttribute.attribute_id == Attribute.id)
+                .where(
+                    FriendAttribute.id > last_id,
+                    FriendAttribute.embedding.isnot(None),
+                    FriendAttribute.embedding_vector.is_(None)
+                )
+                .order_by(FriendAttribute.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+
+            params = backfill_parameters(rows)
+            batch_converted = sum(1 for p in params if p["embedding_vector"] is not None)
+            converted += batch_converted
+            discarded += len(params) - batch_converted
+
+            # 主キー指定の一括UPDATE（executemany）
+            db.execute(update(FriendAttribute), params)
+            db.commit()
+
+            last_id = rows[-1].id
+            logger.info(f"Backfilled up to id {last_id} (converted: {converted}, discarded: {discarded})")
+
+        if sleep_seconds:
+            time.sleep(sleep_seconds)
+
+    return converted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--sleep", type=float, default=0.0, help="バッチ間の待ち時間（秒）。本番負荷を抑えたい場合に指定")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    total = backfill(args.batch_size, args.sleep)
+    logger.info(f"Done. Converted {total} rows.")
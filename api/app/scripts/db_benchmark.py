@@ -0,0 +1,103 @@
+"""同期セッション（psycopg2）と非同期セッション（asyncpg）で、並行リクエストのスループットを比べる
+
+使い方（/app で実行、.env のDB設定を使う）:
+    python -m scripts.db_benchmark --user-id 1 --concurrency 1 8 32 --duration 10 --llm-ms 300
+
+1リクエストはチャット処理と同じDBアクセス（友人の検索 + 友人の全属性の読み込み）と、
+Gemini呼び出しの代わりの --llm-ms ミリ秒の待ちからなる。
+sync はasync defの中で同期セッションのクエリを直接実行する（移行前のルートと同じで、クエリ中はイベントループが止まる）。
+async はAsyncSessionで実行し、クエリの待ちと他のリクエストのLLM待ちが重なる。
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Callable, Awaitable, List, Optional
+
+from sqlalchemy import select
+
+from database import SessionLocal, AsyncSessionLocal, AsyncEngine
+from models.friend import Friend
+from utils.chat_processing_utils import find_friend, find_friend_async, get_all_friend_attributes, get_all_friend_attributes_async
+
+
+def _percentile(samples: List[float], percentile: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))]
+
+
+async def sync_request(user_id: int, friend_name: str, llm_seconds: float) -> None:
+    db = SessionLocal()
+    try:
+        friend = find_friend(db, friend_name, user_id)
+        if friend:
+            get_all_friend_attributes(db, friend.id, user_id)
+    finally:
+        db.close()
+    await asyncio.sleep(llm_seconds)
+
+
+async def async_request(user_id: int, friend_name: str, llm_seconds: float) -> None:
+    async with AsyncSessionLocal() as db:
+        friend = await find_friend_async(db, friend_name, user_id)
+        if friend:
+            await get_all_friend_attributes_async(db, friend.id, user_id)
+    await asyncio.sleep(llm_seconds)
+
+
+async def run(request: Callable[[int, str, float], Awaitable[None]], user_id: int, friend_name: str, concurrency: int, duration: float, llm_seconds: float) -> dict:
+    latencies: List[float] = []
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            await request(user_id, friend_name, llm_seconds)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p95_ms": _percentile(latencies, 95) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+async def first_friend_name(user_id: int) -> Optional[str]:
+    async with AsyncSessionLocal() as db:
+        return (await db.execute(select(Friend.name).where(Friend.user_id == user_id).limit(1))).scalar()
+
+
+async def main(args) -> None:
+    friend_name = args.friend_name or await first_friend_name(args.user_id)
+    if not friend_name:
+        raise SystemExit(f"user_id {args.user_id} has no friends to query")
+
+    modes = {"sync": sync_request, "async": async_request}
+    # 1回目にembeddingの書き戻しやコネクションの確立が入らないよう、両方を1回ずつ実行しておく
+    for request in modes.values():
+        await request(args.user_id, friend_name, 0)
+
+    print(f"{'mode':>6} {'conc':>5} {'reqs':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for concurrency in args.concurrency:
+        for mode in args.modes:
+            result = await run(modes[mode], args.user_id, friend_name, concurrency, args.duration, args.llm_ms / 1000)
+            print(f"{mode:>6} {concurrency:>5} {result['requests']:>7} {result['throughput']:>8.1f} {result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f}")
+    await AsyncEngine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--friend-name", help="defaults to the user's first friend")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--llm-ms", type=float, default=300.0, help="simulated Gemini wait per request")
+    parser.add_argument("--modes", nargs="+", choices=["sync", "async"], default=["sync", "async"])
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,63 @@
+"""friend_attributes を引くホットなクエリの実行計画を表示する
+
+使い方（/app で実行、.env のDB設定を使う）:
+    python -m scripts.explain_hot_queries --user-id 1 --friend-id 3 --attribute-id 29 > explain_before.txt
+    alembic upgrade head
+    python -m scripts.explain_hot_queries --user-id 1 --friend-id 3 --attribute-id 29 > explain_after.txt
+
+アプリと同じSQLAlchemyの文をPostgreSQLの方言でコンパイルし、EXPLAIN (ANALYZE, BUFFERS) で実行する。
+対象はSELECTだけなので、ANALYZEで実際に実行してもデータは変わらない。
+"""
+import argparse
+
+from sqlalchemy import select
+
+from database import Engine
+from models.friend import Attribute, FriendAttribute
+from utils.chat_processing_utils import friend_attributes_query, user_attributes_query
+
+
+def hot_queries(user_id: int, friend_id: int, attribute_id: int) -> dict:
+    return {
+        # カテゴリー①②④: 友人の全属性（get_all_friend_attributes）
+        "friend_attributes": friend_attributes_query(friend_id, user_id),
+        # カテゴリー③: ユーザーの全友人の属性（get_user_vector_index）
+        "user_attributes": user_attributes_query(user_id),
+        # upsert_friend_attributes のON CONFLICTで使う一意キーの検索
+        "upsert_lookup": select(FriendAttribute).where(
+            FriendAttribute.user_id == user_id,
+            FriendAttribute.friend_id == friend_id,
+            FriendAttribute.attribute_id == attribute_id
+        ),
+        # 友人詳細画面の属性一覧（get_friend_details_with_history）
+        "friend_details": (
+            select(Attribute.name, FriendAttribute.value)
+            .join(FriendAttribute, Attribute.id == FriendAttribute.attribute_id)
+            .where(FriendAttribute.friend_id == friend_id, FriendAttribute.user_id == user_id)
+        ),
+    }
+
+
+def explain(statement, analyze: bool) -> str:
+    compiled = statement.compile(dialect=Engine.dialect)
+    options = "ANALYZE, BUFFERS" if analyze else "COSTS"
+    with Engine.connect() as connection:
+        rows = connection.exec_driver_sql(f"EXPLAIN ({options}) {compiled}", compiled.params).all()
+    return "\n".join(row[0] for row in rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--friend-id", type=int, required=True)
+    parser.add_argument("--attribute-id", type=int, required=True)
+    parser.add_argument("--no-analyze", action="store_true", help="show the plan without executing the queries")
+    parser.add_argument("--only", choices=["friend_attributes", "user_attributes", "upsert_lookup", "friend_details"], nargs="+")
+    args = parser.parse_args()
+
+    for name, statement in hot_queries(args.user_id, args.friend_id, args.attribute_id).items():
+        if args.only and name not in args.only:
+            continue
+        print(f"=== {name} ===")
+        print(explain(statement, analyze=not args.no_analyze))
+        print()
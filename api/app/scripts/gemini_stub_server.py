@@ -0,0 +1,189 @@
+"""負荷テスト用のGemini代替サーバー（標準ライブラリのみ、オフラインで動く）
+
+使い方（/app で実行）:
+    python -m scripts.gemini_stub_server --port 8765 --latency lognormal:800:0.4 --seed 1
+    # APIサーバー側は .env に GEMINI_BACKEND=stub / GEMINI_STUB_URL=http://127.0.0.1:8765 を設定して起動する
+
+POST /v1/generate に {"model": ..., "prompt": ...} を送ると {"text": ...} を返す。
+応答は --canned で渡したJSONファイル（[{"match": "正規表現", "response": "..."}]）に一致すればそれを使い、
+無ければプロンプトの種類（質問分析・属性抽出・各カテゴリーの回答生成）ごとにスキーマどおりのJSON/テキストを作る。
+
+--latency の書式:
+    fixed:MS                 常にMSミリ秒
+    uniform:MIN_MS:MAX_MS    一様分布
+    normal:MEAN_MS:STD_MS    正規分布（0未満は0）
+    lognormal:MEDIAN_MS:SIGMA  対数正規分布（LLMのレイテンシの裾の長さに近い）
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional, Tuple
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(":")] if args else []
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "normal" and len(values) == 2:
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal" and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise argparse.ArgumentTypeError(f"invalid latency spec: {spec}")
+
+
+def _classify_question(question: str) -> Tuple[str, str, Optional[str]]:
+    """(カテゴリー, primary_subject, attribute) をanalyze_questionのプロンプトの例に沿って大まかに決める"""
+    text = question.strip().rstrip("?")
+    match = re.match(r"(?i)^(?:can you )?tell me about (\w[\w ]*?)$", text) or re.match(r"(?i)^what do you know about (.+)$", text)
+    if match and "'s" not in match.group(1):
+        return "④", match.group(1), None
+    match = re.match(r"(?i)^(?:what|where|when|how old|tell me about) (?:is|are|does|was)?\s*(\w+)(?:'s)?\s*(.*)$", text)
+    if match and not text.lower().startswith("who"):
+        return "②", match.group(1), match.group(2) or "information"
+    match = re.match(r"(?i)^(?:who|which \w+) (.+)$", text)
+    if match:
+        return "③", "unknown", match.group(1)
+    match = re.match(r"(?i)^(?:is|are|does|do|was|did) (\w+) (.+)$", text)
+    if match:
+        return "①", match.group(1), match.group(2)
+    return "②", "unknown", text
+
+
+def synthesize_response(prompt: str) -> str:
+    """プロンプトの種類を見分けて、呼び出し元がそのまま解析できる応答を作る"""
+    match = re.search(r"Analyze the following question in English: (.*)", prompt)
+    if match:
+        category, subject, attribute = _classify_question(match.group(1))
+        return json.dumps({
+            "category": category,
+            "primary_subject": subject,
+            "related_subject": None,
+            "attribute": attribute,
+            "relation": None,
+            "explanation": "stub classification",
+        })
+
+    if "extract all relevant information about the person" in prompt:
+        text = prompt.split("Text:", 1)[-1].split("Guidelines:", 1)[0].strip()
+        attributes = {}
+        for key, value in re.findall(r"(?i)\b(?:my|his|her) (\w+) is ([\w ]+)", text):
+            attributes[key.capitalize()] = value.strip()
+        return json.dumps(attributes or {"Note": text[:80]})
+
+    if '"likelihood"' in prompt:
+        return json.dumps({
+            "likelihood": "0.9",
+            "relevant_info": "stub relevant info",
+            "explanation": "stub explanation",
+            "final_answer": "Yes, based on the known information.",
+        })
+
+    if '"matching_friends"' in prompt:
+        names = list(dict.fromkeys(re.findall(r'"name":\s*"([^"]+)"', prompt)))
+        return json.dumps({
+            "matching_friends": [{"name": name, "explanation": "stub match", "confidence": "0.9"} for name in names],
+            "final_answer": f"{', '.join(names)} match the criteria." if names else "No one was found.",
+        })
+
+    if '"detailed_description"' in prompt:
+        return json.dumps({
+            "summary": "- stub fact",
+            "detailed_description": "stub description",
+            "missing_info": "none",
+            "final_answer": "This is a stub summary.",
+        })
+
+    if "generate a factual answer" in prompt:
+        return "Based on the available information, this is a stub answer."
+
+    return "stub response"
+
+
+class StubState:
+    def __init__(self, latency: Callable[[random.Random], float], canned: List[Tuple[re.Pattern, str]], error_rate: float, seed: Optional[int]):
+        self.latency = latency
+        self.canned = canned
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def draw(self) -> Tuple[float, bool]:
+        # 乱数列をスレッド間で共有し、--seedを指定すれば同じ順序の遅延が再現される
+        with self._lock:
+            self.requests += 1
+            return self.latency(self._rng) / 1000, self._rng.random() < self.error_rate
+
+    def respond(self, prompt: str) -> str:
+        for pattern, response in self.canned:
+            if pattern.search(prompt):
+                return response
+        return synthesize_response(prompt)
+
+
+def make_handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.rstrip("/") != "/v1/generate":
+                self.send_error(404)
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+
+            delay, fail = state.draw()
+            time.sleep(delay)
+            if fail:
+                self.send_error(503, "stub injected failure")
+                return
+
+            body = json.dumps({"text": state.respond(payload.get("prompt", ""))}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class StubServer(ThreadingHTTPServer):
+    # 既定の5だと並行する負荷テストで接続が取りこぼされる
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def load_canned(path: Optional[str]) -> List[Tuple[re.Pattern, str]]:
+    if not path:
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [(re.compile(entry["match"]), entry["response"]) for entry in json.load(f)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=parse_latency, default=parse_latency("lognormal:800:0.4"))
+    parser.add_argument("--canned", help="JSON file of [{\"match\": regex, \"response\": text}]")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    state = StubState(args.latency, load_canned(args.canned), args.error_rate, args.seed)
+    server = StubServer((args.host, args.port), make_handler(state))
+    print(f"Gemini stub server listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
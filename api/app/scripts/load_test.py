@@ -0,0 +1,102 @@
+"""軽いエンドポイントのレイテンシが、並行する /chat の負荷に引きずられるかを測る負荷テスト
+
+使い方（/app で実行、APIサーバーは別プロセスで起動しておく）:
+    python -m scripts.load_test --base-url http://localhost:8000 --token <JWT> \\
+        --chat-concurrency 0 8 16 --duration 30
+
+--chat-concurrency に指定した並行数ごとに、/chat へ質問を投げ続けるスレッドを起動し、
+その間に /friends/ を一定間隔で呼んで p50 / p95 / p99 を表示する。
+イベントループがブロックされていなければ、並行数を上げても /friends/ の p99 はほぼ変わらない。
+
+Geminiのクォータを使わずに測る場合は、scripts.gemini_stub_server を起動してAPIサーバーを
+GEMINI_BACKEND=stub で起動する（決定的な応答が必要なら record で記録して replay で再生する）。
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import List, Optional
+
+DEFAULT_QUESTIONS = [
+    "What is Jon's occupation?",
+    "Who lives in Tokyo?",
+    "Is Jon an engineer?",
+    "Tell me about Jon",
+]
+
+
+def _request(url: str, token: str, body: Optional[dict] = None, timeout: float = 120.0) -> float:
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    request = urllib.request.Request(url, data=data, method="POST" if body is not None else "GET")
+    request.add_header("Authorization", f"Bearer {token}")
+    if data is not None:
+        request.add_header("Content-Type", "application/json")
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+    except urllib.error.URLError:
+        pass
+    return time.perf_counter() - started
+
+
+def _percentile(samples: List[float], percentile: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(base_url: str, token: str, chat_concurrency: int, duration: float, probe_interval: float, questions: List[str]) -> dict:
+    stop = threading.Event()
+    chat_latencies: List[float] = []
+    probe_latencies: List[float] = []
+
+    def chat_worker(offset: int):
+        i = offset
+        while not stop.is_set():
+            chat_latencies.append(_request(f"{base_url}/chat", token, {"content": questions[i % len(questions)]}))
+            i += 1
+
+    def probe_worker():
+        while not stop.is_set():
+            probe_latencies.append(_request(f"{base_url}/friends/", token, timeout=30.0))
+            time.sleep(probe_interval)
+
+    threads = [threading.Thread(target=chat_worker, args=(i,), daemon=True) for i in range(chat_concurrency)]
+    threads.append(threading.Thread(target=probe_worker, daemon=True))
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=130)
+
+    return {
+        "chat_concurrency": chat_concurrency,
+        "chat_requests": len(chat_latencies),
+        "chat_throughput_rps": len(chat_latencies) / duration,
+        "friends_requests": len(probe_latencies),
+        "friends_p50_ms": _percentile(probe_latencies, 50) * 1000,
+        "friends_p95_ms": _percentile(probe_latencies, 95) * 1000,
+        "friends_p99_ms": _percentile(probe_latencies, 99) * 1000,
+        "friends_mean_ms": statistics.fmean(probe_latencies) * 1000 if probe_latencies else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--token", required=True)
+    parser.add_argument("--chat-concurrency", type=int, nargs="+", default=[0, 4, 16])
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--probe-interval", type=float, default=0.05)
+    args = parser.parse_args()
+
+    for concurrency in args.chat_concurrency:
+        result = run(args.base_url.rstrip("/"), args.token, concurrency, args.duration, args.probe_interval, DEFAULT_QUESTIONS)
+        print(json.dumps(result))
@@ -0,0 +1,115 @@
+import logging
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.config import get_env
+from utils.attribute_synonyms import LOCATION_PRIORITIES
+
+logger = logging.getLogger(__name__)
+
+env = get_env()
+
+# レスポンスのanswer_sourceに入る値（どの経路で回答を作ったか）
+ANSWER_SOURCE_LLM = "llm"
+ANSWER_SOURCE_TEMPLATE = "template"
+ANSWER_SOURCE_DEGRADED = "degraded"
+
+# 否定を含む質問はテンプレートで "Yes" と答えない
+_NEGATION = re.compile(r"\b(?:not|never|no)\b|n't\b", re.IGNORECASE)
+
+# "live in" / "work at" のように場所を聞く質問は、LOCATION_PRIORITIESの属性（出身地などではなく）でしか答えない
+_LOCATION_QUESTIONS = {
+    "live": re.compile(r"\b(?:lives?|lived|living|resides?|resided|residing)\s+(?:in|at)\b", re.IGNORECASE),
+    "work": re.compile(r"\b(?:works?|worked|working)\s+(?:in|at)\b", re.IGNORECASE),
+}
+_LOCATION_ATTRIBUTES = {
+    kind: {name.lower().replace("_", " ") for name in names} for kind, names in LOCATION_PRIORITIES.items()
+}
+
+
+def readable_attribute_name(name: str) -> str:
+    """"Family_Children_Count" → "family children count\""""
+    return " ".join(name.replace("_", " ").split()).lower()
+
+
+def describe_attribute(who: str, attribute_name: str, value: str) -> str:
+    """属性1つを自然な1文にする（住まいは "X lives in Y"、それ以外は "X's attribute is Y"）"""
+    readable = readable_attribute_name(attribute_name)
+    if readable in _LOCATION_ATTRIBUTES["live"]:
+        return f"{who} lives in {value}."
+    return f"{who}'s {readable} is {value}."
+
+
+def _answers_location_question(attribute_name: str, what: str) -> bool:
+    """場所を聞く質問なら、その種類の場所を表す属性かどうか（場所を聞く質問でなければTrue）"""
+    readable = readable_attribute_name(attribute_name)
+    for kind, pattern in _LOCATION_QUESTIONS.items():
+        if pattern.search(what) and readable not in _LOCATION_ATTRIBUTES[kind]:
+            return False
+    return True
+
+
+def _value_in_question(value: Optional[str], what: str) -> bool:
+    if not value or len(value.strip()) < 2:
+        return False
+    return re.search(rf"\b{re.escape(value.strip())}\b", what, re.IGNORECASE) is not None
+
+
+class AnswerPolicy:
+    """属性検索の結果だけで答えが確定する場合に、LLMを呼ばずテンプレートで回答する
+
+    しきい値はカテゴリーごとにCATEGORY_1_TEMPLATE_THRESHOLD / CATEGORY_2_TEMPLATE_THRESHOLDで設定する（1より大きくすれば常にLLMを使う）。
+    """
+
+    @staticmethod
+    def category_1_template(who: str, what: str, candidates: List[Tuple[Any, float, float]]) -> Optional[Dict[str, Any]]:
+        """質問文に属性値そのものが含まれ（"Does Jon live in Osaka?" と Location: Osaka）、その属性が質問に関連していれば "Yes" と答える
+
+        candidatesはscore_template_candidatesの (属性, 属性自身の類似度, 質問の同義語カテゴリーとの関連度)。
+        属性自身の類似度と関連度がどちらもしきい値以上で、場所を聞く質問なら場所の種類も一致する属性だけを使う。
+        """
+        if not env.ANSWER_TEMPLATES_ENABLED or _NEGATION.search(what):
+            return None
+        for attribute, similarity, category_relevance in candidates:
+            if similarity < env.CATEGORY_1_TEMPLATE_THRESHOLD:
+                break
+            if category_relevance < env.CATEGORY_1_TEMPLATE_CATEGORY_THRESHOLD:
+                continue
+            if not _value_in_question(attribute.value, what) or not _answers_location_question(attribute.name, what):
+                continue
+            logger.debug(f"Answering category 1 from template: {attribute.name}={attribute.value} (similarity {similarity:.3f})")
+            return {
+                "status": "Yes",
+                "answer": attribute.value,
+                "approximation": {
+                    "attribute": attribute.name,
+                    "value": attribute.value
+                },
+                "explanation": f"The recorded {readable_attribute_name(attribute.name)} ({attribute.value}) matches the question.",
+                "relevant_info": f"{attribute.name}: {attribute.value}",
+                "final_answer": f"Yes. {describe_attribute(who, attribute.name, attribute.value)}",
+                "answer_source": ANSWER_SOURCE_TEMPLATE
+            }
+        return None
+
+    @staticmethod
+    def category_2_template(who: str, result: Dict[str, Any], similarity: Optional[float]) -> Optional[str]:
+        """resolve_category_2で見つかった属性の類似度（優先度ボーナスを含まない）がしきい値以上なら、その属性をそのまま文にする"""
+        if not env.ANSWER_TEMPLATES_ENABLED or similarity is None or similarity < env.CATEGORY_2_TEMPLATE_THRESHOLD:
+            return None
+        approximation = result.get("approximation")
+        if result.get("status") != "Found" or not isinstance(approximation, dict) or not approximation.get("value"):
+            return None
+        logger.debug(f"Answering category 2 from template: {approximation['attribute']}={approximation['value']} (similarity {similarity:.3f})")
+        return describe_attribute(who, approximation["attribute"], approximation["value"])
+
+    @staticmethod
+    def answer_source(result: Optional[Dict[str, Any]]) -> Optional[str]:
+        """結果に明示されていなければ、縮退したかどうかとfinal_answerの有無から判定する（回答が無ければNone）"""
+        if not result:
+            return None
+        if result.get("answer_source"):
+            return result["answer_source"]
+        if result.get("degraded"):
+            return ANSWER_SOURCE_DEGRADED
+        return ANSWER_SOURCE_LLM if result.get("final_answer") else None
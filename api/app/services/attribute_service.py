@@ -1,80 +1,175 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 import json
 import logging
 from models.friend import Attribute, FriendAttribute
+from schemas.conversation import ConversationInput
+from services.conversation_service import build_conversation_history
 from utils.text_processing import clean_attribute_name
 from utils.json_utils import flatten_json
-from utils.embedding import generate_embedding, cosine_similarity
+from utils.embedding import generate_embedding_async, cosine_similarity, attribute_embedding_text, embedding_key_for
+from utils.embedding_codec import encode_embedding
+from utils.vector_index import index_attribute
+from utils.attribute_registry import attribute_registry
+from utils.datetime_utils import utc_now
 from utils.attribute_keywords import UPDATE_KEYWORDS
 from utils.json_utils import flatten_json_with_prefix
 
 logger = logging.getLogger(__name__)
 
-async def process_attributes(db: Session, user_id: int, friend_id: int, attributes: dict):
+async def process_attributes(db: AsyncSession, user_id: int, friend_id: int, attributes: dict, conversation: Optional[ConversationInput] = None):
+    """抽出した属性をまとめて保存する（conversationを渡すと会話履歴も同じトランザクションで保存する）
+
+    属性名は通常プロセス内の対応で解決し、無い属性名の作成と友人属性のupsertはそれぞれ1文で行う。コミットは最後の1回だけ。
+    """
     flattened_attributes = flatten_json(attributes)
     processed_attributes = {}
-
     for key, value in flattened_attributes.items():
-        cleaned_key = clean_attribute_name(key)
-
-        # Attributeの検索または作成
-        attribute = await find_or_create_attribute(db, cleaned_key)
-
-        # Embeddingの生成
-        embedding = generate_embedding(f"{cleaned_key}: {value}")
-
-        # 既存のFriendAttributeを検索
-        existing_friend_attr = db.query(FriendAttribute).filter(
-            and_(
-                FriendAttribute.user_id == user_id,
-                FriendAttribute.friend_id == friend_id,
-                FriendAttribute.attribute_id == attribute.id
-            )
-        ).first()
-
-        if existing_friend_attr:
-            # 既存の属性値と新しい値が異なる場合のみ更新
-            if existing_friend_attr.value != str(value):
-                existing_friend_attr.value = str(value)
-                existing_friend_attr.embedding = json.dumps(embedding)
-                logger.debug(f"Updated attribute: {cleaned_key} for friend {friend_id}")
-            else:
-                logger.debug(f"Skipped duplicate attribute: {cleaned_key} for friend {friend_id}")
-        else:
-            # 新しい属性の場合は作成
-            new_friend_attr = FriendAttribute(
-                user_id=user_id,
-                friend_id=friend_id,
-                attribute_id=attribute.id,
-                value=str(value),
-                embedding=json.dumps(embedding)
-            )
-            db.add(new_friend_attr)
-            logger.debug(f"Added new attribute: {cleaned_key} for friend {friend_id}")
-
-        processed_attributes[cleaned_key] = value
-
-    db.commit()
+        processed_attributes[clean_attribute_name(key)] = value
+
+    values = {name: str(value) for name, value in processed_attributes.items()}
+    embedding_texts = [attribute_embedding_text(name, value) for name, value in values.items()]
+    embeddings = await generate_embedding_async(embedding_texts) if values else []
+
+    changed = await upsert_friend_attributes(db, user_id, friend_id, values, dict(zip(values, embeddings)))
+
+    if conversation is not None:
+        db.add(build_conversation_history(user_id, conversation))
+    await db.commit()
+
+    for attribute_id, name, value, embedding in changed:
+        index_attribute(user_id, friend_id, attribute_id, name, value, embedding)
+    logger.debug(f"Saved {len(values)} attributes for friend {friend_id} ({len(changed)} inserted or changed)")
+
     return processed_attributes
 
-async def find_or_create_attribute(db: Session, attribute_name: str):
-    attribute = db.query(Attribute).filter(Attribute.name == attribute_name).first()
-    if not attribute:
-        attribute = Attribute(name=attribute_name)
-        db.add(attribute)
-        db.flush()
-        db.refresh(attribute)
-    return attribute
+async def load_attribute_registry(db: AsyncSession) -> int:
+    """attributesを全件読み込み、プロセス内の属性名→idの対応を置き換える（起動時に呼ぶ）"""
+    rows = (await db.execute(select(Attribute.id, Attribute.name))).all()
+    attribute_registry.replace({row.name: row.id for row in rows})
+    logger.info(f"Loaded {len(rows)} attributes into the registry")
+    return len(rows)
+
+async def find_or_create_attribute(db: AsyncSession, name: str) -> int:
+    return (await resolve_attribute_ids(db, [name], create=True))[name]
+
+async def resolve_attribute_ids(db: AsyncSession, names: List[str], create: bool = False) -> Dict[str, int]:
+    """属性名→idを返す。プロセス内の対応に無い属性名だけをDBで引く
+
+    create=Trueなら、無い属性名を作成するINSERTと既存の属性の検索を1文で行う。
+    """
+    names = list(dict.fromkeys(names))
+    attribute_ids, missing = attribute_registry.lookup(names)
+    if not missing:
+        return attribute_ids
+
+    if create:
+        inserted = (
+            pg_insert(Attribute)
+            .values([{"name": name} for name in missing])
+            .on_conflict_do_nothing(index_elements=[Attribute.name])
+            .returning(Attribute.id, Attribute.name)
+            .cte("inserted")
+        )
+        statement = select(inserted.c.id, inserted.c.name).union_all(
+            select(Attribute.id, Attribute.name).where(Attribute.name.in_(missing))
+        )
+    else:
+        statement = select(Attribute.id, Attribute.name).where(Attribute.name.in_(missing))
+    resolved = {row.name: row.id for row in (await db.execute(statement)).all()}
+
+    # 別のトランザクションが同時に作成した属性は、上の文のスナップショットからは見えないので読み直す
+    unresolved = [name for name in missing if name not in resolved]
+    if create and unresolved:
+        rows = (await db.execute(select(Attribute.id, Attribute.name).where(Attribute.name.in_(unresolved)))).all()
+        resolved.update({row.name: row.id for row in rows})
+
+    attribute_registry.update(resolved)
+    attribute_ids.update(resolved)
+    return attribute_ids
+
+async def upsert_friend_attributes(
+    db: AsyncSession,
+    user_id: int,
+    friend_id: int,
+    values: Dict[str, str],
+    embeddings: Optional[Dict[str, list]] = None,
+    create_attributes: bool = True
+) -> List[Tuple[int, str, str, Optional[list]]]:
+    """友人属性を1文のINSERT ... ON CONFLICT DO UPDATEで保存し、追加・変更された (attribute_id, 属性名, 値, embedding) を返す
+
+    値が変わらない行は更新しない。embeddingsを渡さない場合、embeddingは書き込まず次の読み込み時に作り直す。
+    create_attributes=Falseなら、存在しない属性名は保存しない。コミットは呼び出し元で行う。
+    """
+    attribute_ids = await resolve_attribute_ids(db, list(values), create=create_attributes)
+    try:
+        # 失敗しても呼び出し元のトランザクション（会話履歴など）を残せるよう、SAVEPOINTの中で実行する
+        async with db.begin_nested():
+            return await _execute_friend_attribute_upsert(db, user_id, friend_id, attribute_ids, values, embeddings)
+    except IntegrityError as e:
+        # プロセス内の対応が古い（属性を作成した別のリクエストがロールバックされた等）と外部キー違反になる。
+        # 対応から捨ててDBで引き直し、1回だけやり直す
+        logger.warning(f"Attribute ids were stale, refreshing the registry: {str(e.orig)}")
+        attribute_registry.forget(values)
+        attribute_ids = await resolve_attribute_ids(db, list(values), create=create_attributes)
+        return await _execute_friend_attribute_upsert(db, user_id, friend_id, attribute_ids, values, embeddings)
+
+async def _execute_friend_attribute_upsert(
+    db: AsyncSession,
+    user_id: int,
+    friend_id: int,
+    attribute_ids: Dict[str, int],
+    values: Dict[str, str],
+    embeddings: Optional[Dict[str, list]]
+) -> List[Tuple[int, str, str, Optional[list]]]:
+    rows = {}
+    for name, value in values.items():
+        attribute_id = attribute_ids.get(name)
+        if attribute_id is None:
+            logger.warning(f"Attribute {name} not found in the database")
+            continue
+        row = {"user_id": user_id, "friend_id": friend_id, "attribute_id": attribute_id, "value": value}
+        if embeddings is not None:
+            row["embedding"] = None
+            row["embedding_vector"] = encode_embedding(embeddings[name])
+            row["embedding_key"] = embedding_key_for(attribute_embedding_text(name, value))
+        # 同じ文の中で同じ行を2回更新できないので、同じ属性は後の値で上書きする
+        rows[attribute_id] = (name, row)
+    if not rows:
+        return []
+
+    statement = pg_insert(FriendAttribute).values([row for _, row in rows.values()])
+    update_columns = {"value": statement.excluded.value, "updated_at": utc_now()}
+    if embeddings is not None:
+        update_columns.update({
+            "embedding": None,
+            "embedding_vector": statement.excluded.embedding_vector,
+            "embedding_key": statement.excluded.embedding_key,
+        })
+    statement = statement.on_conflict_do_update(
+        constraint="uq_friend_attributes_user_friend_attribute",
+        set_=update_columns,
+        where=FriendAttribute.value.is_distinct_from(statement.excluded.value)
+    ).returning(FriendAttribute.attribute_id)
+
+    changed_ids = (await db.execute(statement)).scalars().all()
+    changed = []
+    for attribute_id in changed_ids:
+        name, row = rows[attribute_id]
+        changed.append((attribute_id, name, row["value"], embeddings[name] if embeddings is not None else None))
+    return changed
 
-async def find_similar_attributes(db: Session, query: str, threshold: float = 0.7):
-    query_embedding = generate_embedding(query)
+async def find_similar_attributes(db: AsyncSession, query: str, threshold: float = 0.7):
+    query_embedding = await generate_embedding_async(query)
 
     similar_attributes = []
-    all_attributes = await db.query(Attribute).all()
+    all_attributes = (await db.execute(select(Attribute))).scalars().all()
 
     for attr in all_attributes:
-        attr_embedding = generate_embedding(attr.name)
+        attr_embedding = await generate_embedding_async(attr.name)
         similarity = cosine_similarity(query_embedding, attr_embedding)
         if similarity >= threshold:
             similar_attributes.append({
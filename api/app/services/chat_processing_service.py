@@ -1,25 +1,42 @@
+import asyncio
 import json
 import logging
 import re
-from typing import Tuple, Dict, Any, List, Optional
-from sqlalchemy.orm import Session
+import numpy as np
+from typing import Tuple, Dict, Any, List, Optional, AsyncIterator
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from models.friend import Attribute
 from models.friend import FriendAttribute
 from models.friend import Friend, FriendAttribute, Attribute
-from utils.chat_processing_utils import find_attribute, find_friend, get_friend_attribute, get_all_friend_attributes, get_all_friend_attributes, get_friends_by_attribute
-from utils.embedding import generate_embedding, cosine_similarity_single
-from utils.gemini_api import generate_gemini_response
+from utils.chat_processing_utils import find_friend_async, get_all_friend_attributes_async, get_user_vector_index_async
+from utils.embedding import generate_embedding_async, generate_embedding_matrix, run_in_embedding_executor, normalize_vectors, attribute_embedding_text
+from utils.attribute_scoring import AttributeMatrix, select_relevant_attributes, find_best_attribute, score_template_candidates, RELEVANCE_THRESHOLD, HIGH_CONFIDENCE_THRESHOLD
+from utils.synonym_index import get_synonym_index
+from utils.gemini_api import generate_gemini_response, generate_cached_gemini_text, stream_gemini_response
+from utils.resilience import UpstreamUnavailableError
+from utils.prompt_builder import build_friend_matches_context, build_attributes_context, merge_truncations
+from core.config import get_env
 from utils.text_processing import clean_json_response
-from utils.attribute_synonyms import ATTRIBUTE_SYNONYMS, LOCATION_PRIORITIES
+from utils.attribute_synonyms import LOCATION_PRIORITIES
+from services.answer_policy import AnswerPolicy, ANSWER_SOURCE_TEMPLATE
 
 logger = logging.getLogger(__name__)
 
+env = get_env()
+
+NO_INFORMATION_ANSWER = "I'm sorry, I don't have enough information to answer that question."
+
+# 処理の経路を示すためのキーで、回答生成のプロンプトには含めない
+_INTERNAL_RESULT_KEYS = ("similarity", "attribute_similarity", "answer_source", "degraded", "metadata")
+
 class ChatProcessingService:
     @staticmethod
     def format_attributes(attributes):
         return "\n".join([f"- {attr.name}: {attr.value}" for attr in attributes])
     @staticmethod
-    async def generate_final_answer(question: str, result: Dict[str, Any], category: int) -> str:
+    def build_final_answer_prompt(question: str, result: Dict[str, Any], category: int) -> Optional[str]:
+        result = {key: value for key, value in result.items() if key not in _INTERNAL_RESULT_KEYS}
         if category == 1:
             prompt = f"""
             Based on the following question and result, generate a factual answer:
@@ -79,14 +96,33 @@ class ChatProcessingService:
             The response should be purely factual and avoid any subjective interpretations or assumptions.
             """
         else:
-            return "I'm sorry, I don't have enough information to answer that question."
+            return None
+        return prompt
 
-        gemini_response = await generate_gemini_response(prompt)
-        return clean_json_response(gemini_response.text)
+    @staticmethod
+    async def generate_final_answer(question: str, result: Dict[str, Any], category: int, user_id: Optional[int] = None, use_cache: bool = True) -> str:
+        prompt = ChatProcessingService.build_final_answer_prompt(question, result, category)
+        if prompt is None:
+            return NO_INFORMATION_ANSWER
+
+        # 質問と結果が同じならプロンプトも同じになるので、応答をキャッシュから返せる
+        response_text = await generate_cached_gemini_text(prompt, "final_answer", user_id=user_id, use_cache=use_cache)
+        return clean_json_response(response_text)
+
+    @staticmethod
+    async def stream_final_answer(question: str, result: Dict[str, Any], category: int, user_id: Optional[int] = None) -> AsyncIterator[str]:
+        """generate_final_answerと同じプロンプトで、Geminiが生成したテキストを届いた順に返す"""
+        prompt = ChatProcessingService.build_final_answer_prompt(question, result, category)
+        if prompt is None:
+            yield NO_INFORMATION_ANSWER
+            return
+
+        async for chunk in stream_gemini_response(prompt, user_id=user_id):
+            yield chunk
 
     @staticmethod
     async def process_category_1(
-        db: Session,
+        db: AsyncSession,
         user_id: int,
         who: str,
         what: str,
@@ -94,40 +130,38 @@ class ChatProcessingService:
     ) -> Tuple[Dict[str, Any], str]:
         logger.debug(f"Processing category 1 for user_id: {user_id}, who: {who}, what: {what}, related_subject: {related_subject}")
 
-        friend = find_friend(db, who, user_id)
+        friend = await find_friend_async(db, who, user_id)
         logger.debug(f"Found friend: {friend.name if friend else 'None'} with id: {friend.id if friend else 'None'}")
         if not friend:
             logger.debug("Friend not found, returning 'No' with low confidence")
             return {"status": "No", "answer": None, "approximation": "Friend not found"}, "low"
 
-        all_attributes = get_all_friend_attributes(db, friend.id, user_id)
+        all_attributes = await get_all_friend_attributes_async(db, friend.id, user_id)
         logger.debug(f"Retrieved attributes: {[attr.name for attr in all_attributes]}")
         if not all_attributes:
             logger.debug(f"No attributes found for friend {friend.name}")
             return {"status": "No", "answer": None, "approximation": "No attributes found"}, "low"
 
-        what_embedding = generate_embedding(what)
-
-        # 関連する属性を特定
-        relevant_attributes = []
-        for attr_info in all_attributes:
-            attr_text = f"{attr_info.name} {attr_info.value}"
-            attr_similarity = cosine_similarity_single(what_embedding, generate_embedding(attr_text))
+        what_vector = normalize_vectors(await generate_embedding_async(what))
 
-            category_similarities = [cosine_similarity_single(what_embedding, generate_embedding(syn))
-                                    for synonyms in ATTRIBUTE_SYNONYMS.values()
-                                    for syn in synonyms]
-            category_similarity = max(category_similarities) if category_similarities else 0
+        # 同義語カテゴリーとの類似度は属性に依存しないので、質問ごとに1回だけ計算する
+        category_similarity = get_synonym_index().max_similarity(what_vector)
 
-            if attr_similarity > 0.5 or category_similarity > 0.5:
-                relevant_attributes.append((attr_info, max(attr_similarity, category_similarity)))
+        # 関連する属性を特定（類似度の降順）
+        attribute_matrix = await run_in_embedding_executor(AttributeMatrix.from_attributes, all_attributes)
+        relevant_attributes = select_relevant_attributes(attribute_matrix, what_vector, category_similarity)
 
         if not relevant_attributes:
             logger.debug("No relevant attributes found")
             return {"status": "No", "answer": None, "approximation": "No relevant attributes found"}, "low"
 
-        # 類似度でソートし、最も関連性の高い属性を選択
-        relevant_attributes.sort(key=lambda x: x[1], reverse=True)
+        # 質問に含まれる値がそのまま記録されていれば、Geminiに尤度を聞かずに答える
+        template_candidates = score_template_candidates(attribute_matrix, what_vector, get_synonym_index())
+        template_result = AnswerPolicy.category_1_template(who, what, template_candidates)
+        if template_result:
+            return template_result, "high"
+
+        # 最も関連性の高い属性を選択
         best_attribute_info, best_similarity = relevant_attributes[0]
 
         # 関連する属性の情報を集約
@@ -165,7 +199,21 @@ class ChatProcessingService:
         }}
         """
 
-        gemini_response = await generate_gemini_response(prompt)
+        try:
+            gemini_response = await generate_gemini_response(prompt, user_id=user_id)
+        except UpstreamUnavailableError as e:
+            # Geminiが使えない間は推論せず、最も関連する属性をそのまま返す
+            logger.warning(f"Gemini unavailable for category 1, returning the best matching attribute: {str(e)}")
+            return {
+                "status": "Unknown",
+                "answer": best_attribute_info.value,
+                "approximation": {
+                    "attribute": best_attribute_info.name,
+                    "value": best_attribute_info.value
+                },
+                "final_answer": ChatProcessingService.degraded_attribute_answer(who, best_attribute_info.name, best_attribute_info.value),
+                "degraded": True
+            }, "low"
         gemini_result = json.loads(clean_json_response(gemini_response.text))
 
         logger.debug(f"Gemini API response: {gemini_result}")
@@ -198,148 +246,211 @@ class ChatProcessingService:
 
     @staticmethod
     async def process_category_2(
-        db: Session,
+        db: AsyncSession,
         user_id: int,
         who: str,
         what: str,
         related_subject: Optional[str] = None,
-        content: str = ""
+        content: str = "",
+        use_cache: bool = True
     ) -> Tuple[Dict[str, Any], str]:
-        logger.debug(f"Processing category 2 for user_id: {user_id}, who: {who}, what: {what}, related_subject: {related_subject}")
+        result, confidence = await ChatProcessingService.resolve_category_2(db, user_id, who, what, related_subject)
+        if "final_answer" in result:
+            return result, confidence
+
+        # 類似度が十分高ければ、見つかった属性をそのまま文にしてGeminiの呼び出しを省く
+        template_answer = AnswerPolicy.category_2_template(who, result, result.get("attribute_similarity"))
+        if template_answer:
+            result["final_answer"] = template_answer
+            result["answer_source"] = ANSWER_SOURCE_TEMPLATE
+            return result, confidence
+
+        try:
+            final_answer = await ChatProcessingService.generate_final_answer(content, result, 2, user_id, use_cache)
+        except UpstreamUnavailableError as e:
+            logger.warning(f"Gemini unavailable for category 2, returning the best matching attribute: {str(e)}")
+            result["degraded"] = True
+            final_answer = ChatProcessingService.category_2_degraded_answer(who, result)
+        result["final_answer"] = final_answer or ChatProcessingService.category_2_fallback_answer(result)
 
-        friend = find_friend(db, who, user_id)
-        if not friend:
-            logger.debug("Friend not found, returning 'Not Found' with low confidence")
-            return {"status": "Not Found", "answer": None, "approximation": "Friend not found"}, "low"
+        logger.debug(f"Final result for category 2: {result}")
+        logger.debug(f"Confidence: {confidence}")
 
-        all_attributes = get_all_friend_attributes(db, friend.id, user_id)
-        if not all_attributes:
-            logger.debug(f"No attributes found for friend {friend.name}")
-            return {"status": "Not Found", "answer": None, "approximation": "No attributes found"}, "low"
+        return result, confidence
 
-        what_embedding = generate_embedding(what)
+    @staticmethod
+    def category_2_fallback_answer(result: Dict[str, Any]) -> str:
+        return f"I'm sorry, but I couldn't find any information about {result.get('who', 'the person')}'s {result.get('what', 'attribute')}."
 
-        # 関連する属性名を取得
-        related_attributes = []
-        for category, synonyms in ATTRIBUTE_SYNONYMS.items():
-            if any(synonym.lower() in what.lower() for synonym in synonyms):
-                related_attributes.extend(synonyms)
+    @staticmethod
+    def category_2_degraded_answer(who: str, result: Dict[str, Any]) -> str:
+        approximation = result.get("approximation")
+        if result.get("status") == "Found" and isinstance(approximation, dict):
+            return ChatProcessingService.degraded_attribute_answer(who, approximation["attribute"], approximation["value"])
+        return ChatProcessingService.category_2_fallback_answer(result)
 
-        # 位置情報の優先順位を設定
-        location_priority = LOCATION_PRIORITIES.get("live", [])
+    @staticmethod
+    def rank_profile_attributes(attributes: List) -> List:
+        """カテゴリー④用: 同義語カテゴリー（仕事・家族・住まいなど）との類似度が高い属性から順に並べる"""
+        vectors = [attr.embedding for attr in attributes]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            encoded = generate_embedding_matrix([attribute_embedding_text(attributes[i].name, attributes[i].value) for i in missing])
+            for i, vector in zip(missing, encoded):
+                vectors[i] = vector
+        scores = get_synonym_index().max_similarities(normalize_vectors(np.stack(vectors)))
+        return [attributes[i] for i in np.argsort(-scores, kind="stable")]
 
-        best_attribute = None
-        best_similarity = -1
+    @staticmethod
+    def degraded_attribute_answer(who: str, attribute_name: str, value: str) -> str:
+        return f"I can't generate a full answer right now, but here is the closest information I have about {who}: {attribute_name}: {value}."
 
-        for attr in all_attributes:
-            attr_name_lower = attr.name.lower()
+    @staticmethod
+    async def resolve_category_2(
+        db: AsyncSession,
+        user_id: int,
+        who: str,
+        what: str,
+        related_subject: Optional[str] = None
+    ) -> Tuple[Dict[str, Any], str]:
+        """カテゴリー②の属性検索まで（final_answerの生成は呼び出し元で行う）
 
-            # 優先度ボーナスを計算
-            priority_bonus = 0
-            if attr.name in location_priority:
-                priority_bonus = (len(location_priority) - location_priority.index(attr.name)) * 0.1
+        友人や属性が見つからない場合は、回答を生成しないことを示すためfinal_answer=Noneを含めて返す。
+        """
+        logger.debug(f"Processing category 2 for user_id: {user_id}, who: {who}, what: {what}, related_subject: {related_subject}")
 
-            # 属性名の類似度を計算
-            name_similarity = cosine_similarity_single(what_embedding, generate_embedding(attr.name))
+        friend = await find_friend_async(db, who, user_id)
+        if not friend:
+            logger.debug("Friend not found, returning 'Not Found' with low confidence")
+            return {"status": "Not Found", "answer": None, "approximation": "Friend not found", "final_answer": None}, "low"
 
-            # 属性値の類似度を計算
-            value_similarity = cosine_similarity_single(what_embedding, generate_embedding(attr.value))
+        all_attributes = await get_all_friend_attributes_async(db, friend.id, user_id)
+        if not all_attributes:
+            logger.debug(f"No attributes found for friend {friend.name}")
+            return {"status": "Not Found", "answer": None, "approximation": "No attributes found", "final_answer": None}, "low"
 
-            # 総合的な類似度を計算
-            total_similarity = max(name_similarity, value_similarity) + priority_bonus
+        what_vector = normalize_vectors(await generate_embedding_async(what))
 
-            logger.debug(f"Attribute: {attr.name}, Value: {attr.value}, Similarity: {total_similarity}")
+        # 位置情報の優先順位を設定
+        location_priority = LOCATION_PRIORITIES.get("live", [])
 
-            if total_similarity > best_similarity:
-                best_similarity = total_similarity
-                best_attribute = attr
+        # 属性名・属性値の類似度に優先度ボーナスを加えた総合的な類似度が最大の属性を選択
+        attribute_matrix = await run_in_embedding_executor(AttributeMatrix.from_attributes, all_attributes)
+        best_attribute, best_similarity, attribute_similarity = find_best_attribute(attribute_matrix, what_vector, location_priority)
 
-        logger.debug(f"Best matching attribute: {best_attribute.name if best_attribute else 'None'} with similarity {best_similarity}")
+        logger.debug(f"Best matching attribute: {best_attribute.name if best_attribute else 'None'} with similarity {best_similarity} (without priority bonus: {attribute_similarity})")
 
-        if best_similarity >= 0.5:
+        if best_similarity >= RELEVANCE_THRESHOLD:
             result = {
                 "status": "Found",
                 "answer": best_attribute.value,
-                "approximation": {"attribute": best_attribute.name, "value": best_attribute.value}
+                "approximation": {"attribute": best_attribute.name, "value": best_attribute.value},
+                "similarity": float(best_similarity),
+                # テンプレート回答の判定用（位置情報の優先度ボーナスを含まない）
+                "attribute_similarity": float(attribute_similarity)
             }
-            confidence = "high" if best_similarity >= 0.8 else "medium"
+            confidence = "high" if best_similarity >= HIGH_CONFIDENCE_THRESHOLD else "medium"
         else:
             result = {"status": "Not Found", "answer": None, "approximation": "No matching attribute found"}
             confidence = "low"
 
-        final_answer = await ChatProcessingService.generate_final_answer(content, result, 2)
-        if not final_answer:
-            final_answer = f"I'm sorry, but I couldn't find any information about {result.get('who', 'the person')}'s {result.get('what', 'attribute')}."
-        result["final_answer"] = final_answer
-
-        logger.debug(f"Final result for category 2: {result}")
-        logger.debug(f"Confidence: {confidence}")
-
         return result, confidence
 
     @staticmethod
-    async def process_category_3(db: Session, user_id: int, what: str, related_subject: Optional[str] = None) -> Tuple[Dict[str, Any], str]:
+    async def process_category_3(db: AsyncSession, user_id: int, what: str, related_subject: Optional[str] = None) -> Tuple[Dict[str, Any], str]:
         logger.debug(f"Processing category 3 for user_id: {user_id}, what: {what}, related_subject: {related_subject}")
 
-        all_friends = db.query(Friend).filter(Friend.user_id == user_id).all()
-        what_embedding = generate_embedding(what)
+        what_vector = normalize_vectors(await generate_embedding_async(what))
+
+        # 同義語カテゴリーとの類似度は友人・属性に依存しないので、質問ごとに1回だけ計算する
+        category_similarity = get_synonym_index().max_similarity(what_vector)
+
+        # ユーザーの全友人の属性を1回で検索し、友人ごとにまとめる（友人は最も類似度の高い属性の順）
+        grouped_attributes = (await get_user_vector_index_async(db, user_id)).search(what_vector, category_similarity)
+
+        friend_names = dict((await db.execute(
+            select(Friend.id, Friend.name)
+            .where(Friend.user_id == user_id, Friend.id.in_([friend_id for friend_id, _ in grouped_attributes]))
+        )).all()) if grouped_attributes else {}
 
         matching_friends = []
-        for friend in all_friends:
-            all_attributes = get_all_friend_attributes(db, friend.id, user_id)
-            if not all_attributes:
+        for friend_id, relevant_attributes in grouped_attributes:
+            if friend_id not in friend_names:
                 continue
 
-            # 関連する属性を特定
-            relevant_attributes = []
-            for attr_info in all_attributes:
-                attr_text = f"{attr_info.name} {attr_info.value}"
-                attr_similarity = cosine_similarity_single(what_embedding, generate_embedding(attr_text))
-
-                category_similarities = [cosine_similarity_single(what_embedding, generate_embedding(syn))
-                                        for synonyms in ATTRIBUTE_SYNONYMS.values()
-                                        for syn in synonyms]
-                category_similarity = max(category_similarities) if category_similarities else 0
-
-                if attr_similarity > 0.5 or category_similarity > 0.5:
-                    relevant_attributes.append((attr_info, max(attr_similarity, category_similarity)))
-
-            if relevant_attributes:
-                # 類似度でソートし、最も関連性の高い属性を選択
-                relevant_attributes.sort(key=lambda x: x[1], reverse=True)
-                best_attribute_info, best_similarity = relevant_attributes[0]
-
-                # 関連する属性の情報を集約
-                aggregated_info = {}
-                for attr_info, _ in relevant_attributes:
-                    keys = attr_info.name.split('_')
-                    current = aggregated_info
-                    for key in keys[:-1]:
-                        if key not in current:
-                            current[key] = {}
-                        current = current[key]
-                    current[keys[-1]] = attr_info.value
-
-                matching_friends.append({
-                    "name": friend.name,
-                    "best_attribute": best_attribute_info,
-                    "similarity": best_similarity,
-                    "aggregated_info": aggregated_info
-                })
+            # 最も関連性の高い属性を選択
+            best_attribute_info, best_similarity = relevant_attributes[0]
+
+            matching_friends.append({
+                "name": friend_names[friend_id],
+                "best_attribute": best_attribute_info,
+                "similarity": best_similarity,
+                "attributes": relevant_attributes
+            })
 
         if not matching_friends:
             logger.debug("No matching friends found")
             return {"status": "Not Found", "answer": None, "approximation": "No matching friends found"}, "low"
 
+        metadata: Dict[str, Any] = {}
+        try:
+            if len(matching_friends) > env.CATEGORY_3_MAX_FRIENDS:
+                # 候補が1回のプロンプトに収まらない場合は、分割して並行に順位付けする
+                gemini_result = await ChatProcessingService.rank_matching_friends_sharded(what, matching_friends, user_id, metadata)
+            else:
+                gemini_result = await ChatProcessingService.rank_matching_friends(what, matching_friends, user_id, metadata)
+        except UpstreamUnavailableError as e:
+            # Geminiが使えない間は、ベクトル検索で見つかった友人と最も関連する属性をそのまま返す
+            logger.warning(f"Gemini unavailable for category 3, returning vector search matches: {str(e)}")
+            answer = [{
+                "name": friend["name"],
+                "explanation": f"{friend['best_attribute'].name}: {friend['best_attribute'].value}",
+                "confidence": friend["similarity"]
+            } for friend in matching_friends]
+            return {
+                "status": "Found",
+                "answer": answer,
+                "final_answer": "Possible matches: " + ", ".join(f"{entry['name']} ({entry['explanation']})" for entry in answer) + ".",
+                "degraded": True,
+                "metadata": metadata or None
+            }, "high" if matching_friends[0]["similarity"] >= HIGH_CONFIDENCE_THRESHOLD else "low"
+
+        logger.debug(f"Gemini API response: {gemini_result}")
+
+        # 最終的な結果を構築
+        result = {
+            "status": "Found" if gemini_result["matching_friends"] else "Not Found",
+            "answer": gemini_result["matching_friends"],
+            "final_answer": gemini_result["final_answer"],
+            "metadata": metadata
+        }
+
+        # 信頼度の計算
+        confidence = "high" if any(float(friend["confidence"]) > 0.8 for friend in gemini_result["matching_friends"]) else \
+                    "medium" if any(float(friend["confidence"]) > 0.5 for friend in gemini_result["matching_friends"]) else \
+                    "low"
+
+        return result, confidence
+
+    @staticmethod
+    async def rank_matching_friends(what: str, matching_friends: List[Dict[str, Any]], user_id: int, metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """1回のGemini呼び出しで候補の友人を順位付けし、final_answerも生成する"""
+        # 類似度の高い友人・属性から、トークン予算に収まる分だけをプロンプトに入れる
+        friends_context, truncation = build_friend_matches_context(
+            matching_friends,
+            budget_tokens=env.PROMPT_CONTEXT_TOKEN_BUDGET,
+            max_friends=env.CATEGORY_3_MAX_FRIENDS,
+            max_attributes_per_friend=env.CATEGORY_3_MAX_ATTRIBUTES_PER_FRIEND
+        )
+        metadata["prompt"] = truncation.to_dict()
+        if truncation.truncated:
+            logger.info(f"Category 3 prompt truncated for user_id: {user_id}: {metadata['prompt']}")
+
         # Gemini APIを使用して推論
         prompt = f"""
         Question: Who {what}?
         Known information about matching friends:
-        {json.dumps([{
-            "name": friend["name"],
-            "best_matching_attribute": f"{friend['best_attribute'].name}: {friend['best_attribute'].value}",
-            "other_relevant_info": friend["aggregated_info"]
-        } for friend in matching_friends], indent=2)}
+        {friends_context}
 
         Based on this information, please provide:
         1. A list of friends who most likely match the criteria, sorted by relevance.
@@ -360,29 +471,110 @@ class ChatProcessingService:
         }}
         """
 
-        gemini_response = await generate_gemini_response(prompt)
-        gemini_result = json.loads(clean_json_response(gemini_response.text))
+        gemini_response = await generate_gemini_response(prompt, user_id=user_id)
+        return json.loads(clean_json_response(gemini_response.text))
 
-        logger.debug(f"Gemini API response: {gemini_result}")
+    @staticmethod
+    async def rank_matching_friends_sharded(what: str, matching_friends: List[Dict[str, Any]], user_id: int, metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """候補を分割して各シャードの順位付けを並行に行い、confidenceの順にマージする
 
-        # 最終的な結果を構築
-        result = {
-            "status": "Found" if gemini_result["matching_friends"] else "Not Found",
-            "answer": gemini_result["matching_friends"],
-            "final_answer": gemini_result["final_answer"]
+        1つの質問が上流の枠を占有しないよう、シャードの呼び出しにも他の呼び出しと同じくユーザーごとの同時実行数の上限を適用する。
+        上限を超えるシャードは呼び出し前に待たせ、待ち時間がリトライを含めた期限（GEMINI_DEADLINE_SECONDS）に含まれないようにする。
+        final_answerはテンプレートで作る。
+        """
+        candidates = matching_friends[:env.CATEGORY_3_MAX_CANDIDATES]
+        shard_size = env.CATEGORY_3_MAX_FRIENDS
+        shards = [candidates[i:i + shard_size] for i in range(0, len(candidates), shard_size)]
+        semaphore = asyncio.Semaphore(min(env.CATEGORY_3_SHARD_CONCURRENCY, env.GEMINI_PER_USER_CONCURRENCY))
+
+        async def rank_shard(shard: List[Dict[str, Any]]):
+            friends_context, truncation = build_friend_matches_context(
+                shard,
+                budget_tokens=env.PROMPT_CONTEXT_TOKEN_BUDGET,
+                max_friends=shard_size,
+                max_attributes_per_friend=env.CATEGORY_3_MAX_ATTRIBUTES_PER_FRIEND
+            )
+            prompt = f"""
+            Question: Who {what}?
+            Known information about candidate friends:
+            {friends_context}
+
+            Based on this information, list the friends who match the criteria, explaining why with specific details
+            from their information, with a confidence score (0-1 scale) for each. Leave out friends who do not match.
+
+            Return a JSON object with the following format:
+            {{
+                "matching_friends": [
+                    {{
+                        "name": "Friend's name",
+                        "explanation": "Explanation of why this friend matches",
+                        "confidence": "A value between 0 and 1"
+                    }}
+                ]
+            }}
+            """
+            async with semaphore:
+                gemini_response = await generate_gemini_response(prompt, user_id=user_id)
+            return json.loads(clean_json_response(gemini_response.text)).get("matching_friends", []), truncation
+
+        results = await asyncio.gather(*[rank_shard(shard) for shard in shards], return_exceptions=True)
+
+        merged: Dict[str, Dict[str, Any]] = {}
+        truncations = []
+        errors = []
+        for result in results:
+            if isinstance(result, BaseException):
+                errors.append(result)
+                continue
+            shard_matches, truncation = result
+            truncations.append(truncation)
+            for friend in shard_matches:
+                friend["confidence"] = ChatProcessingService._parse_confidence(friend.get("confidence"))
+                current = merged.get(friend.get("name"))
+                if current is None or friend["confidence"] > current["confidence"]:
+                    merged[friend.get("name")] = friend
+
+        for error in errors:
+            logger.warning(f"Category 3 shard ranking failed: {type(error).__name__}: {str(error)}")
+        if len(errors) == len(shards):
+            if any(isinstance(error, UpstreamUnavailableError) for error in errors):
+                raise UpstreamUnavailableError(f"All {len(shards)} category 3 shards failed")
+            raise errors[0]
+
+        metadata["prompt"] = merge_truncations(truncations, {
+            "friends": len(matching_friends),
+            "attributes": sum(len(friend["attributes"]) for friend in matching_friends),
+        }).to_dict()
+        metadata["shards"] = {"count": len(shards), "failed": len(errors), "size": shard_size}
+
+        ranked = sorted(merged.values(), key=lambda friend: friend["confidence"], reverse=True)
+        return {
+            "matching_friends": ranked,
+            "final_answer": ChatProcessingService.category_3_template_answer(what, ranked)
         }
 
-        # 信頼度の計算
-        confidence = "high" if any(float(friend["confidence"]) > 0.8 for friend in gemini_result["matching_friends"]) else \
-                    "medium" if any(float(friend["confidence"]) > 0.5 for friend in gemini_result["matching_friends"]) else \
-                    "low"
+    @staticmethod
+    def _parse_confidence(value) -> float:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0.0
 
-        return result, confidence
+    @staticmethod
+    def category_3_template_answer(what: str, matching_friends: List[Dict[str, Any]], limit: int = 5) -> str:
+        if not matching_friends:
+            return f"I couldn't find anyone who {what}."
+        names = [friend["name"] for friend in matching_friends[:limit]]
+        listed = names[0] if len(names) == 1 else ", ".join(names[:-1]) + f" and {names[-1]}"
+        remaining = len(matching_friends) - len(names)
+        if remaining > 0:
+            listed += f" (and {remaining} more)"
+        return f"The friends who best match \"{what}\" are {listed}." if len(matching_friends) > 1 else f"{listed} matches \"{what}\"."
 
     @staticmethod
-    async def process_category_4(db: Session, user_id: int, who: str) -> Tuple[Dict[str, Any], str]:
+    async def process_category_4(db: AsyncSession, user_id: int, who: str) -> Tuple[Dict[str, Any], str]:
         logger.debug(f"Processing category 4 for user_id: {user_id}, who: {who}")
-        friend = find_friend(db, who, user_id)
+        friend = await find_friend_async(db, who, user_id)
         if not friend:
             logger.debug(f"Friend {who} not found")
             return {
@@ -394,7 +586,7 @@ class ChatProcessingService:
                 "final_answer": f"No information available for {who}."
             }, "low"
 
-        all_attributes = get_all_friend_attributes(db, friend.id, user_id)
+        all_attributes = await get_all_friend_attributes_async(db, friend.id, user_id)
         if not all_attributes:
             logger.debug(f"No attributes found for friend {who}")
             return {
@@ -406,24 +598,24 @@ class ChatProcessingService:
                 "final_answer": f"No detailed information available for {who}."
             }, "low"
 
-        # 属性を整理
-        aggregated_info = {}
-        for attr in all_attributes:
-            keys = attr.name.split('_')
-            current = aggregated_info
-            for key in keys[:-1]:
-                if key not in current:
-                    current[key] = {}
-                current = current[key]
-            current[keys[-1]] = attr.value
+        # 人物像の要素（仕事・家族・住まいなど）に近い属性から、トークン予算に収まる分だけをプロンプトに入れる
+        ranked_attributes = await run_in_embedding_executor(ChatProcessingService.rank_profile_attributes, all_attributes)
+        attributes_context, prompt_attributes, truncation = build_attributes_context(
+            ranked_attributes,
+            budget_tokens=env.PROMPT_CONTEXT_TOKEN_BUDGET,
+            max_attributes=env.CATEGORY_4_MAX_ATTRIBUTES
+        )
+        metadata = {"prompt": truncation.to_dict()}
+        if truncation.truncated:
+            logger.info(f"Category 4 prompt truncated for user_id: {user_id}: {metadata['prompt']}")
 
-        logger.debug(f"aggregated_info: {aggregated_info}")
+        logger.debug(f"attributes_context: {attributes_context}")
 
         # Gemini APIを使用して要約と説明を生成
         prompt = f"""
         Please provide a factual summary about {who} based on the following information:
 
-        {json.dumps(aggregated_info, indent=2)}
+        {attributes_context}
 
         In your response:
         1. List only the factual information available about {who}.
@@ -441,7 +633,22 @@ class ChatProcessingService:
         }}
         """
 
-        gemini_response = await generate_gemini_response(prompt)
+        try:
+            gemini_response = await generate_gemini_response(prompt, user_id=user_id)
+        except UpstreamUnavailableError as e:
+            # Geminiが使えない間は、保存されている属性をそのまま列挙する
+            logger.warning(f"Gemini unavailable for category 4, listing stored attributes: {str(e)}")
+            facts = [f"{attr.name}: {attr.value}" for attr in prompt_attributes]
+            return {
+                "status": "Found",
+                "answer": "; ".join(facts),
+                "summary": "\n".join(f"- {fact}" for fact in facts),
+                "missing_info": None,
+                "approximation": None,
+                "final_answer": f"Here is what I have about {who}: " + "; ".join(facts) + ".",
+                "degraded": True,
+                "metadata": metadata
+            }, "medium"
         logger.debug(f"Raw Gemini API response: {gemini_response.text}")
 
         cleaned_response = clean_json_response(gemini_response.text)
@@ -471,7 +678,8 @@ class ChatProcessingService:
                 "summary": gemini_result.get("summary", "No summary available."),
                 "missing_info": gemini_result.get("missing_info", "No information about missing data."),
                 "approximation": None,
-                "final_answer": gemini_result["final_answer"]
+                "final_answer": gemini_result["final_answer"],
+                "metadata": metadata
             }
         else:
             # final_answerが抽出できなかった場合のフォールバック
@@ -481,7 +689,8 @@ class ChatProcessingService:
                 "summary": f"Error processing information for {who}.",
                 "missing_info": "Unable to retrieve information due to a processing error.",
                 "approximation": None,
-                "final_answer": f"I'm sorry, but I encountered an error while retrieving information about {who}."
+                "final_answer": f"I'm sorry, but I encountered an error while retrieving information about {who}.",
+                "metadata": metadata
             }
 
         logger.debug(f"process_category_4 result: {result}")
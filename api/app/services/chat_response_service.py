@@ -1,5 +1,6 @@
+import json
 import logging
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from models.chat_history import ChatResponse
 
 logger = logging.getLogger(__name__)
@@ -7,7 +8,7 @@ logger.setLevel(logging.DEBUG)
 
 class ChatResponseService:
     @staticmethod
-    async def save_chat_response(db: Session, request_id: int, response_data: dict):
+    async def save_chat_response(db: AsyncSession, request_id: int, response_data: dict):
         logger.debug(f"Received response_data in save_chat_response: {response_data}")
         try:
             # answerフィールドの処理
@@ -41,8 +42,8 @@ class ChatResponseService:
                 final_answer=response_data['response'].get('final_answer')
             )
             db.add(chat_response)
-            db.commit()
-            db.refresh(chat_response)
+            await db.commit()
+            await db.refresh(chat_response)
             return chat_response
         except Exception as e:
             logger.error(f"Error in save_chat_response: {str(e)}", exc_info=True)
@@ -1,29 +1,79 @@
 import json
 import logging
 from typing import Dict, Any, Optional, List
-from sqlalchemy.orm import Session
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from schemas.chat import InitialChatResponse
-from utils.gemini_api import generate_gemini_response
+from utils.gemini_api import generate_cached_gemini_text
 from utils.text_processing import clean_json_response
 from models.chat_history import ChatRequest, ChatResponse
-from schemas.chat import ChatRequestSummary, ChatResponseSummary
+from schemas.chat import ChatRequestSummary, ChatResponseSummary, ChatHistoryPage
+from services.question_classifier import question_classifier
+from utils.resilience import UpstreamUnavailableError
+from utils.pagination import encode_cursor, decode_cursor
+from core.config import get_env
 
 logger = logging.getLogger(__name__)
 
+env = get_env()
+
+def _is_json_response(text: str) -> bool:
+    try:
+        json.loads(clean_json_response(text))
+        return True
+    except json.JSONDecodeError:
+        return False
+
 class ChatService:
     @staticmethod
-    async def process_chat(user_id: int, content: str, db) -> InitialChatResponse:
-        analysis = await ChatService.analyze_question(content)
+    async def process_chat(user_id: int, content: str, db: Optional[AsyncSession], use_cache: bool = True) -> InitialChatResponse:
+        local = None
+        if env.QUESTION_CLASSIFIER_ENABLED and db is not None:
+            try:
+                local = await question_classifier.classify(db, user_id, content)
+            except Exception as e:
+                logger.warning(f"Local question classification failed, falling back to Gemini: {str(e)}")
+
+        if local is not None and local.confident:
+            # 確信度の高い質問はGeminiでの分析を省略する
+            question_classifier.record_fast_path(
+                local,
+                lambda: ChatService.analyze_question(content, user_id),
+                ChatService.get_category_number
+            )
+            return InitialChatResponse(
+                who=local.who or "unknown",
+                what=local.what,
+                related_subject=None,
+                question_category=local.category
+            )
+
+        try:
+            analysis = await ChatService.analyze_question(content, user_id, use_cache)
+        except UpstreamUnavailableError as e:
+            if local is None or local.category not in (1, 2, 3, 4):
+                raise
+            # Geminiが使えない間は、確信度が低くてもローカルの分類結果で続ける
+            logger.warning(f"Gemini unavailable for question analysis, using local classification (category {local.category}): {str(e)}")
+            return InitialChatResponse(
+                who=local.who or "unknown",
+                what=local.what or local.masked_question,
+                related_subject=None,
+                question_category=local.category
+            )
+        question_category = ChatService.get_category_number(analysis.get("category"))
+        if env.QUESTION_CLASSIFIER_ENABLED:
+            question_classifier.record_fallback(local, question_category)
 
         return InitialChatResponse(
             who=analysis.get("primary_subject"),
             what=analysis.get("attribute"),
             related_subject=analysis.get("related_subject"),
-            question_category=ChatService.get_category_number(analysis.get("category"))
+            question_category=question_category
         )
 
     @staticmethod
-    async def analyze_question(question: str) -> Dict[str, Any]:
+    async def analyze_question(question: str, user_id: Optional[int] = None, use_cache: bool = True) -> Dict[str, Any]:
         prompt = f"""
         Analyze the following question in English: {question}
 
@@ -80,8 +130,10 @@ class ChatService:
         Note: Return only the JSON object without any additional explanation.
         """
 
-        response = await generate_gemini_response(prompt)
-        cleaned_response = clean_json_response(response.text)
+        response_text = await generate_cached_gemini_text(
+            prompt, "analyze_question", user_id=user_id, use_cache=use_cache, validate=_is_json_response
+        )
+        cleaned_response = clean_json_response(response_text)
 
         try:
             return json.loads(cleaned_response)
@@ -103,33 +155,49 @@ class ChatService:
             return 0  # Unknown category
 
     @staticmethod
-    def get_user_chats_service(db: Session, user_id: int) -> List[ChatRequestSummary]:
-        logger.debug(f"Fetching chat requests for user_id: {user_id}")
-
-        chat_requests = db.query(ChatRequest).filter(ChatRequest.user_id == user_id).all()
-        chat_requests_summaries = []
-
-        for chat_request in chat_requests:
-            logger.debug(f"Processing chat_request_id: {chat_request.id}")
-
-            response = db.query(ChatResponse).filter(ChatResponse.request_id == chat_request.id).first()
-
-            if response:
-                logger.debug(f"Found response for chat_request_id: {chat_request.id}")
-                response_summary = ChatResponseSummary(
-                    final_answer=response.final_answer,
-                    created_at=response.created_at
-                )
-            else:
-                logger.debug(f"No response found for chat_request_id: {chat_request.id}")
-                response_summary = None
-
-            chat_request_summary = ChatRequestSummary(
-                content=chat_request.content,
-                created_at=chat_request.created_at,
-                response=response_summary
-            )
+    async def get_user_chats_service(db: AsyncSession, user_id: int, limit: int = 50, cursor: Optional[str] = None) -> ChatHistoryPage:
+        """チャット履歴を新しい順にlimit件ずつ返す（各ページ内は古い順）
 
-            chat_requests_summaries.append(chat_request_summary)
+        リクエストとレスポンスを1回のJOINで読み込み、(created_at, id) のキーセットで前のページを辿る。
+        next_cursorを次のリクエストのcursorに渡すと、それより古い履歴が返る。
+        """
+        logger.debug(f"Fetching chat requests for user_id: {user_id}, limit: {limit}, cursor: {cursor}")
+
+        query = (
+            select(
+                ChatRequest.id,
+                ChatRequest.content,
+                ChatRequest.created_at,
+                ChatResponse.id.label("response_id"),
+                ChatResponse.final_answer,
+                ChatResponse.created_at.label("response_created_at")
+            )
+            .outerjoin(ChatResponse, ChatResponse.request_id == ChatRequest.id)
+            .where(ChatRequest.user_id == user_id)
+        )
+        if cursor:
+            created_at, request_id = decode_cursor(cursor)
+            query = query.where(tuple_(ChatRequest.created_at, ChatRequest.id) < tuple_(created_at, request_id))
+
+        # 1件多く読んで、さらに古い履歴があるかどうかを判定する
+        rows = (await db.execute(
+            query.order_by(ChatRequest.created_at.desc(), ChatRequest.id.desc()).limit(limit + 1)
+        )).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        items = [
+            ChatRequestSummary(
+                content=row.content,
+                created_at=row.created_at,
+                response=ChatResponseSummary(
+                    final_answer=row.final_answer,
+                    created_at=row.response_created_at
+                ) if row.response_id is not None else None
+            )
+            for row in reversed(rows)
+        ]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id) if has_more else None
 
-        return chat_requests_summaries
+        logger.debug(f"Fetched {len(items)} chat requests for user_id: {user_id} (more: {has_more})")
+        return ChatHistoryPage(items=items, next_cursor=next_cursor)
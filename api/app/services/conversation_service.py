@@ -1,17 +1,19 @@
 import json
 import logging
 from datetime import datetime, timezone
-from sqlalchemy.orm import Session
+from typing import Optional
+from sqlalchemy.ext.asyncio import AsyncSession
 from schemas.conversation import ConversationInput
 from models.conversation_history import ConversationHistory
 from utils.text_processing import clean_json_response
+from utils.datetime_utils import to_naive_utc
 from utils.gemini_api import generate_gemini_response
 from utils.attribute_keywords import UPDATE_KEYWORDS
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-async def extract_attributes_service(conversation: ConversationInput):
+async def extract_attributes_service(conversation: ConversationInput, user_id: Optional[int] = None):
     try:
         prompt = f"""
         Analyze the following text and extract all relevant information about the person mentioned.
@@ -30,7 +32,7 @@ async def extract_attributes_service(conversation: ConversationInput):
 
         Your response should be only the JSON object, with no additional explanation or text.
         """
-        response = await generate_gemini_response(prompt)
+        response = await generate_gemini_response(prompt, user_id=user_id)
 
         cleaned_response = clean_json_response(response.text)
 
@@ -45,14 +47,18 @@ async def extract_attributes_service(conversation: ConversationInput):
         logger.exception(f"Error in extract_attributes_service: {str(e)}")
         return {"error": str(e), "raw_response": response.text if 'response' in locals() else None}
 
-async def save_conversation_history(db: Session, user_id: int, conversation: ConversationInput):
-    new_history = ConversationHistory(
+def build_conversation_history(user_id: int, conversation: ConversationInput) -> ConversationHistory:
+    return ConversationHistory(
         user_id=user_id,
         friend_id=conversation.friend_id,
-        conversation_date=conversation.conversation_date,
+        # クライアントはタイムゾーン付きの日時を送ってくることがある（列はtimestamp without time zone）
+        conversation_date=to_naive_utc(conversation.conversation_date),
         context=conversation.context
     )
+
+async def save_conversation_history(db: AsyncSession, user_id: int, conversation: ConversationInput):
+    new_history = build_conversation_history(user_id, conversation)
     db.add(new_history)
-    db.commit()
-    db.refresh(new_history)
+    await db.commit()
+    await db.refresh(new_history)
     return new_history
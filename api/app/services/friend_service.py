@@ -2,64 +2,52 @@ import numpy as np
 from typing import List
 from fastapi import HTTPException
 from sklearn.metrics.pairwise import cosine_similarity
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from utils.embedding import generate_embedding
 from models.friend import Friend, FriendAttribute, Attribute
 from models.conversation_history import ConversationHistory
+from services.attribute_service import upsert_friend_attributes
 from schemas.friend import FriendAttributeUpdate, FriendCreate, FriendUpdate, FriendDetailResponse, FriendAttributeResponse, ConversationHistoryItem, UpdateFriendDetailsResponse
 
 import logging
 import json
-from utils.embedding import generate_embedding, cosine_similarity
+from utils.embedding import generate_embedding_async, cosine_similarity, attribute_embedding_text
+from utils.vector_index import vector_index_registry, index_attribute, unindex_friend
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-async def save_friend_attributes(db: Session, user_id: int, friend_id: int, processed_attributes: dict):
+async def save_friend_attributes(db: AsyncSession, user_id: int, friend_id: int, processed_attributes: dict):
     try:
-        for key, value in processed_attributes.items():
-            try:
-                attribute = db.query(Attribute).filter(Attribute.name == key).first()
-                if not attribute:
-                    logger.warning(f"Attribute {key} not found in the database")
-                    continue
-
-                friend_attr = db.query(FriendAttribute).filter(
-                    FriendAttribute.user_id == user_id,
-                    FriendAttribute.friend_id == friend_id,
-                    FriendAttribute.attribute_id == attribute.id
-                ).first()
-
-                if friend_attr:
-                    friend_attr.value = value
-                else:
-                    friend_attr = FriendAttribute(user_id=user_id, friend_id=friend_id, attribute_id=attribute.id, value=value)
-                    db.add(friend_attr)
-            except Exception as e:
-                logger.exception(f"Error processing attribute {key}: {str(e)}")
-
-        db.commit()
+        # 既存の属性だけを使い（属性名はプロセス内の対応で解決する）、友人属性を1文でupsertする
+        values = {key: str(value) for key, value in processed_attributes.items()}
+        await upsert_friend_attributes(db, user_id, friend_id, values, create_attributes=False)
+
+        await db.commit()
+        # embeddingを更新していないので、常駐しているベクトルインデックスは次の検索時に作り直す
+        vector_index_registry.invalidate(user_id)
         return {"message": "Friend attributes saved successfully"}
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.exception(f"Error saving friend attributes: {str(e)}")
         raise
 
-async def get_all_attributes(db: Session):
-    return db.query(Attribute).all()
+async def get_all_attributes(db: AsyncSession):
+    return (await db.execute(select(Attribute))).scalars().all()
 
-async def find_similar_attributes(db: Session, query: str, threshold: float = 0.7) -> List[dict]:
+async def find_similar_attributes(db: AsyncSession, query: str, threshold: float = 0.7) -> List[dict]:
     logger.debug(f"Searching for attributes similar to: {query}")
-    query_embedding = generate_embedding(query)
+    query_embedding = await generate_embedding_async(query)
     logger.debug(f"Query embedding: {query_embedding[:5]}...")  # 最初の5要素のみ表示
 
     similar_attributes = []
-    all_attributes = db.query(Attribute).all()
+    all_attributes = (await db.execute(select(Attribute))).scalars().all()
     logger.debug(f"Total attributes in database: {len(all_attributes)}")
 
     # 全ての属性名のembeddingを一度に生成し、2D配列に変換
     attribute_names = [attr.name for attr in all_attributes]
-    attribute_embeddings = np.array([generate_embedding(name) for name in attribute_names])
+    attribute_embeddings = np.array(await generate_embedding_async(attribute_names))
 
     # query_embeddingを2D配列に変換
     query_embedding_2d = np.array(query_embedding).reshape(1, -1)
@@ -79,12 +67,12 @@ async def find_similar_attributes(db: Session, query: str, threshold: float = 0.
     logger.debug(f"Found {len(similar_attributes)} similar attributes")
     return similar_attributes
 
-def create_friend(db: Session, friend: FriendCreate, user_id: int):
+async def create_friend(db: AsyncSession, friend: FriendCreate, user_id: int):
     # 同じユーザーIDで同じ名前のフレンドが既に存在するかチェック
-    existing_friend = db.query(Friend).filter(
+    existing_friend = (await db.execute(select(Friend).where(
         Friend.user_id == user_id,
         Friend.name == friend.name
-    ).first()
+    ))).scalars().first()
 
     if existing_friend:
         raise HTTPException(status_code=400, detail="A friend with this name already exists for this user")
@@ -92,49 +80,53 @@ def create_friend(db: Session, friend: FriendCreate, user_id: int):
     # 新しいフレンドを作成
     db_friend = Friend(name=friend.name, user_id=user_id)
     db.add(db_friend)
-    db.commit()
-    db.refresh(db_friend)
+    await db.commit()
+    await db.refresh(db_friend)
     return db_friend
 
-def get_friend(db: Session, friend_id: int):
-    return db.query(Friend).filter(Friend.id == friend_id).first()
+async def get_friend(db: AsyncSession, friend_id: int):
+    return await db.get(Friend, friend_id)
 
-def get_friends(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(Friend).offset(skip).limit(limit).all()
+async def get_friends(db: AsyncSession, skip: int = 0, limit: int = 100):
+    return (await db.execute(select(Friend).offset(skip).limit(limit))).scalars().all()
 
-def get_friends_by_user_id(db: Session, user_id: int, skip: int = 0, limit: int = 500):
-    return db.query(Friend).filter(Friend.user_id == user_id).offset(skip).limit(limit).all()
+async def get_friends_by_user_id(db: AsyncSession, user_id: int, skip: int = 0, limit: int = 500):
+    return (await db.execute(select(Friend).where(Friend.user_id == user_id).offset(skip).limit(limit))).scalars().all()
 
-def update_friend(db: Session, friend_id: int, friend: FriendUpdate):
-    db_friend = db.query(Friend).filter(Friend.id == friend_id).first()
+async def update_friend(db: AsyncSession, friend_id: int, friend: FriendUpdate):
+    db_friend = await db.get(Friend, friend_id)
     if db_friend:
         for key, value in friend.dict().items():
             setattr(db_friend, key, value)
-        db.commit()
-        db.refresh(db_friend)
+        await db.commit()
+        await db.refresh(db_friend)
     return db_friend
 
-def delete_friend(db: Session, friend_id: int):
-    db_friend = db.query(Friend).filter(Friend.id == friend_id).first()
+async def delete_friend(db: AsyncSession, friend_id: int):
+    db_friend = await db.get(Friend, friend_id)
     if db_friend:
-        db.delete(db_friend)
-        db.commit()
+        user_id = db_friend.user_id
+        await db.delete(db_friend)
+        await db.commit()
+        unindex_friend(user_id, friend_id)
     return db_friend
 
-def get_friend_details_with_history(db: Session, user_id: int, friend_id: int) -> FriendDetailResponse:
-    friend = db.query(Friend).filter(Friend.id == friend_id, Friend.user_id == user_id).first()
+async def get_friend_details_with_history(db: AsyncSession, user_id: int, friend_id: int) -> FriendDetailResponse:
+    friend = (await db.execute(select(Friend).where(Friend.id == friend_id, Friend.user_id == user_id))).scalars().first()
     if not friend:
         raise HTTPException(status_code=404, detail="Friend not found")
 
-    attributes = db.query(Attribute.name, FriendAttribute.value)\
-        .join(FriendAttribute, Attribute.id == FriendAttribute.attribute_id)\
-        .filter(FriendAttribute.friend_id == friend_id, FriendAttribute.user_id == user_id)\
-        .all()
+    attributes = (await db.execute(
+        select(Attribute.name, FriendAttribute.value)
+        .join(FriendAttribute, Attribute.id == FriendAttribute.attribute_id)
+        .where(FriendAttribute.friend_id == friend_id, FriendAttribute.user_id == user_id)
+    )).all()
 
-    conversations = db.query(ConversationHistory.context, ConversationHistory.conversation_date)\
-        .filter(ConversationHistory.user_id == user_id, ConversationHistory.friend_id == friend_id)\
-        .order_by(ConversationHistory.conversation_date.desc())\
-        .all()
+    conversations = (await db.execute(
+        select(ConversationHistory.context, ConversationHistory.conversation_date)
+        .where(ConversationHistory.user_id == user_id, ConversationHistory.friend_id == friend_id)
+        .order_by(ConversationHistory.conversation_date.desc())
+    )).all()
 
     return FriendDetailResponse(
         friend_name=friend.name,
@@ -148,52 +140,37 @@ def get_friend_details_with_history(db: Session, user_id: int, friend_id: int) -
         ]
     )
 
-def update_friend_details(db: Session, user_id: int, friend_id: int, attributes: list[FriendAttributeUpdate]) -> UpdateFriendDetailsResponse:
+async def update_friend_details(db: AsyncSession, user_id: int, friend_id: int, attributes: list[FriendAttributeUpdate]) -> UpdateFriendDetailsResponse:
     logger.info(f"Updating friend details for user_id: {user_id}, friend_id: {friend_id}")
 
-    friend = db.query(Friend).filter(Friend.id == friend_id, Friend.user_id == user_id).first()
+    friend = (await db.execute(select(Friend).where(Friend.id == friend_id, Friend.user_id == user_id))).scalars().first()
     if not friend:
         logger.error(f"Friend not found for user_id: {user_id}, friend_id: {friend_id}")
         raise HTTPException(status_code=404, detail="Friend not found")
 
-    updated_attributes = []
-    for attr in attributes:
-        logger.debug(f"Processing attribute: {attr.attribute_name}")
-        attribute = db.query(Attribute).filter(Attribute.name == attr.attribute_name).first()
-        if not attribute:
-            logger.debug(f"Creating new attribute: {attr.attribute_name}")
-            attribute = Attribute(name=attr.attribute_name)
-            db.add(attribute)
-            db.flush()
-
-        friend_attr = db.query(FriendAttribute).filter(
-            FriendAttribute.friend_id == friend_id,
-            FriendAttribute.attribute_id == attribute.id
-        ).first()
-
-        if friend_attr:
-            logger.debug(f"Updating existing attribute: {attr.attribute_name}")
-            friend_attr.value = attr.value
-        else:
-            logger.debug(f"Adding new attribute to friend: {attr.attribute_name}")
-            friend_attr = FriendAttribute(
-                user_id=user_id,
-                friend_id=friend_id,
-                attribute_id=attribute.id,
-                value=attr.value
-            )
-            db.add(friend_attr)
-
-        updated_attributes.append({"attribute_name": attr.attribute_name, "value": attr.value})
+    # 更新する属性のembeddingをまとめて計算しておく
+    embeddings = await generate_embedding_async([attribute_embedding_text(attr.attribute_name, attr.value) for attr in attributes]) if attributes else []
+
+    # 無い属性名の作成と友人属性の保存をそれぞれ1文で行う（同じ属性が複数あれば後の値を使う）
+    values = {attr.attribute_name: attr.value for attr in attributes}
+    changed = await upsert_friend_attributes(
+        db, user_id, friend_id, values,
+        {attr.attribute_name: embedding for attr, embedding in zip(attributes, embeddings)}
+    )
+    logger.debug(f"Upserted {len(values)} attributes ({len(changed)} inserted or changed)")
+    updated_attributes = [{"attribute_name": attr.attribute_name, "value": attr.value} for attr in attributes]
 
     try:
-        db.commit()
+        await db.commit()
         logger.info("Successfully committed changes to database")
     except Exception as e:
         logger.error(f"Error committing to database: {str(e)}")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Database error occurred")
 
+    for attribute_id, name, value, embedding in changed:
+        index_attribute(user_id, friend_id, attribute_id, name, value, embedding)
+
     return UpdateFriendDetailsResponse(
         friend_name=friend.name,
         attributes=updated_attributes
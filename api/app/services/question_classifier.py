@@ -0,0 +1,314 @@
+import asyncio
+import logging
+import random
+import re
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import get_env
+from database import SessionLocal
+from models.chat_history import ChatRequest, ChatResponse
+from models.friend import Friend
+from utils.embedding import generate_embedding_async, generate_embedding_matrix, normalize_vectors, run_in_embedding_executor
+from utils.text_processing import find_name_in_text
+
+logger = logging.getLogger(__name__)
+
+env = get_env()
+
+# 質問文中の友人名はこの名前に置き換えてから比較する（名前の違いで類似度がぶれないように）
+SUBJECT_PLACEHOLDER = "Alex"
+
+# analyze_questionのプロンプトの例を元にした学習例（{name}は友人名）
+SEED_EXAMPLES: List[Tuple[str, int]] = [
+    ("Is {name} an engineer?", 1),
+    ("Is {name} married?", 1),
+    ("Does {name} have a child?", 1),
+    ("Does {name} like sushi?", 1),
+    ("Is {name} from Tokyo?", 1),
+    ("Does {name} play tennis?", 1),
+    ("What is {name}'s occupation?", 2),
+    ("Where does {name} live?", 2),
+    ("Where does {name} work?", 2),
+    ("How old is {name}?", 2),
+    ("When is {name}'s birthday?", 2),
+    ("What is {name}'s hobby?", 2),
+    ("What does {name} do for a living?", 2),
+    ("Tell me about {name}'s occupation", 2),
+    ("Who lives in Tokyo?", 3),
+    ("Who has a daughter?", 3),
+    ("Who are the new team members?", 3),
+    ("Which employee has the most experience?", 3),
+    ("Who is an engineer?", 3),
+    ("Who likes sushi?", 3),
+    ("Who works at Google?", 3),
+    ("Can you tell me about {name}?", 4),
+    ("What do you know about {name}?", 4),
+    ("Tell me about {name}", 4),
+    ("Who is {name}?", 4),
+    ("Describe {name}", 4),
+]
+
+# カテゴリーごとの "what"（質問されている属性）の抽出パターン。固定値があればそれを使う
+_SUBJECT = re.escape(SUBJECT_PLACEHOLDER.lower())
+_WHAT_PATTERNS: Dict[int, List[Tuple[re.Pattern, Optional[str]]]] = {
+    1: [
+        (re.compile(rf"^(?:is|was) {_SUBJECT} (?P<what>.+)$"), None),
+        (re.compile(rf"^(?:does|did) {_SUBJECT} (?P<what>.+)$"), None),
+    ],
+    2: [
+        (re.compile(rf"^where does {_SUBJECT} live$"), "residence"),
+        (re.compile(rf"^where does {_SUBJECT} work$"), "workplace"),
+        (re.compile(rf"^how old is {_SUBJECT}$"), "age"),
+        (re.compile(rf"^what does {_SUBJECT} do(?: for a living)?$"), "occupation"),
+        (re.compile(rf"^(?:what|which|when|where) (?:is|are|was|were) {_SUBJECT}'s (?P<what>.+)$"), None),
+        (re.compile(rf"^tell me about {_SUBJECT}'s (?P<what>.+)$"), None),
+    ],
+    3: [
+        (re.compile(r"^who (?P<what>(?:is|are|has|have|lives?|works?|likes?|plays?) .+)$"), None),
+        (re.compile(r"^which (?:friends?|person|people|one) (?P<what>.+)$"), None),
+    ],
+}
+_LEADING_WORDS = re.compile(r"^(?:(?:is|are|has|have|an?|the)\s+)+")
+
+# カテゴリー①②④は友人の特定が必要
+_CATEGORIES_WITH_SUBJECT = (1, 2, 4)
+
+
+def extract_subject(friend_names: List[str], question: str) -> Tuple[Optional[str], str]:
+    """質問文に含まれる友人名（複数あれば最も長く一致したもの）と、その部分を置き換えた質問文を返す"""
+    best_name, best_match = None, None
+    for name in friend_names:
+        match = find_name_in_text(name, question)
+        if match and (best_match is None or len(match.group(0)) > len(best_match.group(0))):
+            best_name, best_match = name, match
+    if best_match is None:
+        return None, question
+    masked = question[:best_match.start()] + SUBJECT_PLACEHOLDER + question[best_match.end():]
+    return best_name, masked
+
+
+def extract_what(category: int, masked_question: str) -> Optional[str]:
+    text = masked_question.strip().rstrip("?.! ").lower()
+    for pattern, fixed in _WHAT_PATTERNS.get(category, []):
+        match = pattern.match(text)
+        if not match:
+            continue
+        if fixed is not None:
+            return fixed
+        what = _LEADING_WORDS.sub("", match.group("what")).strip()
+        # "Alex's daughter's age" のように関係者を経由する質問はrelated_subjectが必要なのでGeminiに任せる
+        if "'s " in what:
+            return None
+        return what or None
+    return None
+
+
+class LocalClassification:
+    def __init__(self, category: int, confidence: float, similarity: float, who: Optional[str], what: Optional[str], masked_question: str, vector: np.ndarray):
+        self.category = category
+        self.confidence = confidence
+        self.similarity = similarity
+        self.who = who
+        self.what = what
+        self.masked_question = masked_question
+        self.vector = vector
+        self.confident = False
+
+
+class QuestionClassifierStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.fast_path = 0
+        self.fallback = 0
+        self.fallback_compared = 0
+        self.fallback_disagreements = 0
+        self.shadow_compared = 0
+        self.shadow_disagreements = 0
+
+    def record_fast_path(self) -> None:
+        with self._lock:
+            self.fast_path += 1
+
+    def record_fallback(self, disagreed: Optional[bool]) -> None:
+        with self._lock:
+            self.fallback += 1
+            if disagreed is not None:
+                self.fallback_compared += 1
+                self.fallback_disagreements += int(disagreed)
+
+    def record_shadow(self, disagreed: bool) -> None:
+        with self._lock:
+            self.shadow_compared += 1
+            self.shadow_disagreements += int(disagreed)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.fast_path + self.fallback
+            return {
+                "classified": total,
+                "fast_path": self.fast_path,
+                "fallback": self.fallback,
+                "fast_path_rate": self.fast_path / total if total else 0.0,
+                # 高速パスで答えた質問のうち、サンプリングしてGeminiと比べた結果（高速パスの誤り率の推定）
+                "shadow_compared": self.shadow_compared,
+                "shadow_disagreement_rate": self.shadow_disagreements / self.shadow_compared if self.shadow_compared else 0.0,
+                # Geminiにフォールバックした質問での、ローカルの推定カテゴリーとGeminiの結果の不一致率
+                "fallback_compared": self.fallback_compared,
+                "fallback_disagreement_rate": self.fallback_disagreements / self.fallback_compared if self.fallback_compared else 0.0,
+            }
+
+
+class QuestionClassifier:
+    """ラベル付きの質問例に対するEmbeddingのk近傍法で、質問カテゴリー①〜④を推定する
+
+    学習例はプロンプトの例と、chat_responsesに記録された過去の分析結果（Geminiの分類）。
+    プロセス内では、Geminiにフォールバックした質問の分析結果も学習例に追加していく。
+    """
+
+    def __init__(self, k: int, confidence_threshold: float, min_similarity: float, max_examples: int):
+        self.k = k
+        self.confidence_threshold = confidence_threshold
+        self.min_similarity = min_similarity
+        self.max_examples = max_examples
+        self.stats = QuestionClassifierStats()
+        self._matrix: Optional[np.ndarray] = None
+        self._labels: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+        self._shadow_tasks = set()
+
+    def ensure_loaded(self) -> None:
+        if self._matrix is not None:
+            return
+        with self._lock:
+            if self._matrix is not None:
+                return
+            examples = [(text.format(name=SUBJECT_PLACEHOLDER), category) for text, category in SEED_EXAMPLES]
+            try:
+                examples += self._load_logged_examples()
+            except Exception as e:
+                logger.warning(f"Failed to load logged chat responses as classifier examples: {str(e)}")
+            self._labels = np.array([category for _, category in examples], dtype=np.int8)
+            self._matrix = generate_embedding_matrix([text for text, _ in examples])
+            logger.info(f"Question classifier loaded {len(examples)} examples ({len(SEED_EXAMPLES)} seed)")
+
+    def _load_logged_examples(self) -> List[Tuple[str, int]]:
+        db = SessionLocal()
+        try:
+            rows = (
+                db.query(ChatRequest.content, ChatResponse.who, ChatResponse.question_category)
+                .join(ChatResponse, ChatResponse.request_id == ChatRequest.id)
+                .filter(ChatResponse.question_category.in_([1, 2, 3, 4]))
+                .order_by(ChatResponse.id.desc())
+                .limit(self.max_examples)
+                .all()
+            )
+        finally:
+            db.close()
+
+        examples = []
+        for row in rows:
+            if not row.content:
+                continue
+            content = row.content
+            if row.who and row.who.lower() != "unknown":
+                _, content = extract_subject([row.who], content)
+            examples.append((content, row.question_category))
+        return examples
+
+    def add_example(self, classification: LocalClassification, category: int) -> None:
+        with self._lock:
+            if self._matrix is None or len(self._labels) >= self.max_examples + len(SEED_EXAMPLES):
+                return
+            # predict()はロックを取らずに行列→ラベルの順で読むので、ラベルを先に伸ばす
+            self._labels = np.append(self._labels, np.int8(category))
+            self._matrix = np.vstack([self._matrix, classification.vector[np.newaxis, :]])
+
+    def predict(self, vector: np.ndarray) -> Tuple[int, float, float]:
+        """(カテゴリー, 上位k件の類似度で重み付けした得票率, 最近傍の類似度) を返す"""
+        matrix = self._matrix
+        labels = self._labels
+        similarities = matrix @ vector
+        k = min(self.k, len(similarities))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        weights = np.clip(similarities[top], 0, None)
+        votes = np.zeros(5, dtype=np.float32)
+        np.add.at(votes, labels[top], weights)
+        category = int(np.argmax(votes))
+        total = float(votes.sum())
+        return category, float(votes[category]) / total if total else 0.0, float(similarities[top].max())
+
+    async def classify(self, db: AsyncSession, user_id: int, question: str) -> LocalClassification:
+        rows = (await db.execute(select(Friend.name).where(Friend.user_id == user_id))).all()
+        friend_names = [row.name for row in rows if row.name]
+        who, masked_question = extract_subject(friend_names, question)
+        vector = normalize_vectors(await generate_embedding_async(masked_question))
+        if self._matrix is None:
+            await run_in_embedding_executor(self.ensure_loaded)
+
+        category, confidence, similarity = self.predict(vector)
+        what = extract_what(category, masked_question) if category != 4 else None
+        classification = LocalClassification(category, confidence, similarity, who, what, masked_question, vector)
+
+        classification.confident = (
+            confidence >= self.confidence_threshold
+            and similarity >= self.min_similarity
+            # ①②④は友人名が、③は友人名が無いことが必要
+            and (who is not None) == (category in _CATEGORIES_WITH_SUBJECT)
+            and (category == 4 or what is not None)
+        )
+        return classification
+
+    def record_fast_path(self, classification: LocalClassification, analyze: Callable[[], Awaitable[Dict]], get_category: Callable[[Optional[str]], int]) -> None:
+        self.stats.record_fast_path()
+        if random.random() < env.QUESTION_CLASSIFIER_SHADOW_RATE:
+            # 一部の質問はバックグラウンドでGeminiにも分析させ、高速パスとの不一致率を測る
+            task = asyncio.ensure_future(self._shadow_check(classification, analyze, get_category))
+            self._shadow_tasks.add(task)
+            task.add_done_callback(self._shadow_tasks.discard)
+        self._log_rates()
+
+    def record_fallback(self, classification: Optional[LocalClassification], category: int) -> None:
+        if classification is None or category not in (1, 2, 3, 4):
+            self.stats.record_fallback(None)
+        else:
+            self.stats.record_fallback(classification.category != category)
+            self.add_example(classification, category)
+        self._log_rates()
+
+    async def _shadow_check(self, classification: LocalClassification, analyze: Callable[[], Awaitable[Dict]], get_category: Callable[[Optional[str]], int]) -> None:
+        try:
+            category = get_category((await analyze()).get("category"))
+        except Exception as e:
+            logger.warning(f"Shadow analysis for question classifier failed: {str(e)}")
+            return
+        if category not in (1, 2, 3, 4):
+            return
+        disagreed = category != classification.category
+        self.stats.record_shadow(disagreed)
+        if disagreed:
+            logger.info(f"Question classifier disagreed with Gemini: local={classification.category}, gemini={category}, question={classification.masked_question!r}")
+
+    def _log_rates(self) -> None:
+        stats = self.stats.stats()
+        logger.info(
+            f"Question classifier: fast_path_rate={stats['fast_path_rate']:.3f} ({stats['fast_path']}/{stats['classified']}), "
+            f"shadow_disagreement_rate={stats['shadow_disagreement_rate']:.3f} ({stats['shadow_compared']} compared), "
+            f"fallback_disagreement_rate={stats['fallback_disagreement_rate']:.3f} ({stats['fallback_compared']} compared)"
+        )
+
+
+question_classifier = QuestionClassifier(
+    k=env.QUESTION_CLASSIFIER_K,
+    confidence_threshold=env.QUESTION_CLASSIFIER_CONFIDENCE,
+    min_similarity=env.QUESTION_CLASSIFIER_MIN_SIMILARITY,
+    max_examples=env.QUESTION_CLASSIFIER_MAX_EXAMPLES,
+)
+
+
+def get_question_classifier_stats() -> dict:
+    return question_classifier.stats.stats()
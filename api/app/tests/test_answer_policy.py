@@ -0,0 +1,96 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from services.answer_policy import AnswerPolicy, ANSWER_SOURCE_TEMPLATE
+from utils.attribute_scoring import AttributeMatrix, score_template_candidates
+from utils.synonym_index import SynonymIndex
+
+
+def attribute(name, value):
+    return SimpleNamespace(name=name, value=value)
+
+
+def test_category_1_template_answers_from_residence():
+    candidates = [(attribute("Location", "Tokyo"), 0.9, 0.8)]
+
+    result = AnswerPolicy.category_1_template("Jon", "live in Tokyo", candidates)
+
+    assert result["status"] == "Yes"
+    assert result["final_answer"] == "Yes. Jon lives in Tokyo."
+    assert result["answer_source"] == ANSWER_SOURCE_TEMPLATE
+
+
+def test_category_1_template_does_not_answer_residence_from_birthplace():
+    # 出身地の値が質問に含まれていても、住まいを聞く質問にはテンプレートで答えない
+    candidates = [(attribute("Birthplace", "Tokyo"), 0.95, 0.9)]
+
+    assert AnswerPolicy.category_1_template("Jon", "live in Tokyo", candidates) is None
+
+
+def test_category_1_template_skips_birthplace_and_uses_residence():
+    candidates = [
+        (attribute("Birthplace", "Tokyo"), 0.95, 0.9),
+        (attribute("Residence Prefecture", "Tokyo"), 0.85, 0.9),
+    ]
+
+    result = AnswerPolicy.category_1_template("Jon", "live in Tokyo", candidates)
+
+    assert result["approximation"] == {"attribute": "Residence Prefecture", "value": "Tokyo"}
+
+
+def test_category_1_template_requires_category_relevance():
+    # 属性自身の類似度が高くても、質問の同義語カテゴリーと無関係な属性では答えない
+    candidates = [(attribute("Favorite_Food", "sushi"), 0.9, 0.2)]
+
+    assert AnswerPolicy.category_1_template("Jon", "like sushi", candidates) is None
+
+
+def test_category_1_template_requires_attribute_similarity():
+    candidates = [(attribute("Location", "Tokyo"), 0.6, 0.95)]
+
+    assert AnswerPolicy.category_1_template("Jon", "live in Tokyo", candidates) is None
+
+
+def test_category_1_template_does_not_answer_negated_questions():
+    candidates = [(attribute("Location", "Tokyo"), 0.95, 0.9)]
+
+    assert AnswerPolicy.category_1_template("Jon", "not live in Tokyo", candidates) is None
+    assert AnswerPolicy.category_1_template("Jon", "never lived in Tokyo", candidates) is None
+    assert AnswerPolicy.category_1_template("Jon", "doesn't live in Tokyo", candidates) is None
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_score_template_candidates_ignores_question_category_similarity():
+    # 軸: 0=住まい 1=出身 2=その他
+    residence, birthplace, other = _unit([1, 0, 0]), _unit([0, 1, 0]), _unit([0, 0, 1])
+    attributes = [attribute("Birthplace", "Tokyo"), attribute("Location", "Tokyo")]
+    # 行: 属性名 ×2、属性値 ×2、"属性名: 属性値" ×2
+    stacked = np.vstack([
+        birthplace, residence,
+        other, other,
+        _unit([0.3, 0.9, 0.3]), _unit([0.9, 0.3, 0.3]),
+    ])
+    synonyms = SynonymIndex(["residence", "hobby"], np.array([0, 1], dtype=np.intp), np.vstack([residence, other]))
+
+    candidates = score_template_candidates(AttributeMatrix(attributes, stacked), _unit([1, 0.1, 0]), synonyms)
+
+    assert [candidate[0].name for candidate in candidates] == ["Location", "Birthplace"]
+    location, birth = candidates[0], candidates[1]
+    assert location[1] > 0.9 and location[2] > 0.9
+    # 質問は住まいのカテゴリーに強く一致するが、その類似度は出身地の属性には加算されない
+    assert birth[1] < 0.5
+    assert birth[2] < 0.1
+
+
+def test_synonym_index_category_similarities():
+    matrix = np.vstack([_unit([1, 0, 0]), _unit([0, 1, 0]), _unit([0, 0, 1])])
+    synonyms = SynonymIndex(["job", "hobby"], np.array([0, 2], dtype=np.intp), matrix)
+
+    assert synonyms.best_category(_unit([0, 0.2, 1])) == ("hobby", synonyms.relevance(_unit([0, 0.2, 1]))["hobby"])
+    similarities = synonyms.category_similarities(np.vstack([_unit([0, 1, 0]), _unit([0, 0, 1])]), "job")
+    np.testing.assert_allclose(similarities, [1.0, 0.0], atol=1e-6)
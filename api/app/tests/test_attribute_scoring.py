@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import utils.attribute_scoring as attribute_scoring
+from utils.attribute_scoring import AttributeMatrix, find_best_attribute
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def stored_attribute(name, value, name_embedding, value_embedding, embedding):
+    return SimpleNamespace(name=name, value=value, name_embedding=name_embedding, value_embedding=value_embedding, embedding=embedding)
+
+
+def test_from_attributes_uses_stored_vectors_without_encoding(monkeypatch):
+    def fail(texts):
+        raise AssertionError(f"unexpected encode: {texts}")
+    monkeypatch.setattr(attribute_scoring, "generate_embedding_matrix", fail)
+
+    attributes = [
+        stored_attribute("Occupation", "teacher", _unit([1, 0, 0]), _unit([0, 1, 0]), _unit([1, 1, 0])),
+        stored_attribute("Hobby", "tennis", _unit([0, 0, 1]), _unit([0, 1, 1]), _unit([1, 0, 1])),
+    ]
+
+    matrix = AttributeMatrix.from_attributes(attributes)
+    scores = matrix.score(_unit([1, 0, 0]))
+
+    np.testing.assert_allclose(scores.name, [1.0, 0.0], atol=1e-6)
+    np.testing.assert_allclose(scores.value, [0.0, 0.0], atol=1e-6)
+    best, _, _ = find_best_attribute(matrix, _unit([1, 0, 0]))
+    assert best.name == "Occupation"
+
+
+def test_from_attributes_encodes_only_missing_vectors(monkeypatch):
+    encoded = []
+
+    def fake_encode(texts):
+        encoded.append(list(texts))
+        return np.stack([_unit([0, 0, 1]) for _ in texts])
+    monkeypatch.setattr(attribute_scoring, "generate_embedding_matrix", fake_encode)
+
+    attributes = [
+        stored_attribute("Occupation", "teacher", _unit([1, 0, 0]), None, _unit([1, 1, 0])),
+        SimpleNamespace(name="Hobby", value="tennis", embedding=None),
+    ]
+
+    matrix = AttributeMatrix.from_attributes(attributes)
+
+    assert encoded == [["Hobby", "teacher", "tennis", "Hobby: tennis"]]
+    scores = matrix.score(_unit([1, 0, 0]))
+    assert scores.name[0] == pytest.approx(1.0)
+    assert scores.value[0] == pytest.approx(0.0)
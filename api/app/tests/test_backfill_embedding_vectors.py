@@ -0,0 +1,57 @@
+import json
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import utils.embedding as embedding
+from scripts.backfill_embedding_vectors import backfill_parameters
+from utils.chat_processing_utils import EmbeddingBackfill
+
+
+@pytest.fixture(autouse=True)
+def small_dimension(monkeypatch):
+    monkeypatch.setattr(embedding, "get_embedding_dimension", lambda: 3)
+
+
+def friend_attribute_row(**columns):
+    row = {"id": 1, "attribute_id": 10, "name": "Hobby", "value": "tennis", "embedding": None, "embedding_vector": None, "embedding_key": None}
+    row.update(columns)
+    return SimpleNamespace(**row)
+
+
+def test_converted_row_is_read_back_without_re_encoding():
+    legacy = [0.1, 0.2, 0.3]
+    (params,) = backfill_parameters([friend_attribute_row(embedding=json.dumps(legacy))])
+
+    converted = friend_attribute_row(embedding=params["embedding"], embedding_vector=params["embedding_vector"], embedding_key=params["embedding_key"])
+    backfill = EmbeddingBackfill()
+    attr_info = backfill.to_attribute_info(converted)
+
+    assert len(backfill) == 0
+    np.testing.assert_allclose(attr_info.embedding, legacy, rtol=1e-6)
+
+
+def test_broken_legacy_value_is_discarded():
+    (params,) = backfill_parameters([friend_attribute_row(embedding="not json")])
+
+    assert params == {"id": 1, "embedding": None, "embedding_vector": None, "embedding_key": None}
+
+
+def test_row_not_yet_backfilled_uses_the_legacy_json():
+    legacy = [0.4, 0.5, 0.6]
+    backfill = EmbeddingBackfill()
+    attr_info = backfill.to_attribute_info(friend_attribute_row(embedding=json.dumps(legacy)))
+
+    assert len(backfill) == 0
+    np.testing.assert_allclose(attr_info.embedding, legacy, rtol=1e-6)
+
+
+def test_converted_row_is_re_encoded_after_the_value_changes():
+    (params,) = backfill_parameters([friend_attribute_row(embedding=json.dumps([0.1, 0.2, 0.3]))])
+
+    changed = friend_attribute_row(value="golf", embedding_vector=params["embedding_vector"], embedding_key=params["embedding_key"])
+    backfill = EmbeddingBackfill()
+    backfill.to_attribute_info(changed)
+
+    assert backfill.texts_to_encode() == ["Hobby: golf"]
@@ -0,0 +1,81 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import controllers.chat_controller as chat_controller
+from controllers.chat_controller import ChatController
+from schemas.chat import InitialChatResponse
+
+
+class FakeSession:
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def stream(monkeypatch):
+    state = SimpleNamespace(initial=None, result=None, chunks=[])
+
+    async def save_request(db, user_id, content):
+        return SimpleNamespace(id=1)
+
+    async def save_response(db, chat_request_id, response):
+        pass
+
+    async def analyse(user_id, content, db, use_cache):
+        return state.initial
+
+    async def run_category(db, user_id, content, initial_response, use_cache):
+        return state.result, "high"
+
+    async def resolve_category_2(db, user_id, who, what, related_subject):
+        return state.result, "medium"
+
+    async def stream_final_answer(content, result, category, user_id):
+        for chunk in state.chunks:
+            yield chunk
+
+    monkeypatch.setattr(chat_controller, "AsyncSessionLocal", FakeSession)
+    monkeypatch.setattr(chat_controller.ChatRequestService, "save_chat_request", staticmethod(save_request))
+    monkeypatch.setattr(chat_controller.ChatResponseService, "save_chat_response", staticmethod(save_response))
+    monkeypatch.setattr(chat_controller.ChatService, "process_chat", staticmethod(analyse))
+    monkeypatch.setattr(ChatController, "_run_category", staticmethod(run_category))
+    monkeypatch.setattr(chat_controller.ChatProcessingService, "resolve_category_2", staticmethod(resolve_category_2))
+    monkeypatch.setattr(chat_controller.ChatProcessingService, "stream_final_answer", staticmethod(stream_final_answer))
+
+    def run(initial, result, chunks=()):
+        state.initial, state.result, state.chunks = initial, result, list(chunks)
+
+        async def collect():
+            return [event async for event in ChatController.stream_chat(1, "question")]
+
+        events = []
+        for raw in asyncio.run(collect()):
+            name, data = raw.strip().split("\n")
+            events.append((name[len("event: "):], json.loads(data[len("data: "):])))
+        return events
+
+    return run
+
+
+def test_category_1_sends_the_whole_answer_as_an_answer_event(stream):
+    events = stream(
+        InitialChatResponse(who="Jon", what="lives in Tokyo", question_category=1),
+        {"status": "Found", "answer": "Tokyo", "final_answer": "Yes, Jon lives in Tokyo."}
+    )
+
+    assert [name for name, _ in events] == ["analysis", "answer", "done"]
+    assert events[1][1] == {"text": "Yes, Jon lives in Tokyo."}
+
+
+def test_category_2_streams_llm_tokens(stream):
+    events = stream(
+        InitialChatResponse(who="Jon", what="favorite food", question_category=2),
+        {"status": "Found", "answer": "sushi", "approximation": {"attribute": "Favorite Food", "value": "sushi"}, "attribute_similarity": 0.6},
+        chunks=["Jon likes ", "sushi."]
+    )
+
+    assert [name for name, _ in events] == ["analysis", "token", "token", "done"]
+    assert events[-1][1]["response"]["final_answer"] == "Jon likes sushi."
@@ -0,0 +1,81 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+import utils.chat_pipeline as chat_pipeline
+from utils.chat_pipeline import SpeculativePrefetch
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    """友人ごとの読み込みを、テストが終わらせるまで待たせる"""
+    friends = [SimpleNamespace(id=1, name="Jon Smith"), SimpleNamespace(id=2, name="Amy Jones")]
+    state = SimpleNamespace(started=[], finished=[], release={}, index_loads=0)
+
+    @asynccontextmanager
+    async def session():
+        yield None
+
+    async def find_candidates(db, user_id, content):
+        return [friend for friend in friends if friend.name.split()[0] in content]
+
+    async def load_friend(db, friend_id, user_id):
+        state.started.append(friend_id)
+        await state.release.setdefault(friend_id, asyncio.Event()).wait()
+        state.finished.append(friend_id)
+
+    async def load_index(db, user_id):
+        state.index_loads += 1
+
+    monkeypatch.setattr(chat_pipeline, "AsyncSessionLocal", session)
+    monkeypatch.setattr(chat_pipeline, "find_candidate_friends", find_candidates)
+    monkeypatch.setattr(chat_pipeline, "get_all_friend_attributes_async", load_friend)
+    monkeypatch.setattr(chat_pipeline, "get_user_vector_index_async", load_index)
+    return state
+
+
+def test_hit_waits_only_for_the_matched_friend(loads):
+    async def run():
+        prefetch = SpeculativePrefetch(1, "Do Jon and Amy know each other?").start()
+        resolving = asyncio.ensure_future(prefetch.resolve(2, "Jon"))
+        await asyncio.sleep(0.01)
+        assert not resolving.done()
+
+        # Jonの読み込みが終われば、Amyの読み込みを待たずに本処理に進む
+        loads.release[1].set()
+        outcome = await asyncio.wait_for(resolving, 1)
+        await asyncio.sleep(0)
+        return outcome, prefetch._loads[2].cancelled()
+
+    outcome, other_cancelled = asyncio.run(run())
+
+    assert outcome == "hit"
+    assert loads.finished == [1]
+    assert other_cancelled
+
+
+def test_miss_cancels_every_load(loads):
+    async def run():
+        prefetch = SpeculativePrefetch(1, "Does Jon live in Tokyo?").start()
+        outcome = await prefetch.resolve(2, "Bob")
+        await asyncio.sleep(0)
+        return outcome, [task.cancelled() for task in prefetch._loads.values()]
+
+    outcome, cancelled = asyncio.run(run())
+
+    assert outcome == "miss"
+    assert cancelled == [True]
+    assert loads.finished == []
+
+
+def test_category_3_waits_for_the_vector_index(loads):
+    async def run():
+        return await SpeculativePrefetch(1, "Who lives in Tokyo?").start().resolve(3, None)
+
+    outcome = asyncio.run(run())
+
+    assert outcome == "hit"
+    assert loads.index_loads == 1
+    assert loads.started == []
@@ -0,0 +1,108 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import services.chat_processing_service as chat_processing_service
+from services.chat_processing_service import ChatProcessingService
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def stored_attribute(name, value, vector):
+    # 属性名・属性値・"属性名: 属性値" のどれも同じ向きのベクトルにして、類似度を直接決める
+    return SimpleNamespace(name=name, value=value, name_embedding=vector, value_embedding=vector, embedding=vector)
+
+
+@pytest.fixture
+def category_2(monkeypatch):
+    question = _unit([1, 0, 0])
+    attributes = []
+    llm_calls = []
+
+    async def find_friend(db, who, user_id):
+        return SimpleNamespace(id=1, name=who)
+
+    async def friend_attributes(db, friend_id, user_id):
+        return attributes
+
+    async def embed(text):
+        return question.tolist()
+
+    async def run_inline(func, *args):
+        return func(*args)
+
+    async def final_answer(content, result, category, user_id, use_cache):
+        llm_calls.append(result)
+        return "answer from the LLM"
+
+    monkeypatch.setattr(chat_processing_service, "find_friend_async", find_friend)
+    monkeypatch.setattr(chat_processing_service, "get_all_friend_attributes_async", friend_attributes)
+    monkeypatch.setattr(chat_processing_service, "generate_embedding_async", embed)
+    monkeypatch.setattr(chat_processing_service, "run_in_embedding_executor", run_inline)
+    monkeypatch.setattr(ChatProcessingService, "generate_final_answer", staticmethod(final_answer))
+
+    def run(*stored):
+        attributes[:] = stored
+        llm_calls.clear()
+        result, _ = asyncio.run(ChatProcessingService.process_category_2(None, 1, "Alice", "favorite food", content="What is Alice's favorite food?"))
+        return result, llm_calls
+
+    return run
+
+
+def test_priority_bonus_does_not_trigger_the_template(category_2):
+    # 類似度0.5の居住地は優先度ボーナス（+0.3）で0.8になるが、質問に合っているとはいえないのでLLMに回す
+    residence = stored_attribute("Residence Prefecture", "Tokyo", _unit([0.5, np.sqrt(0.75), 0]))
+
+    result, llm_calls = category_2(residence)
+
+    assert result["approximation"]["attribute"] == "Residence Prefecture"
+    assert result["similarity"] == pytest.approx(0.8, abs=1e-5)
+    assert result["attribute_similarity"] == pytest.approx(0.5, abs=1e-5)
+    assert result["final_answer"] == "answer from the LLM"
+    assert len(llm_calls) == 1
+
+
+def test_template_answers_a_closely_matching_attribute(category_2):
+    favorite_food = stored_attribute("Favorite Food", "sushi", _unit([1, 0.1, 0]))
+
+    result, llm_calls = category_2(favorite_food)
+
+    assert result["answer_source"] == "template"
+    assert "sushi" in result["final_answer"]
+    assert llm_calls == []
+
+
+def test_sharded_ranking_applies_the_per_user_concurrency_limit(monkeypatch):
+    env = chat_processing_service.env
+    monkeypatch.setattr(env, "CATEGORY_3_MAX_FRIENDS", 2)
+    monkeypatch.setattr(env, "CATEGORY_3_SHARD_CONCURRENCY", 10)
+    monkeypatch.setattr(env, "GEMINI_PER_USER_CONCURRENCY", 2)
+    calls = []
+    in_flight = [0, 0]
+
+    async def rank(prompt, user_id=None, timeout=None):
+        calls.append(user_id)
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight[1], in_flight[0])
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        return SimpleNamespace(text='{"matching_friends": []}')
+
+    monkeypatch.setattr(chat_processing_service, "generate_gemini_response", rank)
+    friends = [
+        {"name": f"Friend {i}", "best_attribute": SimpleNamespace(name="Hobby", value="tennis"), "similarity": 0.9, "attributes": []}
+        for i in range(10)
+    ]
+
+    metadata = {}
+    asyncio.run(ChatProcessingService.rank_matching_friends_sharded("plays tennis", friends, 7, metadata))
+
+    assert calls == [7] * 5
+    assert in_flight[1] == 2
+    assert metadata["shards"]["failed"] == 0
@@ -0,0 +1,70 @@
+import threading
+
+import numpy as np
+import pytest
+
+from utils.embedding_batcher import EmbeddingBatcher, _EncodeRequest
+
+
+def fake_encode(texts):
+    return np.array([[float(len(text))] for text in texts], dtype=np.float32)
+
+
+def test_batcher_keeps_serving_after_encode_failure():
+    calls = []
+
+    def flaky(texts):
+        calls.append(list(texts))
+        if len(calls) == 1:
+            raise RuntimeError("model failed")
+        return fake_encode(texts)
+
+    batcher = EmbeddingBatcher(flaky, window_seconds=0.001, max_batch_size=8)
+
+    with pytest.raises(RuntimeError):
+        batcher.encode(["a"])
+    np.testing.assert_array_equal(batcher.encode(["abc"]), [[3.0]])
+
+
+def test_batcher_keeps_serving_after_a_malformed_result():
+    # 返ってきた行数が足りずインデックスで失敗しても、ワーカーは止まらない
+    results_pending = [True]
+
+    def encode_fn(texts):
+        if results_pending[0]:
+            results_pending[0] = False
+            return np.zeros((0, 1), dtype=np.float32)
+        return fake_encode(texts)
+
+    batcher = EmbeddingBatcher(encode_fn, window_seconds=0.001, max_batch_size=8)
+
+    with pytest.raises(IndexError):
+        batcher.encode(["a"])
+    np.testing.assert_array_equal(batcher.encode(["ab"]), [[2.0]])
+
+
+def test_batcher_skips_cancelled_requests():
+    started = threading.Event()
+    release = threading.Event()
+    encoded = []
+
+    def blocking(texts):
+        encoded.append(list(texts))
+        started.set()
+        release.wait(1)
+        return fake_encode(texts)
+
+    batcher = EmbeddingBatcher(blocking, window_seconds=0.001, max_batch_size=8)
+    first = threading.Thread(target=batcher.encode, args=(["first"],))
+    first.start()
+    started.wait(1)
+
+    # ワーカーが処理中の間に積まれた要求を取り消しても、ワーカーは止まらず次の要求に答える
+    cancelled = _EncodeRequest(["cancelled"])
+    cancelled.future.cancel()
+    batcher._queue.put(cancelled)
+    release.set()
+    first.join(1)
+
+    np.testing.assert_array_equal(batcher.encode(["next"]), [[4.0]])
+    assert ["cancelled"] not in encoded
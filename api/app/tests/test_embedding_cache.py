@@ -0,0 +1,14 @@
+import numpy as np
+
+from utils.embedding_cache import EmbeddingCache
+
+
+def test_cache_accepts_a_bare_filename(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    cache = EmbeddingCache("test-model", max_bytes=1024, path="embeddings.sqlite3")
+    cache.put_many({"key": np.array([1.0, 2.0], dtype=np.float32)})
+
+    assert (tmp_path / "embeddings.sqlite3").exists()
+    reloaded = EmbeddingCache("test-model", max_bytes=1024, path="embeddings.sqlite3")
+    np.testing.assert_array_equal(reloaded.get_many(["key"])["key"], [1.0, 2.0])
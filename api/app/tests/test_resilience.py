@@ -0,0 +1,123 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from utils.resilience import CircuitBreaker, ResilientCaller, UpstreamUnavailableError
+
+
+class Slots:
+    """同時に取得されている枠の数を記録するセマフォ"""
+
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.held = 0
+        self.max_held = 0
+        self.held_during_sleep = []
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self.semaphore:
+            self.held += 1
+            self.max_held = max(self.max_held, self.held)
+            try:
+                yield
+            finally:
+                self.held -= 1
+
+
+def make_caller(breaker=None, **options):
+    defaults = dict(
+        name="test",
+        attempt_timeout=1.0,
+        deadline=5.0,
+        max_retries=2,
+        retry_base_seconds=0.01,
+        retry_max_seconds=0.01,
+        is_retryable=lambda e: isinstance(e, (ConnectionError, asyncio.TimeoutError)),
+        breaker=breaker or CircuitBreaker(failure_threshold=2, reset_seconds=60),
+    )
+    defaults.update(options)
+    return ResilientCaller(**defaults)
+
+
+def test_slot_is_released_during_backoff(monkeypatch):
+    slots = Slots(1)
+    attempts = []
+    real_sleep = asyncio.sleep
+
+    async def recording_sleep(seconds):
+        slots.held_during_sleep.append(slots.held)
+        await real_sleep(seconds)
+
+    async def flaky():
+        attempts.append(slots.held)
+        if len(attempts) < 3:
+            raise ConnectionError("503")
+        return "ok"
+
+    async def run():
+        monkeypatch.setattr(asyncio, "sleep", recording_sleep)
+        return await make_caller().call(flaky, slot=slots.slot)
+
+    assert asyncio.run(run()) == "ok"
+    # 試行中は枠を1つ持ち、バックオフの待ちの間は持たない
+    assert attempts == [1, 1, 1]
+    assert slots.held_during_sleep == [0, 0]
+
+
+def test_breaker_counts_one_failure_per_logical_call():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=60)
+    caller = make_caller(breaker=breaker)
+
+    async def failing():
+        raise ConnectionError("503")
+
+    with pytest.raises(UpstreamUnavailableError):
+        asyncio.run(caller.call(failing))
+
+    # 3回試行しても、失敗として数えるのは1回だけなのでブレーカーはまだ閉じている
+    assert caller.retries == 2
+    assert breaker.stats()["consecutive_failures"] == 1
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    with pytest.raises(UpstreamUnavailableError):
+        asyncio.run(caller.call(failing))
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_hedge_takes_its_own_slot():
+    slots = Slots(2)
+    calls = []
+
+    async def slow_then_fast():
+        calls.append(slots.held)
+        await asyncio.sleep(0.2 if len(calls) == 1 else 0.01)
+        return len(calls)
+
+    caller = make_caller(hedge_enabled=True, hedge_min_samples=1)
+    caller.latency.observe(0.01)
+
+    result = asyncio.run(caller.call(slow_then_fast, slot=slots.slot))
+
+    assert caller.hedges_sent == 1
+    assert result == 2
+    assert slots.max_held == 2
+
+
+def test_hedge_waits_for_a_free_slot():
+    slots = Slots(1)
+    calls = []
+
+    async def slow():
+        calls.append(slots.held)
+        await asyncio.sleep(0.1)
+        return "primary"
+
+    caller = make_caller(hedge_enabled=True, hedge_min_samples=1)
+    caller.latency.observe(0.01)
+
+    # 枠が1つしか無ければヘッジは送られず（枠を待つ間に一次の呼び出しが返る）、上限を超えない
+    assert asyncio.run(caller.call(slow, slot=slots.slot)) == "primary"
+    assert slots.max_held == 1
+    assert calls == [1]
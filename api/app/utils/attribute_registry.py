@@ -0,0 +1,63 @@
+import threading
+from typing import Dict, Iterable, Mapping, Tuple
+
+
+class AttributeRegistry:
+    """属性名 -> attributes.id の対応（プロセス内）
+
+    起動時に全件を読み込み、以降は新しく作成・検索した属性を書き足していく。
+    属性は削除されない前提なので期限は持たない。他のワーカーが作成した属性は、初めて使われたときにDBから引いて書き足す。
+    """
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def lookup(self, names: Iterable[str]) -> Tuple[Dict[str, int], list]:
+        """(見つかった 属性名 -> id, 見つからなかった属性名) を返す"""
+        found = {}
+        missing = []
+        with self._lock:
+            for name in names:
+                attribute_id = self._ids.get(name)
+                if attribute_id is None:
+                    missing.append(name)
+                else:
+                    found[name] = attribute_id
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def update(self, attribute_ids: Mapping[str, int]) -> None:
+        with self._lock:
+            self._ids.update(attribute_ids)
+
+    def replace(self, attribute_ids: Mapping[str, int]) -> None:
+        """全件を読み込み直した結果で置き換える"""
+        with self._lock:
+            self._ids = dict(attribute_ids)
+            self.loaded = True
+
+    def forget(self, names: Iterable[str]) -> None:
+        """DB上に存在しなかったidを捨てる（作成したトランザクションがロールバックされた場合など）"""
+        with self._lock:
+            for name in names:
+                self._ids.pop(name, None)
+            self.refreshes += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "attributes": len(self._ids),
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+            }
+
+
+attribute_registry = AttributeRegistry()
@@ -0,0 +1,147 @@
+import logging
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from utils.embedding import generate_embedding_matrix, normalize_vectors, attribute_embedding_text, get_embedding_dimension
+
+logger = logging.getLogger(__name__)
+
+# 関連ありとみなす類似度と、高信頼とみなす類似度
+RELEVANCE_THRESHOLD = 0.5
+HIGH_CONFIDENCE_THRESHOLD = 0.8
+# LOCATION_PRIORITIESの順位1つあたりのボーナス
+PRIORITY_BONUS_STEP = 0.1
+
+
+class AttributeScores:
+    def __init__(self, name: np.ndarray, value: np.ndarray, text: np.ndarray):
+        self.name = name
+        self.value = value
+        self.text = text
+
+
+class AttributeMatrix:
+    """友人（またはユーザー）の属性一覧を正規化済みfloat32行列として保持する
+
+    属性名・属性値・"属性名: 属性値" の3種類のEmbedding（保存済みのものを優先）を縦に積んだ1つの行列を持ち、
+    質問ベクトルとの類似度を1回の行列ベクトル積でまとめて求める。
+    """
+
+    def __init__(self, attributes: Sequence, stacked: np.ndarray):
+        self.attributes = list(attributes)
+        self._stacked = stacked
+
+    def __len__(self) -> int:
+        return len(self.attributes)
+
+    @classmethod
+    def from_attributes(cls, attributes: Sequence) -> "AttributeMatrix":
+        names = [attr.name for attr in attributes]
+        values = [attr.value or "" for attr in attributes]
+        if not attributes:
+            return cls([], np.zeros((0, get_embedding_dimension()), dtype=np.float32))
+
+        # 属性名・属性値・"属性名: 属性値" はそれぞれ保存済みのembedding（AttributeInfoのname_embedding /
+        # value_embedding / embedding）があればそれを使い、無いものだけを1回でまとめてエンコードする
+        blocks = [
+            (names, [getattr(attr, "name_embedding", None) for attr in attributes]),
+            (values, [getattr(attr, "value_embedding", None) for attr in attributes]),
+            ([attribute_embedding_text(name, value) for name, value in zip(names, values)], [getattr(attr, "embedding", None) for attr in attributes]),
+        ]
+        missing = [(block, i) for block, (_, stored) in enumerate(blocks) for i, vector in enumerate(stored) if vector is None]
+        encoded = generate_embedding_matrix([blocks[block][0][i] for block, i in missing]) if missing else None
+
+        dimension = encoded.shape[1] if encoded is not None else len(blocks[0][1][0])
+        count = len(attributes)
+        stacked = np.empty((3 * count, dimension), dtype=np.float32)
+        for block, (_, stored) in enumerate(blocks):
+            present = [i for i, vector in enumerate(stored) if vector is not None]
+            if present:
+                stacked[[block * count + i for i in present]] = normalize_vectors(np.stack([stored[i] for i in present]))
+        if missing:
+            stacked[[block * count + i for block, i in missing]] = encoded
+
+        return cls(attributes, stacked)
+
+    @property
+    def name_vectors(self) -> np.ndarray:
+        return self._stacked[:len(self.attributes)]
+
+    def score(self, query_vector: np.ndarray) -> AttributeScores:
+        similarities = self._stacked @ query_vector
+        count = len(self.attributes)
+        return AttributeScores(
+            name=similarities[:count],
+            value=similarities[count:2 * count],
+            text=similarities[2 * count:],
+        )
+
+
+def select_relevant_attributes(
+    matrix: AttributeMatrix,
+    query_vector: np.ndarray,
+    category_similarity: float = 0,
+    threshold: float = RELEVANCE_THRESHOLD
+) -> List[Tuple[object, float]]:
+    """カテゴリー①③用: "属性名: 属性値" または同義語カテゴリーの類似度が閾値を超える属性を類似度の降順で返す"""
+    if not len(matrix):
+        return []
+    text_similarity = matrix.score(query_vector).text
+    relevance = np.maximum(text_similarity, category_similarity)
+    selected = np.flatnonzero((text_similarity > threshold) | (category_similarity > threshold))
+    # 同じ類似度の場合は元の順序を保つ（以前のlist.sortと同じ安定ソート）
+    order = selected[np.argsort(-relevance[selected], kind="stable")]
+    return [(matrix.attributes[i], float(relevance[i])) for i in order]
+
+
+def score_template_candidates(
+    matrix: AttributeMatrix,
+    query_vector: np.ndarray,
+    synonym_index
+) -> List[Tuple[object, float, float]]:
+    """カテゴリー①のテンプレート回答用: (属性, 属性自身の類似度, 質問の同義語カテゴリーとの関連度) を属性自身の類似度の降順で返す
+
+    属性自身の類似度は "属性名: 属性値" と属性名の類似度の大きい方で、質問全体に対する同義語カテゴリーの類似度は含めない。
+    関連度は、質問に最も近い同義語カテゴリーと属性名の類似度（カテゴリーが決まらなければ0）。
+    """
+    if not len(matrix):
+        return []
+    scores = matrix.score(query_vector)
+    own_similarity = np.maximum(scores.text, scores.name)
+
+    category, category_score = synonym_index.best_category(query_vector)
+    if category is None or category_score <= RELEVANCE_THRESHOLD:
+        category_relevance = np.zeros(len(matrix), dtype=np.float32)
+    else:
+        category_relevance = synonym_index.category_similarities(matrix.name_vectors, category)
+
+    order = np.argsort(-own_similarity, kind="stable")
+    return [(matrix.attributes[i], float(own_similarity[i]), float(category_relevance[i])) for i in order]
+
+
+def find_best_attribute(
+    matrix: AttributeMatrix,
+    query_vector: np.ndarray,
+    priority: Optional[List[str]] = None
+) -> Tuple[Optional[object], float, float]:
+    """カテゴリー②用: 属性名・属性値の類似度の大きい方に優先度ボーナスを加えた値が最大の属性を返す
+
+    (属性, ボーナス込みの類似度, ボーナスを含まない属性名・属性値の類似度) を返す。
+    ボーナスは属性の選択にだけ使い、属性が質問に合っているかの判定には後者を使う。
+    """
+    if not len(matrix):
+        return None, -1, -1
+    scores = matrix.score(query_vector)
+    similarity = np.maximum(scores.name, scores.value)
+    total = similarity
+
+    if priority:
+        bonus = np.array([
+            (len(priority) - priority.index(attr.name)) * PRIORITY_BONUS_STEP if attr.name in priority else 0
+            for attr in matrix.attributes
+        ], dtype=np.float32)
+        total = total + bonus
+
+    best_index = int(np.argmax(total))
+    return matrix.attributes[best_index], float(total[best_index]), float(similarity[best_index])
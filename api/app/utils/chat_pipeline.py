@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal
+from models.friend import Friend
+from models.chat_history import ChatRequest
+from utils.chat_processing_utils import get_all_friend_attributes_async, get_user_vector_index_async
+from utils.metrics import Histogram
+from utils.text_processing import find_name_in_text
+
+logger = logging.getLogger(__name__)
+
+# 友人名を含まない質問は「Who lives in Tokyo?」のようなカテゴリー③であることが多い
+SPECULATIVE_CATEGORIES_WITH_FRIEND = (1, 2, 4)
+
+_STAGE_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class ChatPipelineStats:
+    """チャット処理の各ステージの所要時間と、先読みの的中率"""
+
+    def __init__(self):
+        self._histograms: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+        self.speculation_hits = 0
+        self.speculation_misses = 0
+        self.speculation_skipped = 0
+
+    def observe(self, stage: str, milliseconds: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram(_STAGE_BUCKETS_MS)
+        histogram.observe(milliseconds)
+
+    def record_speculation(self, outcome: str) -> None:
+        with self._lock:
+            if outcome == "hit":
+                self.speculation_hits += 1
+            elif outcome == "miss":
+                self.speculation_misses += 1
+            else:
+                self.speculation_skipped += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            histograms = dict(self._histograms)
+            hits, misses, skipped = self.speculation_hits, self.speculation_misses, self.speculation_skipped
+        decided = hits + misses
+        return {
+            "stages_ms": {stage: histogram.snapshot() for stage, histogram in histograms.items()},
+            "speculation": {
+                "hits": hits,
+                "misses": misses,
+                "skipped": skipped,
+                "hit_rate": hits / decided if decided else 0.0,
+            },
+        }
+
+
+chat_pipeline_stats = ChatPipelineStats()
+
+
+class StageTimer:
+    """ステージごとの経過時間を記録し、最後に1行のログとメトリクスに出す"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+
+    def record(self, stage: str, started_at: float) -> None:
+        self.timings[stage] = (time.perf_counter() - started_at) * 1000
+
+    def finish(self) -> Dict[str, float]:
+        self.timings["total"] = (time.perf_counter() - self.started_at) * 1000
+        for stage, milliseconds in self.timings.items():
+            chat_pipeline_stats.observe(stage, milliseconds)
+        return self.timings
+
+
+async def save_chat_request_in_new_session(user_id: int, content: str) -> int:
+    """質問の分析と並行して保存できるよう、専用のセッションでChatRequestを保存してidを返す
+
+    AsyncSessionは同時に複数の処理から使えないので、リクエストのセッションとは分ける。
+    """
+    async with AsyncSessionLocal() as db:
+        chat_request = ChatRequest(user_id=user_id, content=content)
+        db.add(chat_request)
+        await db.commit()
+        return chat_request.id
+
+
+async def find_candidate_friends(db: AsyncSession, user_id: int, content: str) -> List[Friend]:
+    """質問文に名前（フルネームまたは名前の一部）が単語として含まれる友人を返す"""
+    friends = (await db.execute(select(Friend.id, Friend.name).where(Friend.user_id == user_id))).all()
+    candidates = []
+    for friend in friends:
+        if friend.name and find_name_in_text(friend.name, content):
+            candidates.append(friend)
+    return candidates
+
+
+class SpeculativePrefetch:
+    """カテゴリーが分かる前に、質問文から推測した友人の属性やベクトルインデックスを読み込んでおく
+
+    先読みは読み込み時のEmbeddingのバックフィルとキャッシュ（Embeddingのキャッシュ、ユーザーのベクトルインデックス）を温めるだけで、
+    本処理の結果は変えない。読み込みは候補の友人ごと（友人名が無ければユーザーのベクトルインデックス）に並行して行い、
+    推測が当たれば本処理が使う読み込みだけを待って残りは打ち切る。外れた場合はcancel()で全て打ち切る。
+    """
+
+    def __init__(self, user_id: int, content: str):
+        self.user_id = user_id
+        self.content = content
+        self.candidate_names: Dict[int, str] = {}
+        self._candidates_task: Optional[asyncio.Task] = None
+        # 友人ID -> その友人の属性の読み込み（Noneはユーザーのベクトルインデックスの読み込み）
+        self._loads: Dict[Optional[int], asyncio.Task] = {}
+
+    def start(self) -> "SpeculativePrefetch":
+        self._candidates_task = asyncio.ensure_future(self._find_candidates())
+        return self
+
+    def cancel(self, keep: Iterable[Optional[int]] = ()) -> None:
+        """keepに含まれない読み込みを打ち切る"""
+        keep = set(keep)
+        if self._candidates_task is not None:
+            self._candidates_task.cancel()
+        for key, task in self._loads.items():
+            if key not in keep:
+                task.cancel()
+
+    def needed_loads(self, question_category: int, who: Optional[str]) -> Optional[List[Optional[int]]]:
+        """本処理が使う読み込みのキーを返す。推測が外れていればNone"""
+        if question_category in SPECULATIVE_CATEGORIES_WITH_FRIEND:
+            if not who:
+                return None
+            matched = [
+                friend_id for friend_id, name in self.candidate_names.items()
+                if name.lower() == who.lower() or who.lower() in name.lower().split()
+            ]
+            return matched or None
+        if question_category == 3 and not self.candidate_names:
+            return [None]
+        return None
+
+    async def resolve(self, question_category: int, who: Optional[str]) -> str:
+        """推測が当たっていれば本処理が使う読み込みだけを待ち（同じ読み込みを重複させない）、外れていれば打ち切る"""
+        if self._candidates_task is None:
+            return "skipped"
+        try:
+            await asyncio.shield(self._candidates_task)
+        except Exception as e:
+            logger.warning(f"Speculative candidate lookup failed for user_id: {self.user_id}: {str(e)}")
+            self.cancel()
+            return "skipped"
+
+        needed = self.needed_loads(question_category, who)
+        if needed is None:
+            self.cancel()
+            return "miss"
+        self.cancel(keep=needed)
+        # 読み込みの失敗は各タスク内で記録済みなので、ここでは完了だけを待つ
+        await asyncio.wait([self._loads[key] for key in needed])
+        return "hit"
+
+    async def _find_candidates(self) -> None:
+        async with AsyncSessionLocal() as db:
+            candidates = await find_candidate_friends(db, self.user_id, self.content)
+        self.candidate_names = {friend.id: friend.name for friend in candidates}
+
+        # resolve()が候補を見た時点で読み込みが揃っているよう、ここで始める
+        for friend_id in self.candidate_names:
+            self._loads[friend_id] = asyncio.ensure_future(self._load_friend(friend_id))
+        if not candidates:
+            # 友人名が無ければカテゴリー③を想定して全友人のインデックスを作っておく
+            self._loads[None] = asyncio.ensure_future(self._load_vector_index())
+
+    async def _load_friend(self, friend_id: int) -> None:
+        # 読み込み時にEmbeddingの無い属性がバックフィルされ（エンコードはembedding_executorで実行）、
+        # 本処理の読み込みでは保存済みのEmbeddingが使われる
+        try:
+            async with AsyncSessionLocal() as db:
+                await get_all_friend_attributes_async(db, friend_id, self.user_id)
+        except Exception as e:
+            # 先読みの失敗は本処理に影響させない
+            logger.warning(f"Speculative prefetch failed for user_id: {self.user_id}, friend_id: {friend_id}: {str(e)}")
+
+    async def _load_vector_index(self) -> None:
+        try:
+            async with AsyncSessionLocal() as db:
+                await get_user_vector_index_async(db, self.user_id)
+        except Exception as e:
+            logger.warning(f"Speculative prefetch failed for user_id: {self.user_id}: {str(e)}")
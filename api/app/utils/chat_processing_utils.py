@@ -1,9 +1,16 @@
 import logging
-from sqlalchemy import func
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from sqlalchemy import and_
+from database import SessionLocal, AsyncSessionLocal
 from models.friend import Friend, Attribute, FriendAttribute
-from utils.embedding import generate_embedding, cosine_similarity_single
+from utils.embedding import generate_embedding, run_in_embedding_executor, cosine_similarity_single, attribute_embedding_text, embedding_key_for, decode_stored_embedding, get_embedding_dimension
+from utils.embedding_codec import encode_embedding
+from utils.vector_index import UserVectorIndex, vector_index_registry
 
 logger = logging.getLogger(__name__)
 
@@ -23,35 +30,54 @@ def find_attribute(db: Session, what: str):
 
     return best_attribute, best_similarity
 
+# 名前を記録する属性のid（Friend.nameで見つからない場合はこの属性の値で探す）
+NAME_ATTRIBUTE_ID = 29
+
+def _friend_by_name_query(who: str, user_id: int):
+    return select(Friend).where(func.lower(Friend.name) == who.lower(), Friend.user_id == user_id).limit(1)
+
+def _friend_by_name_attribute_query(who: str, user_id: int):
+    return (
+        select(Friend)
+        .join(FriendAttribute, FriendAttribute.friend_id == Friend.id)
+        .join(Attribute, Attribute.id == FriendAttribute.attribute_id)
+        .where(
+            Attribute.id == NAME_ATTRIBUTE_ID,
+            func.lower(FriendAttribute.value).like(f"%{who.lower()}%"),
+            FriendAttribute.user_id == user_id,
+            Friend.user_id == user_id
+        )
+        .limit(1)
+    )
+
 def find_friend(db: Session, who: str, user_id: int):
     logger.debug(f"Searching for friend: {who} for user_id: {user_id}")
 
-    friend = db.query(Friend).filter(
-        func.lower(Friend.name) == who.lower(),
-        Friend.user_id == user_id
-    ).first()
+    friend = db.execute(_friend_by_name_query(who, user_id)).scalars().first()
+    if friend is None:
+        # Friend.name で見つからなかった場合、Attribute経由で検索
+        logger.debug(f"Friend not found by name for user_id: {user_id}, searching through attributes")
+        friend = db.execute(_friend_by_name_attribute_query(who, user_id)).scalars().first()
 
-    if friend:
-        logger.debug(f"Found friend by name: {friend.name} (id: {friend.id}) for user_id: {user_id}")
-        return friend
-
-    # Friend.name で見つからなかった場合、Attribute経由で検索
-    logger.debug(f"Friend not found by name for user_id: {user_id}, searching through attributes")
-    name_attribute = db.query(Attribute).filter(Attribute.id == 29).first()
-    if name_attribute:
-        friend_with_name = db.query(FriendAttribute).filter(
-            FriendAttribute.attribute_id == name_attribute.id,
-            func.lower(FriendAttribute.value).like(f"%{who.lower()}%"),
-            FriendAttribute.user_id == user_id
-        ).first()
-        if friend_with_name:
-            friend = db.query(Friend).filter(Friend.id == friend_with_name.friend_id, Friend.user_id == user_id).first()
-            if friend:
-                logger.debug(f"Found friend through attributes: {friend.name} (id: {friend.id}) for user_id: {user_id}")
-                return friend
+    _log_found_friend(friend, who, user_id)
+    return friend
 
-    logger.debug(f"Friend not found: {who} for user_id: {user_id}")
-    return None
+async def find_friend_async(db: AsyncSession, who: str, user_id: int):
+    logger.debug(f"Searching for friend: {who} for user_id: {user_id}")
+
+    friend = (await db.execute(_friend_by_name_query(who, user_id))).scalars().first()
+    if friend is None:
+        logger.debug(f"Friend not found by name for user_id: {user_id}, searching through attributes")
+        friend = (await db.execute(_friend_by_name_attribute_query(who, user_id))).scalars().first()
+
+    _log_found_friend(friend, who, user_id)
+    return friend
+
+def _log_found_friend(friend, who: str, user_id: int) -> None:
+    if friend:
+        logger.debug(f"Found friend: {friend.name} (id: {friend.id}) for user_id: {user_id}")
+    else:
+        logger.debug(f"Friend not found: {who} for user_id: {user_id}")
 
 def get_friend_attribute(db: Session, friend_id: int, attribute_id: int, user_id: int):
     return db.query(FriendAttribute).filter(
@@ -60,32 +86,238 @@ def get_friend_attribute(db: Session, friend_id: int, attribute_id: int, user_id
         FriendAttribute.user_id == user_id
     ).first()
 
-def get_all_friend_attributes(db: Session, friend_id: int, user_id: int):
-    logger.debug(f"Getting attributes for friend_id: {friend_id}, user_id: {user_id}")
-    attributes = (
-        db.query(FriendAttribute, Attribute.name)
+def friend_attributes_query(friend_id: int, user_id: int):
+    return (
+        select(
+            FriendAttribute.id,
+            FriendAttribute.attribute_id,
+            FriendAttribute.value,
+            FriendAttribute.embedding_vector,
+            FriendAttribute.embedding,
+            FriendAttribute.embedding_key,
+            FriendAttribute.value_embedding_vector,
+            FriendAttribute.value_embedding_key,
+            Attribute.name,
+            Attribute.embedding_vector.label("name_embedding_vector"),
+            Attribute.embedding_key.label("name_embedding_key")
+        )
         .join(Attribute, FriendAttribute.attribute_id == Attribute.id)
-        .filter(
+        .where(
             and_(
+                FriendAttribute.user_id == user_id,
                 FriendAttribute.friend_id == friend_id,
-                FriendAttribute.user_id == user_id
+                FriendAttribute.enabled == True  # ix_friend_attributes_user_friend_enabled（部分インデックス）を使う
             )
         )
-        .all()
     )
 
-    result = [
-        AttributeInfo(name=attr_name, value=friend_attr.value)
-        for friend_attr, attr_name in attributes
-    ]
+def get_all_friend_attributes(db: Session, friend_id: int, user_id: int):
+    logger.debug(f"Getting attributes for friend_id: {friend_id}, user_id: {user_id}")
+    attributes = db.execute(friend_attributes_query(friend_id, user_id)).all()
 
-    logger.debug(f"Retrieved {len(result)} attributes for friend_id: {friend_id}")
+    backfill = EmbeddingBackfill()
+    result = [backfill.to_attribute_info(row, components=True) for row in attributes]
+
+    if backfill:
+        backfill_attribute_embeddings(backfill)
+
+    logger.debug(f"Retrieved {len(result)} attributes for friend_id: {friend_id} ({len(backfill)} embeddings backfilled)")
     return result
 
+async def get_all_friend_attributes_async(db: AsyncSession, friend_id: int, user_id: int):
+    logger.debug(f"Getting attributes for friend_id: {friend_id}, user_id: {user_id}")
+    attributes = (await db.execute(friend_attributes_query(friend_id, user_id))).all()
+
+    backfill = EmbeddingBackfill()
+    result = [backfill.to_attribute_info(row, components=True) for row in attributes]
+
+    if backfill:
+        await backfill_attribute_embeddings_async(backfill)
+
+    logger.debug(f"Retrieved {len(result)} attributes for friend_id: {friend_id} ({len(backfill)} embeddings backfilled)")
+    return result
+
+def get_user_vector_index(db: Session, user_id: int) -> UserVectorIndex:
+    """ユーザーの全友人属性のベクトルインデックスを返す。常駐していなければ1クエリで読み込んで作る"""
+    index = vector_index_registry.get(user_id)
+    if index is not None:
+        return index
+
+    backfill = EmbeddingBackfill()
+    entries = [(row.friend_id, row.attribute_id, backfill.to_attribute_info(row)) for row in db.execute(user_attributes_query(user_id)).all()]
+
+    if backfill:
+        backfill_attribute_embeddings(backfill)
+
+    return _build_vector_index(user_id, entries, len(backfill))
+
+async def get_user_vector_index_async(db: AsyncSession, user_id: int) -> UserVectorIndex:
+    index = vector_index_registry.get(user_id)
+    if index is not None:
+        return index
+
+    rows = (await db.execute(user_attributes_query(user_id))).all()
+    backfill = EmbeddingBackfill()
+    entries = [(row.friend_id, row.attribute_id, backfill.to_attribute_info(row)) for row in rows]
+
+    if backfill:
+        await backfill_attribute_embeddings_async(backfill)
+
+    return _build_vector_index(user_id, entries, len(backfill))
+
+def user_attributes_query(user_id: int):
+    return (
+        select(
+            FriendAttribute.id,
+            FriendAttribute.friend_id,
+            FriendAttribute.attribute_id,
+            FriendAttribute.value,
+            FriendAttribute.embedding_vector,
+            FriendAttribute.embedding,
+            FriendAttribute.embedding_key,
+            Attribute.name
+        )
+        .join(Attribute, FriendAttribute.attribute_id == Attribute.id)
+        .where(FriendAttribute.user_id == user_id, FriendAttribute.enabled == True)
+        .order_by(FriendAttribute.friend_id, FriendAttribute.id)
+    )
+
+def _build_vector_index(user_id: int, entries: list, backfilled: int) -> UserVectorIndex:
+    index = UserVectorIndex(user_id, get_embedding_dimension(), capacity=len(entries))
+    for friend_id, attribute_id, attr_info in entries:
+        index.upsert(friend_id, attribute_id, attr_info.name, attr_info.value, attr_info.embedding)
+    vector_index_registry.put(index)
+
+    logger.debug(f"Built vector index for user_id: {user_id} with {len(index)} attributes ({backfilled} embeddings backfilled)")
+    return index
+
+class EmbeddingBackfill:
+    """読み込んだ行のうち、保存済みembeddingが無い・古いものを集め、まとめてエンコードして書き戻す
+
+    "属性名: 属性値" はFriendAttribute.embedding_vector、属性値だけはFriendAttribute.value_embedding_vector、
+    属性名だけはAttribute.embedding_vector（全ユーザー共通）に保存する。
+    保存済みembeddingは、現在の (モデル, テキスト) のキーと一致するものだけを使う。
+    """
+
+    def __init__(self):
+        # (FriendAttribute.id, AttributeInfo, テキスト)
+        self.texts: List[Tuple[int, "AttributeInfo", str]] = []
+        self.values: List[Tuple[int, "AttributeInfo", str]] = []
+        # Attribute.id -> (属性名, その属性名を持つAttributeInfo)
+        self.names: Dict[int, Tuple[str, List["AttributeInfo"]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.texts) + len(self.values) + len(self.names)
+
+    def to_attribute_info(self, row, components: bool = False) -> "AttributeInfo":
+        """行をAttributeInfoにする。components=Trueなら属性名・属性値だけのembeddingも読む（カテゴリー②などのスコア計算用）"""
+        embedding_text = attribute_embedding_text(row.name, row.value)
+        attr_info = AttributeInfo(name=row.name, value=row.value, embedding=_stored_embedding(row.embedding_key, embedding_text, row.embedding_vector, row.embedding))
+        if attr_info.embedding is None:
+            self.texts.append((row.id, attr_info, embedding_text))
+
+        if components:
+            value_text = row.value or ""
+            attr_info.value_embedding = _stored_embedding(row.value_embedding_key, value_text, row.value_embedding_vector)
+            if attr_info.value_embedding is None:
+                self.values.append((row.id, attr_info, value_text))
+            attr_info.name_embedding = _stored_embedding(row.name_embedding_key, row.name, row.name_embedding_vector)
+            if attr_info.name_embedding is None:
+                self.names.setdefault(row.attribute_id, (row.name, []))[1].append(attr_info)
+        return attr_info
+
+    def texts_to_encode(self) -> List[str]:
+        return (
+            [text for _, _, text in self.texts]
+            + [text for _, _, text in self.values]
+            + [name for name, _ in self.names.values()]
+        )
+
+    def apply(self, embeddings: list) -> Tuple[list, list, list]:
+        """texts_to_encodeの順のembeddingをAttributeInfoに入れ、
+        (FriendAttributeの"属性名: 属性値", FriendAttributeの属性値, Attribute) への一括UPDATEのパラメーターを返す
+        """
+        vectors = [np.asarray(embedding, dtype=np.float32) for embedding in embeddings]
+        text_vectors = vectors[:len(self.texts)]
+        value_vectors = vectors[len(self.texts):len(self.texts) + len(self.values)]
+        name_vectors = vectors[len(self.texts) + len(self.values):]
+
+        text_parameters = []
+        for (friend_attribute_id, attr_info, text), vector in zip(self.texts, text_vectors):
+            attr_info.embedding = vector
+            text_parameters.append({"id": friend_attribute_id, "embedding": None, "embedding_vector": encode_embedding(vector), "embedding_key": embedding_key_for(text)})
+
+        value_parameters = []
+        for (friend_attribute_id, attr_info, text), vector in zip(self.values, value_vectors):
+            attr_info.value_embedding = vector
+            value_parameters.append({"id": friend_attribute_id, "value_embedding_vector": encode_embedding(vector), "value_embedding_key": embedding_key_for(text)})
+
+        name_parameters = []
+        for (attribute_id, (name, attr_infos)), vector in zip(self.names.items(), name_vectors):
+            for attr_info in attr_infos:
+                attr_info.name_embedding = vector
+            name_parameters.append({"id": attribute_id, "embedding_vector": encode_embedding(vector), "embedding_key": embedding_key_for(name)})
+
+        return text_parameters, value_parameters, name_parameters
+
+def _stored_embedding(stored_key: Optional[str], text: str, vector_blob: Optional[bytes], legacy_json: Optional[str] = None) -> Optional[np.ndarray]:
+    if stored_key is None and vector_blob is None and legacy_json:
+        # バックフィル前の行。JSON列は値の更新のたびに "属性名: 属性値" から作り直されていたので、キー無しでも使える
+        return decode_stored_embedding(None, legacy_json)
+    if stored_key != embedding_key_for(text):
+        return None
+    return decode_stored_embedding(vector_blob, legacy_json)
+
+def _backfill_statements(text_parameters: list, value_parameters: list, name_parameters: list) -> list:
+    # 主キーでの一括UPDATEは、パラメーターの列がそろっている単位で実行する
+    return [
+        (statement, parameters)
+        for statement, parameters in (
+            (update(FriendAttribute), text_parameters),
+            (update(FriendAttribute), value_parameters),
+            (update(Attribute), name_parameters),
+        )
+        if parameters
+    ]
+
+def backfill_attribute_embeddings(backfill: EmbeddingBackfill):
+    """embeddingが無い・古い行をまとめてエンコードし、FriendAttribute / Attributeに書き戻す
+
+    読み込み側のセッションに未コミットの変更があってもコミット・ロールバックしないよう、書き戻しは専用の短いセッションで行う。
+    """
+    statements = _backfill_statements(*backfill.apply(generate_embedding(backfill.texts_to_encode())))
+
+    with SessionLocal() as db:
+        try:
+            for statement, parameters in statements:
+                db.execute(statement, parameters)
+            db.commit()
+        except SQLAlchemyError as e:
+            # 書き戻しに失敗しても今回の質問には計算済みのembeddingで回答できる
+            db.rollback()
+            logger.warning(f"Failed to backfill attribute embeddings: {str(e)}")
+
+async def backfill_attribute_embeddings_async(backfill: EmbeddingBackfill):
+    embeddings = await run_in_embedding_executor(generate_embedding, backfill.texts_to_encode())
+    statements = _backfill_statements(*backfill.apply(embeddings))
+
+    async with AsyncSessionLocal() as db:
+        try:
+            for statement, parameters in statements:
+                await db.execute(statement, parameters)
+            await db.commit()
+        except SQLAlchemyError as e:
+            await db.rollback()
+            logger.warning(f"Failed to backfill attribute embeddings: {str(e)}")
+
 class AttributeInfo:
-    def __init__(self, name: str, value: str):
+    def __init__(self, name: str, value: str, embedding: Optional[np.ndarray] = None):
         self.name = name
         self.value = value
+        self.embedding = embedding
+        # 属性名だけ・属性値だけのembedding（get_all_friend_attributesで読み込んだ場合のみ）
+        self.name_embedding: Optional[np.ndarray] = None
+        self.value_embedding: Optional[np.ndarray] = None
 
 def get_friends_by_attribute(db: Session, user_id: int, attribute_id: int, attribute_value: str):
     """
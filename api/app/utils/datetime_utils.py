@@ -0,0 +1,16 @@
+from datetime import datetime, timezone
+
+
+def utc_now() -> datetime:
+    """タイムゾーン情報を持たないUTCの現在時刻
+
+    DateTime列は timestamp without time zone なので、asyncpgはタイムゾーン付きの値を受け付けない。
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def to_naive_utc(value: datetime) -> datetime:
+    """タイムゾーン付きの値はUTCに変換してタイムゾーン情報を外す（無い値はそのまま）"""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
@@ -0,0 +1,65 @@
+import threading
+import time
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool, QueuePool
+
+from utils.metrics import Histogram
+
+# 接続の取得待ち時間（ミリ秒）のバケット
+POOL_WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000, 30000)
+
+
+class PoolStats:
+    """コネクションプールから接続を取り出すのにかかった時間（新規接続を含む）と、タイムアウトした回数"""
+
+    def __init__(self):
+        self.wait_ms = Histogram(POOL_WAIT_BUCKETS_MS)
+        self._lock = threading.Lock()
+        self.timeouts = 0
+
+    def observe(self, milliseconds: float, timed_out: bool) -> None:
+        self.wait_ms.observe(milliseconds)
+        if timed_out:
+            with self._lock:
+                self.timeouts += 1
+
+    def snapshot(self, pool: Pool) -> dict:
+        with self._lock:
+            timeouts = self.timeouts
+        return {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "timeouts": timeouts,
+            "wait_ms": self.wait_ms.snapshot(),
+        }
+
+
+class _TimedPoolMixin:
+    # dispose()でプールが作り直されても集計が続くよう、インスタンスではなくクラスに持たせる
+    stats: PoolStats
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self.stats.observe((time.perf_counter() - started_at) * 1000, timed_out)
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    """同期エンジン（psycopg2）用"""
+
+    stats = PoolStats()
+
+
+class TimedAsyncAdaptedQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    """非同期エンジン（asyncpg）用"""
+
+    stats = PoolStats()
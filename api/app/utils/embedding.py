@@ -1,11 +1,138 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from typing import List, Tuple
+from typing import Any, Callable, List, Tuple
+from core.config import get_env
+from utils.embedding_cache import EmbeddingCache, normalize_text, make_cache_key
+from utils.embedding_codec import encode_embedding, decode_embedding, decode_legacy_embedding
+from utils.embedding_batcher import EmbeddingBatcher
 
-model = SentenceTransformer('all-MiniLM-L6-v2')
+logger = logging.getLogger(__name__)
+
+env = get_env()
+
+MODEL_NAME = env.EMBEDDING_MODEL_NAME
+
+# SentenceTransformerは初回利用時（通常は起動時のウォームアップ）に読み込む
+_model = None
+_model_lock = threading.Lock()
+
+embedding_cache = EmbeddingCache(
+    model_name=MODEL_NAME,
+    max_bytes=env.EMBEDDING_CACHE_MAX_BYTES,
+    path=env.EMBEDDING_CACHE_PATH,
+)
+
+def get_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                # torch / sentence_transformers のimport自体も重いので読み込み時まで遅らせる
+                import torch
+                from sentence_transformers import SentenceTransformer
+                if env.EMBEDDING_TORCH_THREADS > 0:
+                    # ワーカープロセス数×スレッド数がCPUコア数を超えないよう明示的に設定する
+                    torch.set_num_threads(env.EMBEDDING_TORCH_THREADS)
+                logger.info(f"Loading SentenceTransformer model: {MODEL_NAME}")
+                _model = SentenceTransformer(MODEL_NAME)
+    return _model
+
+def is_model_loaded() -> bool:
+    return _model is not None
+
+def _encode_with_model(texts: List[str]) -> np.ndarray:
+    return get_model().encode(texts, convert_to_numpy=True)
+
+embedding_batcher = EmbeddingBatcher(
+    encode_fn=_encode_with_model,
+    window_seconds=env.EMBEDDING_BATCH_WINDOW_MS / 1000,
+    max_batch_size=env.EMBEDDING_BATCH_MAX_SIZE,
+) if env.EMBEDDING_BATCH_WINDOW_MS > 0 else None
+
+def _encode_cached(texts: List[str]) -> List[np.ndarray]:
+    normalized = [normalize_text(text) for text in texts]
+    keys = [make_cache_key(MODEL_NAME, text) for text in normalized]
+    cached = embedding_cache.get_many(set(keys))
+
+    # キャッシュに無いテキストだけをまとめて1回でエンコードする
+    missing = {key: text for key, text in zip(keys, normalized) if key not in cached}
+    if missing:
+        # 他のリクエストからのエンコードとまとめて1回のバッチ推論にする
+        texts_to_encode = list(missing.values())
+        encoded = embedding_batcher.encode(texts_to_encode) if embedding_batcher else _encode_with_model(texts_to_encode)
+        new_entries = {
+            key: np.asarray(vector, dtype=np.float32)
+            for key, vector in zip(missing.keys(), encoded)
+        }
+        embedding_cache.put_many(new_entries)
+        cached.update(new_entries)
+
+    return [cached[key] for key in keys]
+
+def attribute_embedding_text(name: str, value) -> str:
+    """FriendAttribute.embeddingの元になるテキスト"""
+    return f"{name}: {value}"
+
+def embedding_key_for(text: str) -> str:
+    return make_cache_key(MODEL_NAME, normalize_text(text))
 
 def generate_embedding(text: str | List[str]) -> List[float] | List[List[float]]:
-    return model.encode(text).tolist()
+    if isinstance(text, str):
+        return _encode_cached([text])[0].tolist()
+    return [vector.tolist() for vector in _encode_cached(list(text))]
+
+# モデル推論をイベントループの外で実行するための専用スレッドプール（同時実行数の上限を兼ねる）
+embedding_executor = ThreadPoolExecutor(
+    max_workers=env.EMBEDDING_EXECUTOR_WORKERS,
+    thread_name_prefix="embedding",
+)
+
+async def run_in_embedding_executor(func: Callable[..., Any], *args) -> Any:
+    """エンコードを伴う処理をembedding_executorで実行し、完了をawaitする"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(embedding_executor, func, *args)
+
+async def generate_embedding_async(text: str | List[str]) -> List[float] | List[List[float]]:
+    return await run_in_embedding_executor(generate_embedding, text)
+
+async def generate_embedding_matrix_async(texts: List[str]) -> np.ndarray:
+    return await run_in_embedding_executor(generate_embedding_matrix, texts)
+
+def normalize_vectors(vectors: List[float] | List[List[float]] | np.ndarray) -> np.ndarray:
+    """L2正規化したfloat32配列を返す（正規化済みベクトル同士の内積がコサイン類似度になる）"""
+    array = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(array, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return array / norms
+
+def get_embedding_dimension() -> int:
+    return get_model().get_sentence_embedding_dimension()
+
+def decode_stored_embedding(vector_blob: bytes | None, legacy_json: str | None = None) -> np.ndarray | None:
+    """FriendAttributeの保存値をfloat32配列に戻す。無い・壊れている・次元が合わない場合はNone
+
+    バイナリ列（embedding_vector）を優先し、バックフィル前の行だけJSON列（embedding）を読む。
+    """
+    dimension = get_embedding_dimension()
+    vector = decode_embedding(vector_blob, dimension)
+    if vector is None and legacy_json:
+        vector = decode_legacy_embedding(legacy_json, dimension)
+    return vector
+
+def generate_embedding_matrix(texts: List[str]) -> np.ndarray:
+    """複数テキストのEmbeddingを正規化済みの (len(texts), dim) float32行列として返す"""
+    if not texts:
+        return np.zeros((0, get_embedding_dimension()), dtype=np.float32)
+    return normalize_vectors(np.stack(_encode_cached(list(texts))))
+
+def get_embedding_cache_stats() -> dict:
+    return embedding_cache.stats()
+
+def get_embedding_batcher_stats() -> dict | None:
+    return embedding_batcher.stats() if embedding_batcher else None
 
 def cosine_similarity(vec1: List[float] | np.ndarray, vec2: List[float] | np.ndarray) -> float | np.ndarray:
     vec1 = np.array(vec1)
@@ -0,0 +1,131 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from utils.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class _EncodeRequest:
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.future: Future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+def _set_result(future: Future, result) -> None:
+    # 呼び出し元が取り消した場合などは結果を捨てる
+    if not future.done():
+        try:
+            future.set_result(result)
+        except InvalidStateError:
+            pass
+
+
+def _set_exception(future: Future, exception: BaseException) -> None:
+    if not future.done():
+        try:
+            future.set_exception(exception)
+        except InvalidStateError:
+            pass
+
+
+class EmbeddingBatcher:
+    """並行するリクエストからのエンコード要求を短い時間窓でまとめ、1回のバッチ推論にする
+
+    呼び出し元スレッドは結果が出るまでブロックする。時間窓（window_seconds）が経過するか、
+    まとめたテキスト数が max_batch_size に達した時点で1回だけ encode_fn を呼び、
+    結果を各呼び出し元に振り分ける。
+    """
+
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray], window_seconds: float, max_batch_size: int):
+        self.encode_fn = encode_fn
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+
+        self._queue: "queue.Queue[_EncodeRequest]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+
+        self.batch_size_histogram = Histogram([1, 2, 4, 8, 16, 32, 64, 128, 256])
+        self.queue_wait_ms_histogram = Histogram([0.5, 1, 2, 5, 10, 20, 50, 100, 250, 1000])
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            raise ValueError("texts must not be empty")
+        self._ensure_worker()
+        request = _EncodeRequest(list(texts))
+        self._queue.put(request)
+        return request.future.result()
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None:
+            with self._worker_lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                    self._worker.start()
+
+    def _collect_batch(self) -> List[_EncodeRequest]:
+        first = self._queue.get()
+        batch = [first]
+        size = len(first.texts)
+        deadline = time.monotonic() + self.window_seconds
+
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            try:
+                self._process_batch(batch)
+            except Exception as e:
+                # ワーカーが止まると以降のencode()が全て待ち続けるので、例外は呼び出し元に渡して次のバッチに進む
+                logger.exception(f"Batched embedding encode failed: {str(e)}")
+                for request in batch:
+                    _set_exception(request.future, e)
+
+    def _process_batch(self, batch: List[_EncodeRequest]) -> None:
+        started_at = time.monotonic()
+        # 取り消された・既に結果のある要求はエンコードしない
+        batch = [request for request in batch if not request.future.done()]
+        if not batch:
+            return
+
+        # 同じテキストは1回だけエンコードする
+        unique_texts = list(dict.fromkeys(text for request in batch for text in request.texts))
+        self.batch_size_histogram.observe(len(unique_texts))
+        for request in batch:
+            self.queue_wait_ms_histogram.observe((started_at - request.enqueued_at) * 1000)
+
+        encoded = np.asarray(self.encode_fn(unique_texts))
+        positions = {text: i for i, text in enumerate(unique_texts)}
+        for request in batch:
+            try:
+                _set_result(request.future, encoded[[positions[text] for text in request.texts]])
+            except Exception as e:
+                _set_exception(request.future, e)
+
+    def stats(self) -> dict:
+        return {
+            "window_ms": self.window_seconds * 1000,
+            "max_batch_size": self.max_batch_size,
+            "queue_depth": self._queue.qsize(),
+            "batch_size": self.batch_size_histogram.snapshot(),
+            "queue_wait_ms": self.queue_wait_ms_histogram.snapshot(),
+        }
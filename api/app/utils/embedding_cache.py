@@ -0,0 +1,172 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# OrderedDictのエントリ・キー文字列などのおおよそのオーバーヘッド（バイト）
+ENTRY_OVERHEAD_BYTES = 200
+
+
+def normalize_text(text: str) -> str:
+    # Unicode正規化と空白の統一のみ行う（大文字小文字はモデルの入力として意味があるので保持）
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def make_cache_key(model_name: str, normalized_text: str) -> str:
+    return hashlib.sha256(f"{model_name}\x00{normalized_text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """(モデル名, 正規化テキスト) をキーにした2層のEmbeddingキャッシュ
+
+    1層目はバイト数上限付きのプロセス内LRU、2層目はSQLiteファイルで、
+    プロセス再起動後も残り、同じホスト上の全uvicornワーカーで共有される。
+    """
+
+    def __init__(self, model_name: str, max_bytes: int, path: Optional[str] = None):
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self.path = path or None
+
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_errors = 0
+
+        if self.path:
+            # ファイル名だけが指定された場合はカレントディレクトリに作る
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection().execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, model TEXT NOT NULL, dim INTEGER NOT NULL, vector BLOB NOT NULL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3の接続はスレッド間で共有できないのでスレッドごとに保持する
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, np.ndarray]:
+        found: Dict[str, np.ndarray] = {}
+        missing: List[str] = []
+
+        with self._lock:
+            for key in keys:
+                vector = self._entries.get(key)
+                if vector is None:
+                    missing.append(key)
+                else:
+                    self._entries.move_to_end(key)
+                    found[key] = vector
+                    self.memory_hits += 1
+
+        if missing and self.path:
+            from_disk = self._disk_get_many(missing)
+            if from_disk:
+                with self._lock:
+                    for key, vector in from_disk.items():
+                        self._store(key, vector)
+                    self.disk_hits += len(from_disk)
+                found.update(from_disk)
+
+        with self._lock:
+            self.misses += sum(1 for key in missing if key not in found)
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]) -> None:
+        if not items:
+            return
+        with self._lock:
+            for key, vector in items.items():
+                self._store(key, vector)
+        if self.path:
+            self._disk_put_many(items)
+
+    def _store(self, key: str, vector: np.ndarray) -> None:
+        # 呼び出し元でself._lockを保持していること
+        size = vector.nbytes + ENTRY_OVERHEAD_BYTES
+        if size > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._current_bytes -= previous.nbytes + ENTRY_OVERHEAD_BYTES
+        self._entries[key] = vector
+        self._current_bytes += size
+        while self._current_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._current_bytes -= evicted.nbytes + ENTRY_OVERHEAD_BYTES
+            self.evictions += 1
+
+    def _disk_get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        result: Dict[str, np.ndarray] = {}
+        try:
+            conn = self._connection()
+            # SQLiteのバインド変数上限を超えないよう分割して問い合わせる
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({placeholders})",
+                    [self.model_name, *chunk],
+                ).fetchall()
+                for key, blob in rows:
+                    result[key] = np.frombuffer(blob, dtype="<f4")
+        except sqlite3.Error as e:
+            self.disk_errors += 1
+            logger.warning(f"Embedding disk cache read failed: {str(e)}")
+        return result
+
+    def _disk_put_many(self, items: Dict[str, np.ndarray]) -> None:
+        rows: List[Tuple[str, str, int, bytes]] = [
+            (key, self.model_name, int(vector.shape[0]), vector.astype("<f4", copy=False).tobytes())
+            for key, vector in items.items()
+        ]
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN")
+            conn.executemany("INSERT OR REPLACE INTO embeddings (key, model, dim, vector) VALUES (?, ?, ?, ?)", rows)
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            self.disk_errors += 1
+            logger.warning(f"Embedding disk cache write failed: {str(e)}")
+            try:
+                self._connection().execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "model": self.model_name,
+            "entries": len(self._entries),
+            "bytes": self._current_bytes,
+            "max_bytes": self.max_bytes,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_errors": self.disk_errors,
+            "disk_enabled": bool(self.path),
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,34 @@
+import json
+from typing import List, Optional
+
+import numpy as np
+
+# FriendAttribute.embedding_vectorの形式: リトルエンディアンのfloat32を並べた生バイト列
+EMBEDDING_DTYPE = np.dtype("<f4")
+
+
+def encode_embedding(vector: List[float] | np.ndarray) -> bytes:
+    return np.asarray(vector, dtype=EMBEDDING_DTYPE).tobytes()
+
+
+def decode_embedding(blob: bytes | memoryview | None, dimension: Optional[int] = None) -> Optional[np.ndarray]:
+    """バイト列をコピーせずにfloat32配列として参照する（戻り値は読み取り専用）"""
+    if blob is None or len(blob) == 0 or len(blob) % EMBEDDING_DTYPE.itemsize:
+        return None
+    vector = np.frombuffer(blob, dtype=EMBEDDING_DTYPE)
+    if dimension is not None and vector.shape[0] != dimension:
+        return None
+    return vector
+
+
+def decode_legacy_embedding(stored: Optional[str], dimension: Optional[int] = None) -> Optional[np.ndarray]:
+    """移行前のJSONテキスト形式のembeddingをfloat32配列に戻す"""
+    if not stored:
+        return None
+    try:
+        vector = np.asarray(json.loads(stored), dtype=EMBEDDING_DTYPE)
+    except (ValueError, TypeError):
+        return None
+    if vector.ndim != 1 or (dimension is not None and vector.shape[0] != dimension):
+        return None
+    return vector
@@ -1,9 +1,143 @@
+import asyncio
+import logging
 import os
-import google.generativeai as genai
+import weakref
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Optional
+from core.config import get_env
+from utils.gemini_backends import GeminiBackend, GeminiResponse, create_gemini_backend, is_retryable_gemini_error
+from utils.llm_cache import LLMResponseCache
+from utils.resilience import CircuitBreaker, CircuitOpenError, ResilientCaller
+
+logger = logging.getLogger(__name__)
 
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-genai.configure(api_key=GEMINI_API_KEY)
 
-async def generate_gemini_response(prompt: str):
-    model = genai.GenerativeModel('gemini-pro')
-    return model.generate_content(prompt)
+env = get_env()
+
+# google（本番）/ stub（ローカルの代替サーバー）/ record・replay（応答の記録と再生）
+gemini_backend: GeminiBackend = create_gemini_backend(
+    env.GEMINI_BACKEND,
+    api_key=GEMINI_API_KEY,
+    stub_url=env.GEMINI_STUB_URL,
+    recording_path=env.GEMINI_RECORDING_PATH,
+)
+if gemini_backend.name != "google":
+    logger.warning(f"Using Gemini backend: {gemini_backend.name}")
+
+# プロセス全体の同時呼び出し数と、1ユーザーが占有できる同時呼び出し数の上限
+_global_semaphore = asyncio.Semaphore(env.GEMINI_MAX_CONCURRENCY)
+_user_semaphores: "weakref.WeakValueDictionary[int, asyncio.Semaphore]" = weakref.WeakValueDictionary()
+
+# 期限・リトライ・ヘッジ・サーキットブレーカー（ストリーミングにはブレーカーだけを適用する）
+gemini_resilience = ResilientCaller(
+    name="gemini",
+    attempt_timeout=env.GEMINI_TIMEOUT_SECONDS,
+    deadline=env.GEMINI_DEADLINE_SECONDS,
+    max_retries=env.GEMINI_MAX_RETRIES,
+    retry_base_seconds=env.GEMINI_RETRY_BASE_SECONDS,
+    retry_max_seconds=env.GEMINI_RETRY_MAX_SECONDS,
+    is_retryable=is_retryable_gemini_error,
+    breaker=CircuitBreaker(
+        failure_threshold=env.GEMINI_BREAKER_FAILURE_THRESHOLD,
+        reset_seconds=env.GEMINI_BREAKER_RESET_SECONDS,
+    ),
+    hedge_enabled=env.GEMINI_HEDGE_ENABLED,
+    hedge_percentile=env.GEMINI_HEDGE_PERCENTILE,
+)
+
+llm_response_cache = LLMResponseCache(
+    max_entries=env.LLM_CACHE_MAX_ENTRIES,
+    ttl_seconds=env.LLM_CACHE_TTL_SECONDS,
+)
+
+@asynccontextmanager
+async def _concurrency_slot(user_id: Optional[int]):
+    if user_id is None:
+        async with _global_semaphore:
+            yield
+        return
+
+    # 使用中のユーザーの分だけ保持する（誰も参照しなくなれば自動で消える）
+    user_semaphore = _user_semaphores.get(user_id)
+    if user_semaphore is None:
+        user_semaphore = asyncio.Semaphore(env.GEMINI_PER_USER_CONCURRENCY)
+        _user_semaphores[user_id] = user_semaphore
+
+    async with user_semaphore:
+        async with _global_semaphore:
+            yield
+
+async def generate_gemini_response(prompt: str, user_id: Optional[int] = None, timeout: Optional[float] = None) -> GeminiResponse:
+    """timeoutは1回の試行あたりの上限。リトライを含めた全体はGEMINI_DEADLINE_SECONDSまで
+
+    応答が得られない、またはブレーカーが開いている場合はUpstreamUnavailableErrorを送出する。
+    """
+    # 同時実行数の枠は試行・ヘッジごとに取り、バックオフの待ちの間は他のリクエストに譲る
+    text = await gemini_resilience.call(
+        lambda: gemini_backend.generate(env.GEMINI_MODEL_NAME, prompt),
+        attempt_timeout=timeout,
+        slot=lambda: _concurrency_slot(user_id)
+    )
+    return GeminiResponse(text)
+
+async def stream_gemini_response(prompt: str, user_id: Optional[int] = None, timeout: Optional[float] = None) -> AsyncIterator[str]:
+    """生成されたテキストを届いた順に返す。timeoutは最初のチャンクまでと、チャンク間の待ち時間それぞれに適用する"""
+    timeout = timeout if timeout is not None else env.GEMINI_TIMEOUT_SECONDS
+    breaker = gemini_resilience.breaker
+    if not breaker.allow():
+        raise CircuitOpenError("gemini circuit breaker is open")
+    outcome = None
+    try:
+        async with _concurrency_slot(user_id):
+            chunks = gemini_backend.stream(env.GEMINI_MODEL_NAME, prompt).__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=timeout)
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        outcome = "success"
+    except Exception as e:
+        if is_retryable_gemini_error(e):
+            outcome = "failure"
+        raise
+    finally:
+        # 途中で打ち切られた場合（キャンセル・クライアント切断）は成功とも失敗とも数えない
+        if outcome == "success":
+            breaker.record_success()
+        elif outcome == "failure":
+            breaker.record_failure()
+        else:
+            breaker.release()
+
+async def generate_cached_gemini_text(
+    prompt: str,
+    kind: str,
+    user_id: Optional[int] = None,
+    use_cache: bool = True,
+    validate: Optional[Callable[[str], bool]] = None
+) -> str:
+    """同じプロンプトへの応答テキストをキャッシュから返す。use_cache=Falseなら読み込みを飛ばして取り直す
+
+    validateが指定された場合、それがTrueを返した応答だけをキャッシュする（壊れたJSONを使い回さないため）。
+    """
+    model_name = env.GEMINI_MODEL_NAME
+    if use_cache:
+        cached = llm_response_cache.get(kind, model_name, prompt)
+        if cached is not None:
+            return cached
+    else:
+        llm_response_cache.record_bypass(kind)
+
+    response = await generate_gemini_response(prompt, user_id=user_id)
+    text = response.text
+    if validate is None or validate(text):
+        llm_response_cache.put(kind, model_name, prompt, text)
+    return text
+
+def get_llm_cache_stats() -> dict:
+    return llm_response_cache.stats()
+
+def get_gemini_resilience_stats() -> dict:
+    return gemini_resilience.stats()
@@ -0,0 +1,227 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict, List, Optional
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class GeminiResponse:
+    """バックエンドに関係なく、呼び出し元は今まで通り response.text で応答テキストを読む"""
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class GeminiUpstreamError(RuntimeError):
+    """HTTPのバックエンドが200以外を返した"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class ReplayMissError(LookupError):
+    """replayモードで、記録に無いプロンプトが来た"""
+
+
+def _split_into_chunks(text: str, chunk_size: int = 32) -> List[str]:
+    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)] or [""]
+
+
+class GeminiBackend(ABC):
+    """generateを実装しないバックエンドはインスタンス化の時点でTypeErrorになる"""
+
+    name = "base"
+
+    @abstractmethod
+    async def generate(self, model_name: str, prompt: str) -> str:
+        """プロンプトへの応答テキストを返す"""
+
+    async def stream(self, model_name: str, prompt: str) -> AsyncIterator[str]:
+        # ストリーミングに対応しないバックエンドは、生成済みのテキストを分割して返す
+        text = await self.generate(model_name, prompt)
+        for chunk in _split_into_chunks(text):
+            yield chunk
+
+
+class GoogleGeminiBackend(GeminiBackend):
+    name = "google"
+
+    def __init__(self, api_key: Optional[str]):
+        import google.generativeai as genai
+
+        self._genai = genai
+        genai.configure(api_key=api_key)
+        # GenerativeModel（と内部のクライアント・コネクション）は呼び出しごとに作らず使い回す
+        self._models: Dict[str, "genai.GenerativeModel"] = {}
+
+    def get_model(self, model_name: str):
+        model = self._models.get(model_name)
+        if model is None:
+            model = self._genai.GenerativeModel(model_name)
+            self._models[model_name] = model
+        return model
+
+    async def generate(self, model_name: str, prompt: str) -> str:
+        response = await self.get_model(model_name).generate_content_async(prompt)
+        return response.text
+
+    async def stream(self, model_name: str, prompt: str) -> AsyncIterator[str]:
+        response = await self.get_model(model_name).generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+
+class StubHTTPGeminiBackend(GeminiBackend):
+    """scripts/gemini_stub_server.py（ローカルのGemini代替サーバー）に問い合わせる
+
+    依存を増やさないよう、asyncioのストリームでHTTP/1.1のPOSTを1本ずつ送る。
+    """
+
+    name = "stub"
+
+    def __init__(self, base_url: str):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 80
+        self.path = (parts.path.rstrip("/") or "") + "/v1/generate"
+
+    async def generate(self, model_name: str, prompt: str) -> str:
+        body = json.dumps({"model": model_name, "prompt": prompt}).encode("utf-8")
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(
+                f"POST {self.path} HTTP/1.1\r\n"
+                f"Host: {self.host}:{self.port}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode("ascii") + body
+            )
+            await writer.drain()
+            raw = await reader.read()
+        finally:
+            writer.close()
+
+        head, _, payload = raw.partition(b"\r\n\r\n")
+        status_line = head.split(b"\r\n", 1)[0].decode("ascii", "replace")
+        status = int(status_line.split()[1]) if len(status_line.split()) > 1 else 0
+        if status != 200:
+            raise GeminiUpstreamError(status, f"Gemini stub server returned {status_line}: {payload[:200]!r}")
+        return json.loads(payload)["text"]
+
+
+def recording_key(model_name: str, prompt: str) -> str:
+    return hashlib.sha256(f"{model_name}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+class RecordingGeminiBackend(GeminiBackend):
+    """別のバックエンド（通常はgoogle）への呼び出しをそのまま通し、プロンプトと応答をJSONLに追記する"""
+
+    name = "record"
+
+    def __init__(self, inner: GeminiBackend, path: str):
+        self.inner = inner
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _append(self, model_name: str, prompt: str, text: str) -> None:
+        line = json.dumps({
+            "key": recording_key(model_name, prompt),
+            "model": model_name,
+            "prompt": prompt,
+            "response": text,
+        }, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    async def generate(self, model_name: str, prompt: str) -> str:
+        text = await self.inner.generate(model_name, prompt)
+        self._append(model_name, prompt, text)
+        return text
+
+    async def stream(self, model_name: str, prompt: str) -> AsyncIterator[str]:
+        chunks = []
+        async for chunk in self.inner.stream(model_name, prompt):
+            chunks.append(chunk)
+            yield chunk
+        self._append(model_name, prompt, "".join(chunks))
+
+
+class ReplayGeminiBackend(GeminiBackend):
+    """recordモードで記録したJSONLから応答を返す（ネットワークには一切出ない）
+
+    同じプロンプトが複数回記録されていれば、記録された順に返し、最後まで行ったら先頭に戻る。
+    """
+
+    name = "replay"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._responses: Dict[str, List[str]] = {}
+        self._positions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                key = record.get("key") or recording_key(record["model"], record["prompt"])
+                self._responses.setdefault(key, []).append(record["response"])
+        logger.info(f"Loaded {sum(len(v) for v in self._responses.values())} recorded Gemini responses from {path}")
+
+    async def generate(self, model_name: str, prompt: str) -> str:
+        key = recording_key(model_name, prompt)
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                raise ReplayMissError(f"No recorded Gemini response for prompt (key {key[:12]}): {prompt.strip()[:80]!r}")
+            position = self._positions.get(key, 0)
+            self._positions[key] = (position + 1) % len(responses)
+        return responses[position]
+
+
+# google.api_core.exceptions のうち、時間をおけば成功しうるもの（googleパッケージを読み込まずに名前で判定する）
+_RETRYABLE_GOOGLE_ERRORS = {
+    "DeadlineExceeded",
+    "ServiceUnavailable",
+    "InternalServerError",
+    "TooManyRequests",
+    "ResourceExhausted",
+    "GatewayTimeout",
+    "BadGateway",
+}
+
+
+def is_retryable_gemini_error(error: BaseException) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    if isinstance(error, GeminiUpstreamError):
+        return error.status == 429 or error.status >= 500
+    if isinstance(error, ReplayMissError):
+        return False
+    if isinstance(error, OSError):
+        return True
+    return type(error).__name__ in _RETRYABLE_GOOGLE_ERRORS
+
+
+def create_gemini_backend(backend: str, api_key: Optional[str], stub_url: str, recording_path: str) -> GeminiBackend:
+    if backend == "google":
+        return GoogleGeminiBackend(api_key)
+    if backend == "stub":
+        return StubHTTPGeminiBackend(stub_url)
+    if backend == "record":
+        return RecordingGeminiBackend(GoogleGeminiBackend(api_key), recording_path)
+    if backend == "replay":
+        return ReplayGeminiBackend(recording_path)
+    raise ValueError(f"Unknown GEMINI_BACKEND: {backend} (expected google, stub, record or replay)")
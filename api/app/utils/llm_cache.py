@@ -0,0 +1,67 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Dict, Optional, Tuple
+
+
+class LLMResponseCache:
+    """(モデル名, プロンプトのハッシュ) をキーにしたTTL・件数上限付きのLLM応答キャッシュ
+
+    統計はプロンプトの種類（analyze_question など）ごとに集計する。
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"hits": 0, "misses": 0, "bypasses": 0, "stores": 0})
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model_name: str, prompt: str) -> Tuple[str, str]:
+        return model_name, hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    def get(self, kind: str, model_name: str, prompt: str) -> Optional[str]:
+        key = self.make_key(model_name, prompt)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._stats[kind]["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats[kind]["hits"] += 1
+            return entry[1]
+
+    def record_bypass(self, kind: str) -> None:
+        with self._lock:
+            self._stats[kind]["bypasses"] += 1
+
+    def put(self, kind: str, model_name: str, prompt: str, text: str) -> None:
+        key = self.make_key(model_name, prompt)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, text)
+            self._entries.move_to_end(key)
+            self._stats[kind]["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            kinds = {}
+            for kind, counts in self._stats.items():
+                lookups = counts["hits"] + counts["misses"]
+                kinds[kind] = {**counts, "hit_rate": counts["hits"] / lookups if lookups else 0.0}
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "evictions": self.evictions,
+                "kinds": kinds,
+            }
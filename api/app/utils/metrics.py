@@ -0,0 +1,34 @@
+import bisect
+import threading
+from typing import List, Sequence
+
+
+class Histogram:
+    """累積しない単純なバケット付きヒストグラム（/metrics でそのままJSONとして返す）"""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets: List[float] = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+            count = self._count
+        labels = [f"<={bound:g}" for bound in self.buckets] + [f">{self.buckets[-1]:g}" if self.buckets else "all"]
+        return {
+            "count": count,
+            "sum": total,
+            "mean": total / count if count else 0.0,
+            "buckets": dict(zip(labels, counts)),
+        }
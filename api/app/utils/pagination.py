@@ -0,0 +1,23 @@
+import base64
+import json
+from datetime import datetime
+from typing import Tuple
+
+from utils.datetime_utils import to_naive_utc
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """キーセットページネーションの位置 (created_at, id) を、クライアントが中身を気にしない文字列にする"""
+    payload = json.dumps([created_at.isoformat(), row_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """encode_cursorの逆。形式が不正ならValueErrorを送出する"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        # created_atは timestamp without time zone なので、タイムゾーン付きで渡されたらUTCにそろえる
+        return to_naive_utc(datetime.fromisoformat(created_at)), int(row_id)
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
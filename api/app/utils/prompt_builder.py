@@ -0,0 +1,125 @@
+import json
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（英語は約4文字で1トークン、ASCII以外の文字は1文字1トークンとみなす）
+
+    トークナイザーを呼ばずに予算の判定に使うための値なので、多めに見積もる側に倒している。
+    """
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return (len(text) - non_ascii + 3) // 4 + non_ascii
+
+
+def compact_json(value: Any) -> str:
+    """インデントや区切りの空白を入れないJSON（indent=2のダンプに比べてトークン数がおよそ半分になる）"""
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def nest_attributes(attributes: Iterable) -> Dict[str, Any]:
+    """"Family_Children_Count" のような属性名を "_" で区切って入れ子のdictにまとめる"""
+    nested: Dict[str, Any] = {}
+    for attr in attributes:
+        keys = attr.name.split('_')
+        current = nested
+        for key in keys[:-1]:
+            if not isinstance(current.get(key), dict):
+                current[key] = {}
+            current = current[key]
+        current[keys[-1]] = attr.value
+    return nested
+
+
+def select_within_budget(rendered: Sequence[str], budget_tokens: int, max_items: Optional[int] = None, min_items: int = 1) -> Tuple[int, int]:
+    """関連度の高い順に並んだ要素を先頭から、件数上限と予算に収まるだけ採用する
+
+    (採用した件数, 採用した要素の推定トークン数の合計) を返す。予算を超えてもmin_items件までは採用する。
+    """
+    limit = len(rendered) if max_items is None else min(max_items, len(rendered))
+    used = 0
+    count = 0
+    for text in rendered[:limit]:
+        tokens = estimate_tokens(text) + 1  # 区切り文字の分
+        if count >= min_items and used + tokens > budget_tokens:
+            break
+        used += tokens
+        count += 1
+    return count, used
+
+
+class PromptTruncation:
+    """プロンプトに含めた件数と切り捨てた件数（レスポンスのmetadataに入れる）"""
+
+    def __init__(self, budget_tokens: int):
+        self.budget_tokens = budget_tokens
+        self.estimated_tokens = 0
+        self.counts: Dict[str, Dict[str, int]] = {}
+
+    def record(self, kind: str, total: int, included: int) -> None:
+        counts = self.counts.setdefault(kind, {"total": 0, "included": 0})
+        counts["total"] += total
+        counts["included"] += included
+
+    @property
+    def truncated(self) -> bool:
+        return any(counts["included"] < counts["total"] for counts in self.counts.values())
+
+    def to_dict(self) -> dict:
+        return {
+            "truncated": self.truncated,
+            "estimated_tokens": self.estimated_tokens,
+            "budget_tokens": self.budget_tokens,
+            **{kind: dict(counts) for kind, counts in self.counts.items()},
+        }
+
+
+def merge_truncations(truncations: Sequence[PromptTruncation], totals: Dict[str, int]) -> PromptTruncation:
+    """複数のプロンプト（シャード）の記録を1つにまとめる。totalsは分割前の全体の件数"""
+    merged = PromptTruncation(truncations[0].budget_tokens if truncations else 0)
+    for truncation in truncations:
+        merged.estimated_tokens += truncation.estimated_tokens
+        for kind, counts in truncation.counts.items():
+            merged.record(kind, 0, counts["included"])
+    for kind, total in totals.items():
+        merged.counts.setdefault(kind, {"total": 0, "included": 0})["total"] = total
+    return merged
+
+
+def build_friend_matches_context(matching_friends: List[Dict[str, Any]], budget_tokens: int, max_friends: int, max_attributes_per_friend: int) -> Tuple[str, PromptTruncation]:
+    """カテゴリー③: 類似度順の友人リストから、上位の友人・上位の属性だけを予算内でJSON配列にする
+
+    matching_friendsの各要素は name / best_attribute / attributes（類似度の降順の (属性, 類似度)）を持つ。
+    """
+    truncation = PromptTruncation(budget_tokens)
+    rendered = []
+    attribute_counts = []
+    for friend in matching_friends[:max_friends]:
+        attributes = [attr for attr, _ in friend["attributes"][:max_attributes_per_friend]]
+        rendered.append(compact_json({
+            "name": friend["name"],
+            "best_matching_attribute": f"{friend['best_attribute'].name}: {friend['best_attribute'].value}",
+            "other_relevant_info": nest_attributes(attributes),
+        }))
+        attribute_counts.append(len(attributes))
+
+    included, tokens = select_within_budget(rendered, budget_tokens)
+    truncation.estimated_tokens = tokens
+    truncation.record("friends", len(matching_friends), included)
+    truncation.record(
+        "attributes",
+        sum(len(friend["attributes"]) for friend in matching_friends),
+        sum(attribute_counts[:included])
+    )
+    return "[" + ",".join(rendered[:included]) + "]", truncation
+
+
+def build_attributes_context(ranked_attributes: Sequence, budget_tokens: int, max_attributes: int) -> Tuple[str, List, PromptTruncation]:
+    """カテゴリー④: 重要度順の属性から予算内に収まる分だけを入れ子のJSONにする（採用した属性も返す）"""
+    truncation = PromptTruncation(budget_tokens)
+    rendered = [compact_json({attr.name: attr.value}) for attr in ranked_attributes]
+    included, tokens = select_within_budget(rendered, budget_tokens, max_items=max_attributes)
+    kept = list(ranked_attributes[:included])
+    context = compact_json(nest_attributes(kept))
+    truncation.estimated_tokens = estimate_tokens(context)
+    truncation.record("attributes", len(ranked_attributes), included)
+    return context, kept, truncation
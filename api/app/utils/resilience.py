@@ -0,0 +1,299 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import AsyncExitStack
+from typing import AsyncContextManager, Awaitable, Callable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class UpstreamUnavailableError(Exception):
+    """リトライしても応答が得られなかった、または遮断中で呼び出さなかった（呼び出し元は縮退した回答を返す）"""
+
+
+class CircuitOpenError(UpstreamUnavailableError):
+    pass
+
+
+class ConcurrencyLimitError(UpstreamUnavailableError):
+    """期限までに同時実行数の枠が空かなかった"""
+
+
+class LatencyTracker:
+    """直近N件の成功した呼び出しのレイテンシ（秒）からパーセンタイルを求める"""
+
+    def __init__(self, window: int = 500):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        with self._lock:
+            ordered = sorted(self._samples)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))]
+
+
+class CircuitBreaker:
+    """連続失敗がしきい値に達したら一定時間呼び出しを止め、その後1件だけ試して回復を確かめる
+
+    ResilientCallerからはリトライを含めた1回の論理的な呼び出しごとに成功・失敗が記録される。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.opened_count = 0
+        self.rejected_count = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected_count += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("Circuit breaker closed")
+            self._state = self.CLOSED
+            self._consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.opened_count += 1
+                    logger.warning(f"Circuit breaker opened after {self._consecutive_failures} consecutive failures")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def release(self) -> None:
+        """成功とも失敗とも判定しない結果だった場合に、回復確認の枠だけを返す"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def stats(self) -> dict:
+        state = self.state
+        with self._lock:
+            return {
+                "state": state,
+                "consecutive_failures": self._consecutive_failures,
+                "opened": self.opened_count,
+                "rejected": self.rejected_count,
+            }
+
+
+class ResilientCaller:
+    """1回の論理的な呼び出しに、全体の期限・試行ごとのタイムアウト・ジッター付き指数バックオフのリトライ・
+    p95を超えた時点での重複リクエスト（ヘッジ）・サーキットブレーカーを適用する
+
+    make_callは呼ぶたびに新しい試行のコルーチンを返す関数。ヘッジするので冪等な呼び出しにだけ使う。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        attempt_timeout: float,
+        deadline: float,
+        max_retries: int,
+        retry_base_seconds: float,
+        retry_max_seconds: float,
+        is_retryable: Callable[[BaseException], bool],
+        breaker: CircuitBreaker,
+        hedge_enabled: bool = False,
+        hedge_percentile: float = 95,
+        hedge_min_samples: int = 50
+    ):
+        self.name = name
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.is_retryable = is_retryable
+        self.breaker = breaker
+        self.hedge_enabled = hedge_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latency = LatencyTracker()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.hedges_sent = 0
+        self.hedges_won = 0
+
+    def _count(self, field: str) -> None:
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    async def call(
+        self,
+        make_call: Callable[[], Awaitable[T]],
+        deadline: Optional[float] = None,
+        attempt_timeout: Optional[float] = None,
+        slot: Optional[Callable[[], AsyncContextManager]] = None
+    ) -> T:
+        """slotは同時実行数の枠を取るコンテキストマネージャーを返す関数。試行（とヘッジ）ごとに取得し、
+        バックオフの待ちの間は保持しない。試行のタイムアウトとヘッジの計時は枠を取得してから始める
+
+        ブレーカーには1回の論理的な呼び出しにつき1回だけ成功・失敗を記録する（試行ごとには数えない）。
+        """
+        self._count("calls")
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.name} circuit breaker is open")
+
+        attempt_timeout = attempt_timeout if attempt_timeout is not None else self.attempt_timeout
+        deadline_at = time.monotonic() + (deadline if deadline is not None else self.deadline)
+        attempt = 0
+        while True:
+            try:
+                result = await self._attempt(make_call, slot, attempt_timeout, deadline_at)
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except ConcurrencyLimitError:
+                # 上流ではなくこのプロセスの混雑なのでブレーカーの判定には含めない
+                self.breaker.release()
+                self._count("failures")
+                raise
+            except Exception as e:
+                if not self.is_retryable(e):
+                    # 上流は応答している（プロンプトの内容などが原因）のでブレーカーの判定には含めない
+                    self.breaker.release()
+                    self._count("failures")
+                    raise
+                backoff = min(self.retry_max_seconds, self.retry_base_seconds * (2 ** attempt)) * random.random()
+                # 回復確認中（half-open）の呼び出しや、他の呼び出しでブレーカーが開いた場合はリトライしない
+                if attempt >= self.max_retries or time.monotonic() + backoff >= deadline_at or self.breaker.state != CircuitBreaker.CLOSED:
+                    self.breaker.record_failure()
+                    self._count("failures")
+                    raise UpstreamUnavailableError(f"{self.name} failed after {attempt + 1} attempt(s): {type(e).__name__}: {str(e)}") from e
+                attempt += 1
+                self._count("retries")
+                logger.warning(f"{self.name} attempt {attempt} failed ({type(e).__name__}: {str(e)}), retrying in {backoff:.2f}s")
+                await asyncio.sleep(backoff)
+                continue
+
+            self.breaker.record_success()
+            return result
+
+    async def _attempt(
+        self,
+        make_call: Callable[[], Awaitable[T]],
+        slot: Optional[Callable[[], AsyncContextManager]],
+        attempt_timeout: float,
+        deadline_at: float
+    ) -> T:
+        async with AsyncExitStack() as stack:
+            if deadline_at - time.monotonic() <= 0:
+                raise asyncio.TimeoutError()
+            if slot is not None:
+                try:
+                    await asyncio.wait_for(stack.enter_async_context(slot()), timeout=max(deadline_at - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    raise ConcurrencyLimitError(f"{self.name} timed out waiting for a concurrency slot")
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            started_at = time.monotonic()
+            result = await asyncio.wait_for(self._hedged(make_call, slot), timeout=min(attempt_timeout, remaining))
+            self.latency.observe(time.monotonic() - started_at)
+            return result
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not self.hedge_enabled or len(self.latency) < self.hedge_min_samples:
+            return None
+        return self.latency.percentile(self.hedge_percentile)
+
+    async def _hedged(self, make_call: Callable[[], Awaitable[T]], slot: Optional[Callable[[], AsyncContextManager]] = None) -> T:
+        hedge_delay = self._hedge_delay()
+        primary = asyncio.ensure_future(make_call())
+        if hedge_delay is None:
+            return await primary
+
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done:
+                # p95を過ぎても返ってこない呼び出しは、同じ内容をもう1本送って早い方を使う
+                self._count("hedges_sent")
+                # ヘッジも同時実行数の上限に含めるため、自分の枠を取ってから送る
+                tasks.append(asyncio.ensure_future(self._in_slot(make_call, slot)))
+
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self._count("hedges_won")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    @staticmethod
+    async def _in_slot(make_call: Callable[[], Awaitable[T]], slot: Optional[Callable[[], AsyncContextManager]]) -> T:
+        if slot is None:
+            return await make_call()
+        async with slot():
+            return await make_call()
+
+    def stats(self) -> dict:
+        p50 = self.latency.percentile(50)
+        p95 = self.latency.percentile(95)
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "failures": self.failures,
+                "hedging_enabled": self.hedge_enabled,
+                "hedges_sent": self.hedges_sent,
+                "hedges_won": self.hedges_won,
+                "latency_p50_ms": p50 * 1000 if p50 is not None else None,
+                "latency_p95_ms": p95 * 1000 if p95 is not None else None,
+                "breaker": self.breaker.stats(),
+            }
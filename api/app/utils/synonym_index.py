@@ -0,0 +1,125 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from core.config import get_env
+from utils.attribute_synonyms import ATTRIBUTE_SYNONYMS
+from utils.embedding import MODEL_NAME, generate_embedding_matrix
+
+logger = logging.getLogger(__name__)
+
+
+class SynonymIndex:
+    """ATTRIBUTE_SYNONYMSの全同義語を1つの正規化済み行列にまとめたもの
+
+    行はカテゴリーごとに連続して並んでいるので、1回の行列積の後に
+    カテゴリー単位の最大値を取るだけでカテゴリー別の関連度が得られる。
+    """
+
+    def __init__(self, categories: List[str], offsets: np.ndarray, matrix: np.ndarray):
+        self.categories = categories
+        self.offsets = offsets
+        self.matrix = matrix
+
+    def relevance(self, query_vector: np.ndarray) -> Dict[str, float]:
+        """カテゴリー名 -> そのカテゴリーの同義語との最大コサイン類似度"""
+        if not self.categories:
+            return {}
+        similarities = self.matrix @ query_vector
+        maxima = np.maximum.reduceat(similarities, self.offsets)
+        return {category: float(value) for category, value in zip(self.categories, maxima)}
+
+    def best_category(self, query_vector: np.ndarray) -> Tuple[Optional[str], float]:
+        """質問に最も近いカテゴリー名とその類似度（同義語が無ければ (None, 0)）"""
+        relevance = self.relevance(query_vector)
+        if not relevance:
+            return None, 0
+        category = max(relevance, key=relevance.get)
+        return category, relevance[category]
+
+    def category_similarities(self, vectors: np.ndarray, category: str) -> np.ndarray:
+        """複数の正規化済みベクトルそれぞれについて、指定したカテゴリーの同義語との最大コサイン類似度"""
+        position = self.categories.index(category)
+        start = self.offsets[position]
+        end = self.offsets[position + 1] if position + 1 < len(self.offsets) else len(self.matrix)
+        return (vectors @ self.matrix[start:end].T).max(axis=1)
+
+    def max_similarity(self, query_vector: np.ndarray) -> float:
+        return max(self.relevance(query_vector).values(), default=0)
+
+    def max_similarities(self, vectors: np.ndarray) -> np.ndarray:
+        """複数の正規化済みベクトルそれぞれについて、いずれかの同義語との最大コサイン類似度"""
+        if not self.categories:
+            return np.zeros(len(vectors), dtype=np.float32)
+        return (vectors @ self.matrix.T).max(axis=1)
+
+
+def _synonym_table_digest() -> str:
+    payload = json.dumps({"model": MODEL_NAME, "synonyms": ATTRIBUTE_SYNONYMS}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def _artifact_path() -> str:
+    model_slug = MODEL_NAME.replace("/", "_")
+    return os.path.join(get_env().EMBEDDING_ARTIFACT_DIR, f"synonym_index_{model_slug}_{_synonym_table_digest()}.npz")
+
+
+def build_synonym_index() -> SynonymIndex:
+    categories = []
+    offsets = []
+    texts = []
+    for category, synonyms in ATTRIBUTE_SYNONYMS.items():
+        if not synonyms:
+            continue
+        categories.append(category)
+        offsets.append(len(texts))
+        texts.extend(synonyms)
+
+    matrix = generate_embedding_matrix(texts)
+    return SynonymIndex(categories, np.asarray(offsets, dtype=np.intp), matrix)
+
+
+def load_or_build_synonym_index() -> SynonymIndex:
+    # 同義語テーブルとモデル名のハッシュをファイル名に含めているので、どちらかが変われば作り直される
+    path = _artifact_path()
+    if os.path.exists(path):
+        try:
+            with np.load(path, allow_pickle=False) as artifact:
+                index = SynonymIndex(
+                    [str(category) for category in artifact["categories"]],
+                    artifact["offsets"].astype(np.intp),
+                    artifact["matrix"].astype(np.float32),
+                )
+            logger.debug(f"Loaded synonym index from {path}")
+            return index
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning(f"Failed to load synonym index artifact {path}: {str(e)}")
+
+    index = build_synonym_index()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, categories=np.array(index.categories), offsets=index.offsets, matrix=index.matrix)
+        os.replace(tmp_path, path)
+        logger.debug(f"Saved synonym index to {path}")
+    except OSError as e:
+        logger.warning(f"Failed to save synonym index artifact {path}: {str(e)}")
+    return index
+
+
+_synonym_index: Optional[SynonymIndex] = None
+_synonym_index_lock = threading.Lock()
+
+
+def get_synonym_index() -> SynonymIndex:
+    global _synonym_index
+    if _synonym_index is None:
+        with _synonym_index_lock:
+            if _synonym_index is None:
+                _synonym_index = load_or_build_synonym_index()
+    return _synonym_index
@@ -1,4 +1,5 @@
 import re
+from typing import Optional
 from utils.constants import ATTRIBUTE_PREFIXES_TO_REMOVE
 
 def clean_json_response(response_text: str) -> str:
@@ -13,3 +14,12 @@ def clean_attribute_name(name: str) -> str:
 
     # スペースで区切られた各単語の先頭を大文字に
     return ' '.join(word.capitalize() for word in cleaned_name.split())
+
+def find_name_in_text(name: str, text: str) -> Optional[re.Match]:
+    """フルネーム、または名前の一部（姓・名）が単語として含まれていれば、最初に見つかった位置を返す"""
+    tokens = [name] + [token for token in name.split() if len(token) > 1]
+    for token in tokens:
+        match = re.search(rf"\b{re.escape(token)}\b", text, re.IGNORECASE)
+        if match:
+            return match
+    return None
@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from core.config import get_env
+from utils.embedding import normalize_vectors
+
+logger = logging.getLogger(__name__)
+
+
+class IndexedAttribute:
+    def __init__(self, friend_id: int, attribute_id: int, name: str, value: str):
+        self.friend_id = friend_id
+        self.attribute_id = attribute_id
+        self.name = name
+        self.value = value
+
+
+class UserVectorIndex:
+    """1ユーザーの全友人の属性を1つの連続した正規化済み行列で持つインデックス
+
+    行番号 -> (friend_id, 属性) の対応を保持し、1回の行列ベクトル積で全友人の属性を検索する。
+    """
+
+    def __init__(self, user_id: int, dimension: int, capacity: int = 64):
+        self.user_id = user_id
+        self.dimension = dimension
+        self.built_at = time.monotonic()
+        self._matrix = np.zeros((max(capacity, 1), dimension), dtype=np.float32)
+        self._rows: List[IndexedAttribute] = []
+        self._positions: Dict[Tuple[int, int], int] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def upsert(self, friend_id: int, attribute_id: int, name: str, value: str, vector: np.ndarray) -> None:
+        normalized = normalize_vectors(vector)
+        with self._lock:
+            key = (friend_id, attribute_id)
+            position = self._positions.get(key)
+            if position is None:
+                position = len(self._rows)
+                if position == self._matrix.shape[0]:
+                    # 容量を倍にして償却O(1)で追加する
+                    grown = np.zeros((self._matrix.shape[0] * 2, self.dimension), dtype=np.float32)
+                    grown[:position] = self._matrix[:position]
+                    self._matrix = grown
+                self._rows.append(IndexedAttribute(friend_id, attribute_id, name, value))
+                self._positions[key] = position
+            else:
+                row = self._rows[position]
+                row.name = name
+                row.value = value
+            self._matrix[position] = normalized
+
+    def remove_friend(self, friend_id: int) -> None:
+        with self._lock:
+            for key in [key for key in self._positions if key[0] == friend_id]:
+                self._remove(key)
+
+    def _remove(self, key: Tuple[int, int]) -> None:
+        # 最後の行を削除位置に移して行列を連続に保つ
+        position = self._positions.pop(key)
+        last = len(self._rows) - 1
+        if position != last:
+            moved = self._rows[last]
+            self._rows[position] = moved
+            self._matrix[position] = self._matrix[last]
+            self._positions[(moved.friend_id, moved.attribute_id)] = position
+        self._rows.pop()
+
+    def search(
+        self,
+        query_vector: np.ndarray,
+        category_similarity: float = 0,
+        threshold: float = 0.5,
+        max_friends: Optional[int] = None
+    ) -> List[Tuple[int, List[Tuple[IndexedAttribute, float]]]]:
+        """閾値を超える属性を友人ごとにまとめ、最も類似度の高い属性の順に友人を返す
+
+        各友人の属性は類似度の降順。同義語カテゴリーとの類似度の扱いはselect_relevant_attributesと同じ。
+        """
+        with self._lock:
+            count = len(self._rows)
+            if not count:
+                return []
+            similarities = self._matrix[:count] @ query_vector
+            rows = list(self._rows)
+
+        relevance = np.maximum(similarities, category_similarity)
+        selected = np.flatnonzero((similarities > threshold) | (category_similarity > threshold))
+        order = selected[np.argsort(-relevance[selected], kind="stable")]
+
+        grouped: "OrderedDict[int, List[Tuple[IndexedAttribute, float]]]" = OrderedDict()
+        for i in order:
+            row = rows[i]
+            if row.friend_id not in grouped:
+                if max_friends is not None and len(grouped) >= max_friends:
+                    continue
+                grouped[row.friend_id] = []
+            grouped[row.friend_id].append((row, float(relevance[i])))
+        return list(grouped.items())
+
+
+class VectorIndexRegistry:
+    """ユーザーごとのUserVectorIndexをLRUで保持する（プロセス内）
+
+    他のワーカープロセスでの書き込みは反映されないため、TTLを過ぎたインデックスは作り直す。
+    """
+
+    def __init__(self, max_users: int, ttl_seconds: float):
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self._indexes: "OrderedDict[int, UserVectorIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: int) -> Optional[UserVectorIndex]:
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None and time.monotonic() - index.built_at > self.ttl_seconds:
+                del self._indexes[user_id]
+                index = None
+            if index is None:
+                self.misses += 1
+                return None
+            self._indexes.move_to_end(user_id)
+            self.hits += 1
+            return index
+
+    def put(self, index: UserVectorIndex) -> None:
+        with self._lock:
+            self._indexes[index.user_id] = index
+            self._indexes.move_to_end(index.user_id)
+            while len(self._indexes) > self.max_users:
+                self._indexes.popitem(last=False)
+                self.evictions += 1
+
+    def peek(self, user_id: int) -> Optional[UserVectorIndex]:
+        """LRUの順序や統計を変えずに、常駐しているインデックスを返す（書き込み時の差分反映用）"""
+        with self._lock:
+            return self._indexes.get(user_id)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._indexes.pop(user_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "resident_users": len(self._indexes),
+                "max_users": self.max_users,
+                "rows": sum(len(index) for index in self._indexes.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+vector_index_registry = VectorIndexRegistry(
+    max_users=get_env().VECTOR_INDEX_MAX_USERS,
+    ttl_seconds=get_env().VECTOR_INDEX_TTL_SECONDS,
+)
+
+
+def index_attribute(user_id: int, friend_id: int, attribute_id: int, name: str, value: str, vector) -> None:
+    """常駐しているインデックスがあれば属性の追加・更新を反映する（無ければ次の検索時に作られる）"""
+    index = vector_index_registry.peek(user_id)
+    if index is not None:
+        index.upsert(friend_id, attribute_id, name, value, np.asarray(vector, dtype=np.float32))
+
+
+def unindex_friend(user_id: int, friend_id: int) -> None:
+    index = vector_index_registry.peek(user_id)
+    if index is not None:
+        index.remove_friend(friend_id)
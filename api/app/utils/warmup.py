@@ -0,0 +1,58 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+from utils.embedding import get_model
+from utils.synonym_index import get_synonym_index
+
+logger = logging.getLogger(__name__)
+
+# キャッシュを経由せずモデルに直接通すプローブ文（初回推論のコストをここで払っておく）
+PROBE_TEXTS = [
+    "Tokyo",
+    "Occupation: Engineer",
+    "Who lives in Tokyo?",
+    "What is Jon's occupation?",
+]
+
+_ready = threading.Event()
+_started_at: Optional[float] = None
+_finished_at: Optional[float] = None
+_error: Optional[str] = None
+
+
+def warmup() -> None:
+    """モデルの読み込み・プローブ文の推論・同義語インデックスの構築を行い、完了したらreadyにする"""
+    global _started_at, _finished_at, _error
+    _started_at = time.monotonic()
+    try:
+        model = get_model()
+        model.encode(PROBE_TEXTS, convert_to_numpy=True)
+        get_synonym_index()
+    except Exception as e:
+        _error = str(e)
+        logger.exception(f"Embedding warmup failed: {str(e)}")
+        return
+    _finished_at = time.monotonic()
+    _ready.set()
+    logger.info(f"Embedding warmup finished in {_finished_at - _started_at:.2f}s")
+
+
+def start_warmup_in_background() -> threading.Thread:
+    thread = threading.Thread(target=warmup, name="embedding-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def is_ready() -> bool:
+    return _ready.is_set()
+
+
+def readiness() -> dict:
+    return {
+        "ready": _ready.is_set(),
+        "warmup_started": _started_at is not None,
+        "warmup_seconds": (_finished_at - _started_at) if _finished_at is not None else None,
+        "error": _error,
+    }
@@ -11,6 +11,8 @@ import Cookies from 'js-cookie';
 const ChatPage: React.FC = () => {
   const router = useRouter();
   const [messages, setMessages] = useState<ChatMessageReceive[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [loadingOlder, setLoadingOlder] = useState(false);
   const [inputMessage, setInputMessage] = useState('');
   const [loading, setLoading] = useState(false);
   const [initialLoading, setInitialLoading] = useState(true);
@@ -24,7 +26,8 @@ const ChatPage: React.FC = () => {
     }
     try {
       const response = await getChats(token);
-      setMessages(response); // データの順序を維持
+      setMessages(response.items); // データの順序を維持
+      setNextCursor(response.next_cursor);
 
       // レスポンスが返ってきた後、次のレンダリングサイクルでスクロールを実行
       setTimeout(() => {
@@ -49,7 +52,8 @@ const ChatPage: React.FC = () => {
     }
     try {
       const response = await getChats(token);
-      setMessages(response); // データの順序を維持
+      setMessages(response.items); // データの順序を維持
+      setNextCursor(response.next_cursor);
     } catch (error) {
       console.error('Failed to fetch chats:', error);
     } finally {
@@ -57,6 +61,26 @@ const ChatPage: React.FC = () => {
     }
   };
 
+  // 表示中の履歴より古いページを先頭に追加する
+  const fetchOlderChats = async () => {
+    const token = Cookies.get('auth_token');
+    if (!token) {
+      router.push('/login');
+      return;
+    }
+    if (!nextCursor) return;
+    setLoadingOlder(true);
+    try {
+      const response = await getChats(token, nextCursor);
+      setMessages((current) => [...response.items, ...current]);
+      setNextCursor(response.next_cursor);
+    } catch (error) {
+      console.error('Failed to fetch older chats:', error);
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
   useEffect(() => {
     fetchChatsAndScroll();
   }, [router]);
@@ -97,6 +121,17 @@ const ChatPage: React.FC = () => {
     <div className="min-h-screen bg-gray-100 flex flex-col">
       <main className="flex-grow p-4 mb-32 overflow-y-auto">
         <div className="space-y-4">
+          {nextCursor && (
+            <div className="flex justify-center">
+              <button
+                onClick={fetchOlderChats}
+                disabled={loadingOlder}
+                className="text-sm text-blue-500 hover:underline disabled:opacity-50"
+              >
+                {loadingOlder ? 'Loading...' : 'Load earlier messages'}
+              </button>
+            </div>
+          )}
           {messages && messages.length > 0 ? (
             messages.map((message, index) => (
               <div key={index} className="space-y-2">
@@ -16,6 +16,12 @@ export interface ChatResponse {
   created_at: string;
 }
 
+// GET /chats のレスポンス（items は古い順。next_cursor を渡すとさらに古い履歴を取得できる）
+export interface ChatHistoryPage {
+  items: ChatMessageReceive[];
+  next_cursor: string | null;
+}
+
 // チャットレスポンスの型
 // export interface ChatResponse {
 //   question_category: number;
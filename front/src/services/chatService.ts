@@ -1,10 +1,14 @@
-import { ChatMessageSend, ChatMessageReceive } from '@/interfaces/chat';
+import { ChatMessageSend, ChatMessageReceive, ChatHistoryPage } from '@/interfaces/chat';
 import { getApiUrl } from '@/utils/getApiUrl';
 
 const API_URL = getApiUrl();
 
-export const getChats = async (token: string): Promise<ChatMessageReceive[]> => {
-  const response = await fetch(`${API_URL}/chats/`, {
+export const getChats = async (token: string, cursor?: string | null, limit: number = 50): Promise<ChatHistoryPage> => {
+  const params = new URLSearchParams({ limit: String(limit) });
+  if (cursor) {
+    params.set('cursor', cursor);
+  }
+  const response = await fetch(`${API_URL}/chats/?${params.toString()}`, {
     method: 'GET',
     headers: {
       'Authorization': `Bearer ${token}`,
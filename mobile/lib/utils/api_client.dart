@@ -83,11 +83,15 @@ class ApiClient {
     }
   }
 
-  Future<List<ChatMessageReceive>> getChats() async {
+  Future<List<ChatMessageReceive>> getChats({String? cursor, int limit = 50}) async {
     try {
-      final response = await _dio.get('/chats/');
+      final response = await _dio.get('/chats/', queryParameters: {
+        'limit': limit,
+        if (cursor != null) 'cursor': cursor,
+      });
       if (response.statusCode == 200) {
-        final List<dynamic> chatsJson = response.data;
+        // { "items": [...古い順...], "next_cursor": "..." } の形式で返る
+        final List<dynamic> chatsJson = response.data['items'];
         return chatsJson.map((json) => ChatMessageReceive.fromJson(json)).toList();
       } else {
         throw DioException(